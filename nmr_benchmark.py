@@ -0,0 +1,767 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Under GPL licence.
+
+Purpose:
+========
+Synthetic Varian data and benchmarks of nmr_procy
+
+* SyntheticExperiment writes a procpar and a fid file (1D, 2D HSQC,
+  TROSY, f1180, arrayed pseudo 3D, 3D, non uniformly sampled 2D) of any
+  size
+* Benchmark times the procpar parsing, the script generation and the
+  whole (native) processing of a set of experiments and writes the
+  results as JSON, two results can be compared
+* Check compares the results of the processing paths that must give the
+  same (or a close enough) spectrum
+
+Usage:
+======
+    nmr_benchmark.py run [quick|production] [repeat N] [output file.json]
+    nmr_benchmark.py compare <base.json> <new.json> [threshold 0.1]
+    nmr_benchmark.py generate <folder> [quick|production]
+    nmr_benchmark.py check
+
+Requires:
+=========
+* numpy
+* nmr_procy.py (in the same folder)
+
+"""
+
+import glob
+import json
+import os
+import platform
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy
+import nmr_procy
+
+class SyntheticExperiment():
+    """
+    Write a synthetic Varian experiment: procpar and fid
+
+    The peaks are decaying complex exponentials with random positions (the
+    seed makes the data the same every time) plus noise. The fid order is
+    the same as of the spectrometer: [ni2][ni][phase][phase2 / array][np].
+
+    Example:
+
+        SyntheticExperiment('data/hsqc/', 'HSQC', np = 2048, ni = 128)
+        SyntheticExperiment('data/t1/', 'ARRAYED', np = 2048, ni = 128,
+                            arrayed = [0.01, 0.05, 0.1, 0.2, 0.4])
+        SyntheticExperiment('data/nus/', 'HSQC', np = 2048, ni = 128,
+                            schedule = SyntheticExperiment.Schedule(128, 48))
+    """
+    # Kinds of experiments: (seqfil, f1180)
+    KINDS = {'1D'      : ('s2pul', 'n'),
+             'HSQC'    : ('gNhsqc', 'n'),
+             'TROSY'   : ('gNhsqc_trosy', 'n'),
+             'F1180'   : ('gNhsqc', 'y'),
+             'ARRAYED' : ('gNhsqc_T1', 'n'),
+             '3D'      : ('ghn_co', 'n')}
+    #####################################################
+    def __init__(self, Path, kind = 'HSQC', np = 2048, ni = 128, ni2 = 1,
+                 arrayed = None, peaks = 20, filler = 600, datatype = 'float',
+                 traces = 1, schedule = None, seed = 1):
+        """
+        Parameters:
+
+        * Path     = folder of the experiment, created if needed
+        * kind     = one of KINDS
+        * np       = number of points (real + imaginary) of a fid
+        * ni       = number of increments of the second dimension
+        * ni2      = number of increments of the third dimension (3D)
+        * arrayed  = values of the arrayed relaxation delay (ARRAYED, or a
+                     series of 1D fids)
+        * peaks    = number of peaks
+        * filler   = number of extra procpar parameters, a real procpar
+                     has several hundreds
+        * datatype = 'float' or 'int32' data points
+        * traces   = number of fids (traces) in a block of the fid file
+        * schedule = the measured t1 increments of a non uniformly sampled
+                     2D (sampling.sch), like Schedule(), None = all of them
+        * seed     = seed of the random peaks and noise
+        """
+        self.Path = os.path.join(Path, '')
+        if not os.path.isdir(self.Path):
+            os.makedirs(self.Path)
+        self.kind = kind
+        self.np = np
+        self.ni = 1 if kind == '1D' else ni
+        self.ni2 = ni2 if kind == '3D' else 1
+        self.arrayed = arrayed if kind in ('ARRAYED', '1D') else None
+        self.schedule = schedule if kind != '3D' else None
+        self.random = numpy.random.RandomState(seed)
+        self.Write_procpar(peaks, filler)
+        fids = self.Fids(peaks)
+        if self.schedule:
+            # The same fids as of the uniformly sampled experiment
+            fids = fids[:, self.schedule]
+            schedule = open(self.Path + 'sampling.sch', 'w')
+            schedule.write(''.join(['{0}\n'.format(index) for index in self.schedule]))
+            schedule.close()
+        self.Write_fid(fids, datatype, traces)
+        return None
+    #####################################################
+    @staticmethod
+    def Schedule(ni, measured, seed = 1):
+        """
+        Returns a sorted, exponentially weighted random sampling schedule
+        of measured increments out of ni, the first one is always measured
+        """
+        random = numpy.random.RandomState(seed)
+        weights = numpy.exp(-numpy.arange(ni) / (ni / 2.0))
+        weights[0] = 0.0
+        chosen = random.choice(ni, measured - 1, replace = False,
+                               p = weights / weights.sum())
+        return sorted([0] + [int(index) for index in chosen])
+    #####################################################
+    def Parameters(self):
+        """
+        Returns the procpar parameters {name: value or list of values}
+        """
+        seqfil, f1180 = self.KINDS[self.kind]
+        array = 'phase'
+        if self.kind == '1D':
+            array = 'relaxT' if self.arrayed else ''
+        elif self.arrayed:
+            array = 'phase,relaxT'
+        elif self.kind == '3D':
+            array = 'phase,phase2'
+        parameters = {'seqfil' : seqfil, 'np': self.np, 'ni': self.ni,
+                      'ni2': self.ni2, 'sw': 8000.0, 'sw1': 2000.0,
+                      'sw2': 1600.0, 'sfrq': 599.79, 'dfrq': 150.83,
+                      'dfrq2': 60.78, 'tn': 'H1', 'dn': 'C13', 'dn2': 'N15',
+                      'temp': 25.0, 'f1180': f1180, 'f2180': 'n',
+                      'array': array, 'phase': [1, 2], 'phase2': [1, 2],
+                      'nt': 8, 'd1': 1.0,
+                      'arraydim': len(self.schedule or range(self.ni)) * self.ni2 *
+                                  len(self.arrayed or [1]) *
+                                  {'1D': 1, '3D': 4}.get(self.kind, 2)}
+        if self.arrayed:
+            parameters['relaxT'] = list(self.arrayed)
+        if self.schedule:
+            parameters['sampling'] = 'sparse'
+        return parameters
+    #####################################################
+    def Write_procpar(self, peaks, filler):
+        """
+        Write the procpar: the parameters and filler parameters of both
+        types, like the hundreds of parameters of a real procpar
+        """
+        lines = []
+        parameters = self.Parameters()
+        for number in range(filler):
+            if number % 3:
+                parameters['filler{0:04d}'.format(number)] = [
+                    float(value) for value in range(number % 5 + 1)]
+            else:
+                parameters['filler{0:04d}'.format(number)] = 'value{0}'.format(number)
+        for name in sorted(parameters):
+            value = parameters[name]
+            if isinstance(value, str):
+                lines.append('{0} 2 2 256 0 0 2 1 0 1 64'.format(name))
+                lines.append('1 "{0}"'.format(value))
+            else:
+                if not isinstance(value, list):
+                    value = [value]
+                lines.append('{0} 1 1 1e+18 -1e+18 0 2 1 0 1 64'.format(name))
+                lines.append(' '.join([str(len(value))] + [repr(item) for item in value]))
+            lines.append('0')
+        procpar = open(self.Path + 'procpar', 'w')
+        procpar.write('\n'.join(lines) + '\n')
+        procpar.close()
+        return None
+    #####################################################
+    def Modulation(self, times, frequencies, mode):
+        """
+        Returns the modulation of an indirect dimension, shape = (times,
+        phases, peaks)
+
+        Parameters:
+        ===========
+            * mode = 'States' (cosine, sine), 'Rance-Kay' (echo, anti-echo)
+                     or None (not incremented, one phase)
+        """
+        phase = 2j * numpy.pi * numpy.outer(times, frequencies)
+        if mode == 'States':
+            return numpy.array([numpy.cos(phase.imag), numpy.sin(phase.imag)]).transpose(1, 0, 2)
+        if mode == 'Rance-Kay':
+            return numpy.array([numpy.exp(phase), numpy.exp(-phase)]).transpose(1, 0, 2)
+        return numpy.ones((len(times), 1, len(frequencies)))
+    #####################################################
+    def Fids(self, peaks):
+        """
+        Returns the complex fids, shape = (ni2, ni, phases, array, np / 2)
+
+        The coding of the indirect dimensions is what Convert_HSQC expects:
+        echo / anti-echo for the (15N) dimension of the 2D experiments and
+        the third dimension of a 3D, States for the second dimension of a
+        3D.
+        """
+        points = self.np / 2
+        t = numpy.arange(points) / 8000.0
+        t1 = (numpy.arange(self.ni) + (0.5 if self.KINDS[self.kind][1] == 'y' else 0.0)) / 2000.0
+        t2 = numpy.arange(self.ni2) / 1600.0
+        w = self.random.uniform(-3500.0, 3500.0, peaks)
+        w1 = self.random.uniform(-900.0, 900.0, peaks)
+        w2 = self.random.uniform(-700.0, 700.0, peaks)
+        amplitude = self.random.uniform(0.2, 1.0, peaks)
+        rate = self.random.uniform(1.0, 10.0, peaks)
+        direct = numpy.exp(numpy.outer(2j * numpy.pi * w - 20.0, t))
+        delays = numpy.array(self.arrayed or [0.0])
+        decay = numpy.exp(-numpy.outer(delays, rate)) * amplitude
+        if self.kind == '1D':
+            modes = (None, None)
+        elif self.kind == '3D':
+            modes = ('States', 'Rance-Kay')
+        else:
+            modes = ('Rance-Kay', None)
+        first = self.Modulation(t1, w1, modes[0])
+        second = self.Modulation(t2, w2, modes[1])
+        # (ni2, ni, phase, phase2, peaks), phase2 changes faster
+        indirect = second[:, numpy.newaxis, numpy.newaxis] * first[numpy.newaxis, :, :, numpy.newaxis]
+        indirect = indirect.reshape((self.ni2, self.ni, -1, peaks))
+        fids = numpy.einsum('abcp,dp,pn->abcdn', indirect, decay, direct)
+        noise = self.random.normal(0.0, 0.02, fids.shape + (2,))
+        fids += noise[..., 0] + 1j * noise[..., 1]
+        return fids.astype(numpy.complex64)
+    #####################################################
+    def Write_fid(self, fids, datatype = 'float', traces = 1):
+        """
+        Write the fid file, traces fids in every block
+        """
+        fids = fids.reshape((-1, fids.shape[-1]))
+        if fids.shape[0] % traces:
+            raise ValueError('{0} fids can not be written in blocks of {1} traces'.format(
+                             fids.shape[0], traces))
+        VarianFid = nmr_procy.VarianFid
+        if datatype == 'float':
+            status = (VarianFid.S_DATA | VarianFid.S_32 | VarianFid.S_FLOAT |
+                      VarianFid.S_COMPLEX)
+            points = numpy.empty((fids.shape[0], 2 * fids.shape[1]), dtype = '>f4')
+            points[:, 0::2] = fids.real
+            points[:, 1::2] = fids.imag
+        else:
+            status = VarianFid.S_DATA | VarianFid.S_32 | VarianFid.S_COMPLEX
+            scale = 2.0 ** 30 / max(abs(fids.real).max(), abs(fids.imag).max())
+            points = numpy.empty((fids.shape[0], 2 * fids.shape[1]), dtype = '>i4')
+            points[:, 0::2] = numpy.round(fids.real * scale)
+            points[:, 1::2] = numpy.round(fids.imag * scale)
+        tbytes = points.shape[1] * 4
+        nblocks = fids.shape[0] / traces
+        header = numpy.array([(nblocks, traces, points.shape[1], 4, tbytes,
+                               traces * tbytes + VarianFid.BLOCK_HEADER_SIZE, 0, status, 1)],
+                             dtype = numpy.dtype([('nblocks', '>i4'), ('ntraces', '>i4'),
+                                                  ('np', '>i4'), ('ebytes', '>i4'),
+                                                  ('tbytes', '>i4'), ('bbytes', '>i4'),
+                                                  ('vers_id', '>i2'), ('status', '>i2'),
+                                                  ('nbheaders', '>i4')]))
+        blocks = numpy.zeros(nblocks, dtype = [('head', '>i2', (4,)),
+                                               ('rest', '>i4', (5,)),
+                                               ('data', points.dtype, (traces * points.shape[1],))])
+        blocks['head'][:, 1] = status
+        blocks['head'][:, 2] = numpy.arange(1, nblocks + 1)
+        blocks['rest'][:, 0] = self.Parameters()['nt']
+        blocks['data'] = points.reshape((nblocks, -1))
+        fid = open(self.Path + 'fid', 'wb')
+        header.tofile(fid)
+        blocks.tofile(fid)
+        fid.close()
+        return None
+################################################################################
+
+
+def Silence():
+    """
+    Send the output (also of the worker processes) to /dev/null, returns
+    what Restore() needs
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    null = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(null, 1)
+    os.dup2(null, 2)
+    os.close(null)
+    return saved
+################################################################################
+
+
+def Restore(saved):
+    """
+    Restore the output after Silence()
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(saved[0], 1)
+    os.dup2(saved[1], 2)
+    os.close(saved[0])
+    os.close(saved[1])
+    return None
+################################################################################
+
+
+class ScriptOnly(nmr_procy.Convert_HSQC):
+    """
+    Convert_HSQC that only makes the script, without processing
+    """
+    def RunConvertFile(self, *arguments, **keywords):
+        return None
+    def ByeBye(self):
+        return None
+################################################################################
+
+
+class Benchmark():
+    """
+    Time the steps of nmr_procy on synthetic experiments
+
+    Every value is the best (minimum) of the repeats, the median is also
+    kept. Throughput is spectra / s (a plane of an arrayed experiment is
+    one spectrum) and MB / s of fid data.
+
+    Example:
+
+        Results = Benchmark('quick', repeat = 3).results
+    """
+    # name: (kind, np, ni, ni2, arrayed values)
+    SIZES = {'quick'      : [('1d_np16k',            '1D',      16384, 1,   1,  None),
+                             ('hsqc_np1k_ni64',      'HSQC',     1024, 64,  1,  None),
+                             ('trosy_np1k_ni64',     'TROSY',    1024, 64,  1,  None),
+                             ('f1180_np1k_ni64',     'F1180',    1024, 64,  1,  None),
+                             ('arrayed_np1k_ni64x4', 'ARRAYED',  1024, 64,  1,  [0.01, 0.05, 0.1, 0.2]),
+                             ('3d_np512_ni16x16',    '3D',        512, 16,  16, None)],
+             'production' : [('1d_np64k',             '1D',      65536, 1,   1,  None),
+                             ('hsqc_np2k_ni256',      'HSQC',     2048, 256, 1,  None),
+                             ('trosy_np2k_ni256',     'TROSY',    2048, 256, 1,  None),
+                             ('f1180_np2k_ni128',     'F1180',    2048, 128, 1,  None),
+                             ('arrayed_np2k_ni128x10', 'ARRAYED', 2048, 128, 1,
+                              [0.01, 0.03, 0.05, 0.1, 0.15, 0.2, 0.3, 0.4, 0.6, 0.8]),
+                             ('3d_np1k_ni64x40',      '3D',       1024, 64,  40, None)]}
+    #####################################################
+    def __init__(self, size = 'quick', repeat = 3, Folder = None):
+        """
+        Parameters:
+
+        * size   = 'quick' or 'production', see SIZES
+        * repeat = number of repeats of every measurement
+        * Folder = where the experiments are made, default = a temporary
+                   folder, removed at the end
+        """
+        self.repeat = repeat
+        temporary = Folder is None
+        if temporary:
+            Folder = tempfile.mkdtemp(prefix = 'nmr_benchmark_')
+        self.results = {'environment': self.Environment(), 'size': size,
+                        'repeat': repeat, 'cases': {}}
+        try:
+            for name, kind, np, ni, ni2, arrayed in self.SIZES[size]:
+                Path = os.path.join(Folder, name, '')
+                experiment = SyntheticExperiment(Path, kind, np = np, ni = ni,
+                                                 ni2 = ni2, arrayed = arrayed)
+                self.results['cases'][name] = self.Run_case(
+                    Path, arrayed, experiment.Parameters().keys())
+                print '{0:24s} {1}'.format(name, ' '.join(
+                      ['{0}={1:.4g}'.format(key, value) for key, value in
+                       sorted(self.results['cases'][name].items())
+                       if not key.endswith('_median')]))
+        finally:
+            if temporary:
+                shutil.rmtree(Folder, True)
+        return None
+    #####################################################
+    def Environment(self):
+        """
+        Returns the description of the measurement: commit, versions, host
+        """
+        try:
+            commit = subprocess.Popen(['git', 'rev-parse', 'HEAD'],
+                                      stdout = subprocess.PIPE, stderr = subprocess.PIPE,
+                                      cwd = os.path.dirname(os.path.abspath(__file__))
+                                      ).communicate()[0].strip()
+        except OSError:
+            commit = ''
+        return {'commit'  : commit,
+                'date'    : time.strftime('%Y-%m-%d %H:%M:%S'),
+                'python'  : platform.python_version(),
+                'numpy'   : numpy.__version__,
+                'pyfftw'  : nmr_procy.pyfftw and nmr_procy.pyfftw.__version__,
+                'host'    : platform.node(),
+                'machine' : platform.machine(),
+                'cpus'    : nmr_procy.multiprocessing.cpu_count()}
+    #####################################################
+    def Time(self, function, prepare = None):
+        """
+        Returns the best and the median time of function in seconds
+
+        Parameters:
+        ===========
+            * function = called without arguments
+            * prepare = called before every repeat, not timed
+        """
+        times = []
+        for number in range(self.repeat):
+            if prepare:
+                prepare()
+            saved = Silence()
+            try:
+                start = time.time()
+                function()
+                times.append(time.time() - start)
+            finally:
+                Restore(saved)
+        return min(times), sorted(times)[len(times) / 2]
+    #####################################################
+    def Run_case(self, Path, arrayed, names):
+        """
+        Returns the measured values of one experiment
+
+        Parameters:
+        ===========
+            * Path = folder of the experiment
+            * arrayed = arrayed values (one spectrum each) or None
+            * names = the procpar parameters read by the parsing benchmark,
+                      like the processing reads them
+        """
+        result = {}
+        index = Path + '.procpar.index'
+        def Remove_index():
+            if os.path.exists(index):
+                os.remove(index)
+        def Parse():
+            procpar = nmr_procy.ProcparData(Path)
+            for name in names:
+                procpar.parameter(name)
+        result['procpar_s'], result['procpar_s_median'] = self.Time(Parse, Remove_index)
+        Parse()
+        result['procpar_indexed_s'], result['procpar_indexed_s_median'] = self.Time(Parse)
+        arguments = ['noplot', 'nocache', '0.0']
+        saved = Silence()
+        try:
+            converter = ScriptOnly(arguments, Path = Path, Temperature = 25.0)
+        finally:
+            Restore(saved)
+        def Script():
+            converter.CreateConverFile(userphase = '0.0', SecondDimension = 'N',
+                                       Extract = [10.0, 6.0] if converter._2D else None,
+                                       Trosy_experiment = 'trosy' in converter.Info('seqfil')[0])
+        result['script_s'], result['script_s_median'] = self.Time(Script)
+        def Clean():
+            # Kept intermediates would make the next repeat a rephasing
+            for name in os.listdir(Path):
+                if name not in ('procpar', 'fid', '.procpar.index'):
+                    if os.path.isdir(Path + name):
+                        shutil.rmtree(Path + name, True)
+                    else:
+                        os.remove(Path + name)
+        def Process():
+            nmr_procy.Convert_HSQC(['noplot', 'nocache', 'native', '0.0'],
+                                   Path = Path, Temperature = 25.0)
+        best, median = self.Time(Process, Clean)
+        spectra = len(arrayed) if arrayed else 1
+        megabytes = os.path.getsize(Path + 'fid') / 1024.0 ** 2
+        result['process_s'] = best
+        result['process_s_median'] = median
+        result['spectra_per_s'] = spectra / best
+        result['fid_MB_per_s'] = megabytes / best
+        result['fid_MB'] = megabytes
+        return result
+    #####################################################
+    def Write(self, FileName):
+        """
+        Write the results as JSON
+        """
+        json.dump(self.results, open(FileName, 'w'), indent = 1, sort_keys = True)
+        return None
+    #####################################################
+    @staticmethod
+    def Compare(Base, New, threshold = 0.1):
+        """
+        Print the ratio of every value of two results, returns the number
+        of regressions (more than threshold slower)
+
+        Parameters:
+        ===========
+            * Base, New = result files of Benchmark.Write
+            * threshold = relative change that counts as a regression
+        """
+        base = json.load(open(Base))
+        new = json.load(open(New))
+        print 'base: {0} {1}'.format(base['environment']['commit'][:10], base['environment']['date'])
+        print 'new:  {0} {1}'.format(new['environment']['commit'][:10], new['environment']['date'])
+        if base['environment']['host'] != new['environment']['host']:
+            print 'WARNING: measured on different hosts!'
+        regressions = 0
+        for case in sorted(new['cases']):
+            if case not in base['cases']:
+                continue
+            for key in sorted(new['cases'][case]):
+                if key.endswith('_median') or key == 'fid_MB':
+                    continue
+                old_value = base['cases'][case].get(key)
+                value = new['cases'][case][key]
+                if not old_value or not value:
+                    continue
+                # Positive change = slower: throughputs are better if larger,
+                # times if smaller
+                if key.endswith('_per_s'):
+                    change = old_value / value - 1.0
+                else:
+                    change = value / old_value - 1.0
+                flag = ''
+                if change > threshold:
+                    flag = '  <== REGRESSION'
+                    regressions += 1
+                print '{0:24s} {1:20s} {2:10.4g} {3:10.4g} {4:+7.1%}{5}'.format(
+                      case, key, old_value, value, change, flag)
+        return regressions
+################################################################################
+
+
+class Check():
+    """
+    Correctness checks of nmr_procy on small synthetic experiments
+
+    Every check returns None or the description of the failure, the names
+    of the failed checks are in failures.
+
+    Example:
+
+        if Check().failures:
+            ...
+    """
+    CHECKS = ['Fid_traces', 'Nus', 'Stream', 'Lp', 'Prephase', 'Index']
+    # Smallest correlation of the IST reconstruction (48 of 128
+    # increments) with the uniformly sampled spectrum
+    NUS_CORRELATION = 0.95
+    #####################################################
+    def __init__(self, Folder = None):
+        """
+        Parameters:
+
+        * Folder = where the experiments are made, default = a temporary
+                   folder, removed at the end
+        """
+        self.failures = []
+        temporary = Folder is None
+        if temporary:
+            Folder = tempfile.mkdtemp(prefix = 'nmr_check_')
+        try:
+            for name in self.CHECKS:
+                error = getattr(self, name)(os.path.join(Folder, name.lower(), ''))
+                if error:
+                    self.failures.append(name)
+                print '{0:24s} {1}'.format(name, error and 'FAILED: ' + error or 'ok')
+        finally:
+            if temporary:
+                shutil.rmtree(Folder, True)
+        return None
+    #####################################################
+    def Process(self, Path, flags = ()):
+        """
+        Process an experiment natively, returns the content of its .ucsf
+        files
+        """
+        saved = Silence()
+        try:
+            nmr_procy.Convert_HSQC(['noplot', 'nocache', 'native'] + list(flags) + ['0.0'],
+                                   Path = Path, Temperature = 25.0)
+        finally:
+            Restore(saved)
+        return [open(name, 'rb').read() for name in
+                sorted(glob.glob(Path + '*.ucsf'))]
+    #####################################################
+    def Fid_traces(self, Path):
+        """
+        The fids of a file with two traces in a block (views and copies,
+        see VarianFid.Data) and their spectra are the same as with one
+        trace in a block
+        """
+        for folder, traces in (('one/', 1), ('two/', 2)):
+            SyntheticExperiment(Path + folder, 'ARRAYED', np = 256, ni = 8,
+                                arrayed = [0.01, 0.1], traces = traces)
+        one = nmr_procy.VarianFid(Path + 'one/')
+        two = nmr_procy.VarianFid(Path + 'two/')
+        if two.ntraces != 2:
+            return 'the fid has {0} traces in a block'.format(two.ntraces)
+        for shape in (None, (16, 2, 128), (32, 128), (15, 128)):
+            if not numpy.array_equal(one.Data(shape), two.Data(shape)):
+                return 'Data({0}) differs'.format(shape)
+        if not numpy.array_equal(numpy.concatenate(list(two.Stream(size = 3))),
+                                 one.Data()):
+            return 'Stream() differs'
+        if self.Process(Path + 'one/') != self.Process(Path + 'two/'):
+            return 'the spectra differ'
+        return None
+    #####################################################
+    def Nus(self, Path):
+        """
+        The IST reconstruction of a non uniformly sampled HSQC correlates
+        with the spectrum of the uniformly sampled one
+        """
+        schedule = SyntheticExperiment.Schedule(128, 48)
+        for folder, measured in (('uniform/', None), ('nus/', schedule)):
+            SyntheticExperiment(Path + folder, 'HSQC', np = 1024, ni = 128,
+                                peaks = 15, schedule = measured)
+            self.Process(Path + folder)
+        uniform = nmr_procy.NmrPipeEngine.Read_ucsf(Path + 'uniform/uniform.ucsf')[0]
+        nus = nmr_procy.NmrPipeEngine.Read_ucsf(Path + 'nus/nus.ucsf')[0]
+        if uniform.shape != nus.shape:
+            return 'the shapes differ: {0} {1}'.format(uniform.shape, nus.shape)
+        correlation = numpy.corrcoef(uniform.ravel(), nus.ravel())[0, 1]
+        if correlation < self.NUS_CORRELATION:
+            return 'the correlation is {0:.3f} < {1}'.format(correlation,
+                                                            self.NUS_CORRELATION)
+        return None
+    #####################################################
+    def Stream(self, Path):
+        """
+        The .ucsf and .dat files of a 1D series processed batch by batch
+        (Process_stream) are the same as of Process_1D of all the fids at
+        once, also if the batch size does not divide the number of fids
+        """
+        count = 37
+        SyntheticExperiment(Path, '1D', np = 1024,
+                            arrayed = list(numpy.linspace(0.01, 1.0, count)))
+        saved = Silence()
+        try:
+            converter = ScriptOnly(['noplot', 'nocache', '0.0'], Path = Path,
+                                   Temperature = 25.0)
+        finally:
+            Restore(saved)
+        fid = nmr_procy.VarianFid(Path)
+        engine = nmr_procy.NmrPipeEngine(converter.parameters)
+        spectrum = engine.Process_1D(fid.Data())
+        engine.Write_ucsf(Path + 'whole.ucsf', spectrum)
+        engine.Write_pipe(Path + 'whole.dat', spectrum)
+        whole = [open(Path + 'whole' + extension, 'rb').read()
+                 for extension in ('.ucsf', '.dat')]
+        for size in (1, 8, count, 64):
+            engine = nmr_procy.NmrPipeEngine(converter.parameters)
+            engine.Process_stream(fid.Stream(size = size), count,
+                                  Path + 'stream.ucsf', Path + 'stream.dat')
+            if [open(Path + 'stream' + extension, 'rb').read()
+                for extension in ('.ucsf', '.dat')] != whole:
+                return 'the files differ with batches of {0} fids'.format(size)
+        for name in ('whole.ucsf', 'whole.dat', 'stream.ucsf', 'stream.dat'):
+            os.remove(Path + name)
+        if self.Process(Path, ['stream']) != self.Process(Path):
+            return 'the "stream" run differs from the native run'
+        return None
+    #####################################################
+    def Lp(self, Path):
+        """
+        LP -fb extends noiseless damped (and undamped) multi exponential
+        series with their own next points
+        """
+        engine = nmr_procy.NmrPipeEngine({})
+        points = numpy.arange(96)
+        for damping in (0.05, 0.0):
+            series = sum([amplitude * numpy.exp((-damping * scale + 2j * numpy.pi * frequency) * points)
+                          for amplitude, frequency, scale in ((0.9, 0.11, 1.0),
+                                                              (0.5, -0.23, 0.4),
+                                                              (0.3, 0.37, 2.0))])
+            engine.axes = [engine.Axis('H1', 1.0, 1.0, 0.0, 32, 'Complex')]
+            data = numpy.array([series[:32], 2.0 * series[:32]]).astype(numpy.complex64)
+            predicted = engine.LP(data, order = 8, pred = 64)[:, 32:]
+            error = abs(predicted - numpy.array([series[32:], 2.0 * series[32:]])).max()
+            if error > 1e-5:
+                return 'the largest error of the predicted points is {0:.2g} (damping {1})'.format(
+                       error, damping)
+        return None
+    #####################################################
+    def Prephase(self, Path):
+        """
+        A 2D processed with the hypercomplex intermediate ("keepprephase",
+        Process_phased) and rephased from it is the same as processed again
+        with the new phase, and without LP the same as Process_2D
+        """
+        SyntheticExperiment(Path, 'HSQC', np = 512, ni = 32, peaks = 5)
+        saved = Silence()
+        try:
+            converter = ScriptOnly(['noplot', 'nocache', '0.0'], Path = Path,
+                                   Temperature = 25.0)
+        finally:
+            Restore(saved)
+        fids = nmr_procy.VarianFid(Path).Data()
+        for lp in ('#', ''):
+            parameters = dict(converter.parameters, LP = lp, Ext = '',
+                              ProtonExtraction = '-x1 9.5ppm -xn 6.5ppm -sw -round 16')
+            for p0, p1 in (('0.0', '0.0'), ('35.0', '-20.0')):
+                parameters.update(_p0x_ = p0, _p1x_ = p1)
+                kept = nmr_procy.NmrPipeEngine(parameters).Process_phased(fids, 2, Path + 'kept')
+                again = nmr_procy.NmrPipeEngine(parameters).Process_phased(fids, 2, Path + 'again')
+                for extension in ('.npy', '.json'):
+                    os.remove(Path + 'again' + extension)
+                if not numpy.array_equal(kept, again):
+                    return 'the phase {0} {1} from the intermediate differs (LP "{2}")'.format(
+                           p0, p1, lp)
+                if lp == '#':
+                    whole = nmr_procy.NmrPipeEngine(parameters).Process_2D(fids)
+                    if (whole.shape != kept.shape or
+                        abs(whole - kept).max() > 1e-4 * abs(whole).max()):
+                        return 'the phase {0} {1} differs from Process_2D'.format(p0, p1)
+            for extension in ('.npy', '.json'):
+                os.remove(Path + 'kept' + extension)
+        return None
+    #####################################################
+    def Index(self, Path):
+        """
+        ProcparIndex.Update skips a corrupt procpar (a real value "abc") and
+        indexes the other experiments of the tree
+        """
+        for name in ('a', 'b', 'c'):
+            SyntheticExperiment(os.path.join(Path, 'archive', name), '1D', np = 256)
+        corrupt = os.path.join(Path, 'archive', 'c', '')
+        text = open(corrupt + 'procpar').read()
+        open(corrupt + 'procpar', 'w').write(re.sub(r'(?m)^(temp .*\n1 ).*$', r'\1abc', text))
+        archive = nmr_procy.ProcparIndex(Path + 'index.sqlite')
+        saved = Silence()
+        try:
+            updated, removed = archive.Update(Path + 'archive', Processes = 2)
+        finally:
+            Restore(saved)
+        if updated != 2 or [directory for directory, error in archive.skipped] != [corrupt]:
+            return '{0} updated, skipped: {1}'.format(updated, archive.skipped)
+        if len(archive.Query(temp = (20.0, 30.0))) != 2:
+            return 'the valid experiments are not found'
+        return None
+################################################################################
+
+
+
+
+if __name__ == '__main__':
+    arguments = sys.argv[1:]
+    def Option(name, default):
+        if name in arguments:
+            return arguments[arguments.index(name) + 1]
+        return default
+    size = 'production' if 'production' in arguments else 'quick'
+    if arguments[:1] == ['compare'] and len(arguments) >= 3:
+        regressions = Benchmark.Compare(arguments[1], arguments[2],
+                                        float(Option('threshold', 0.1)))
+        sys.exit(1 if regressions else 0)
+    elif arguments[:1] == ['generate'] and len(arguments) >= 2:
+        for name, kind, np, ni, ni2, arrayed in Benchmark.SIZES[size]:
+            SyntheticExperiment(os.path.join(arguments[1], name), kind, np = np,
+                                ni = ni, ni2 = ni2, arrayed = arrayed)
+            print 'written ' + os.path.join(arguments[1], name)
+    elif arguments[:1] == ['check']:
+        sys.exit(1 if Check().failures else 0)
+    elif arguments[:1] == ['run'] or not arguments:
+        result = Benchmark(size, int(Option('repeat', 3)))
+        output = Option('output', 'benchmark_{0}.json'.format(
+                        result.results['environment']['commit'][:10] or 'results'))
+        result.Write(output)
+        print 'results written to ' + output
+    else:
+        print __doc__
@@ -15,89 +15,2809 @@ Requires:
 
 """
 
+import collections
+import glob
+import hashlib
+import heapq
+import itertools
+import json
+import marshal
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
+import resource
+import shlex
+import shutil
+import signal
+import socket
+import sqlite3
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import zlib
+try:
+    import numpy
+except ImportError:
+    # Only the native (in-process) processing needs numpy
+    numpy = None
+try:
+    import pyfftw.builders
+except ImportError:
+    # FFTW plans are optional, numpy.fft is used without them
+    pyfftw = None
 
 class ProcparData():
     """
     Read a varian procpar file and load the data into a variables
 
+    The file is indexed once: the offset, length and type of the value lines
+    of every parameter. The values are only decoded when they are asked
+    for. The index is saved next to the procpar (.procpar.index) and used
+    as long as the size and modification time of the procpar are the same,
+    then only the requested values are read from the file.
+
+    Example:
+
+        MyProcpar = ProcparData('data/','procpar')
+        print MyProcpar.parameter('ni')
+        print MyProcpar.value('sw')
+    """
+    # Basic types of the procpar parameters
+    REAL   = 1
+    STRING = 2
+    # Parsed files kept by Open (warm state of a long running process)
+    warm = {}
+    WARM_FILES = 64
+    #####################################################
+    def __init__(self, Path='', FileName='procpar', SaveIndex=True):
+        """
+        Parameters:
+
+        * Path      Path of the procpar file
+        * FileName  Filename of the procpar file, default = 'procpar'
+        * SaveIndex Save the index next to the procpar, False = nothing is
+                    written (read-only or shared data), default = True
+        """
+        self.FileName = Path + FileName
+        self.IndexFileName = Path + '.' + FileName + '.index'
+        # Open the procpar file
+        try:
+            status = os.stat(self.FileName)
+            File_handler = open(self.FileName, 'rb')
+        except (IOError, OSError):
+            print ''.join(('\n-----------\nError opening ', Path, FileName,
+                           '! Please check it!\n-----------\n'))
+            exit()
+        File_handler.close()
+        # Content of the file, only read if the index has to be built
+        self.__content = None
+        # Decoded values
+        self.__parameter__ = {}
+        self.__value = {}
+        self.__signature = (status.st_size, status.st_mtime)
+        self.__index = self.Load_index()
+        if self.__index is None:
+            File_handler = open(self.FileName, 'rb')
+            self.__content = File_handler.read()
+            File_handler.close()
+            self.__index = self.Build_index(self.__content)
+            if SaveIndex:
+                self.Save_index()
+        return None
+    #####################################################
+    @staticmethod
+    def Open(Path='', FileName='procpar'):
+        """
+        Returns the ProcparData of the file, reusing the already parsed
+        instance (with its decoded values) as long as the size and
+        modification time of the procpar are the same
+        """
+        try:
+            status = os.stat(Path + FileName)
+        except OSError:
+            # Reports the error
+            return ProcparData(Path, FileName)
+        key = os.path.abspath(Path + FileName)
+        signature = (status.st_size, status.st_mtime)
+        if key in ProcparData.warm and ProcparData.warm[key][0] == signature:
+            return ProcparData.warm[key][1]
+        procpar = ProcparData(Path, FileName)
+        if key not in ProcparData.warm and len(ProcparData.warm) >= ProcparData.WARM_FILES:
+            del ProcparData.warm[next(iter(ProcparData.warm))]
+        ProcparData.warm[key] = (signature, procpar)
+        return procpar
+    #####################################################
+    def Build_index(self, content):
+        """
+        Returns {name: (offset, length, basic type)} of the value lines
+
+        A parameter is a header line (name subtype basictype ... 11 words),
+        the values ('count value ...', strings one per line) and a line of
+        enumerated values.
+        """
+        index = {}
+        lines = content.split('\n')
+        offsets = [0]
+        for line in lines:
+            offsets.append(offsets[-1] + len(line) + 1)
+        i = 0
+        while i < len(lines):
+            words = lines[i].split()
+            if len(words) != 11 or not words[2].isdigit():
+                # Empty or unexpected line
+                i += 1
+                continue
+            name = words[0]
+            basictype = int(words[2])
+            i += 1
+            if i >= len(lines):
+                break
+            start = offsets[i]
+            words = lines[i].split()
+            i += 1
+            if basictype == self.STRING and words and words[0].isdigit():
+                # Every string of an array is on its own line
+                remaining = int(words[0]) - 1
+                while remaining > 0 and i < len(lines) and lines[i].startswith('"'):
+                    remaining -= 1
+                    i += 1
+            index[name] = (start, offsets[i] - 1 - start, basictype)
+            # Skip the enumerated values
+            i += 1
+        return index
+    #####################################################
+    def Load_index(self):
+        """
+        Returns the saved index if it belongs to the current procpar file,
+        otherwise None
+        """
+        try:
+            saved = marshal.load(open(self.IndexFileName, 'rb'))
+            if tuple(saved['signature']) == self.__signature:
+                return saved['index']
+        except (IOError, EOFError, ValueError, TypeError, KeyError):
+            pass
+        return None
+    #####################################################
+    def Save_index(self):
+        """
+        Save the index next to the procpar file, if the folder is writable
+        """
+        try:
+            handle, temporary = tempfile.mkstemp(
+                dir = os.path.dirname(os.path.abspath(self.IndexFileName)))
+            os.write(handle, marshal.dumps({'signature': self.__signature,
+                                            'index': self.__index}))
+            os.close(handle)
+            os.chmod(temporary, 0o644)
+            os.rename(temporary, self.IndexFileName)
+        except (IOError, OSError):
+            pass
+        return None
+    #####################################################
+    def Raw_lines(self, ParameterName):
+        """
+        Returns the value lines of a parameter as they are in the file
+        """
+        offset, length, basictype = self.__index[ParameterName]
+        if self.__content is not None:
+            text = self.__content[offset:offset + length]
+        else:
+            File_handler = open(self.FileName, 'rb')
+            File_handler.seek(offset)
+            text = File_handler.read(length)
+            File_handler.close()
+        return text.split('\n')
+    #####################################################
+    def parameter(self, ParameterName):
+        """
+        Returns the value of a parameter from the procpar file
+
+        The first element is the first value line without the number of
+        values, like: '"gNhsqc"' or '0.01 0.05 0.1', followed by the other
+        lines of a string array.
+
+        Parameters:
+
+        * ParameterName = The name of a parameter, like: ni, nt, sw2,...
+        """
+        if ParameterName in self.__parameter__:
+            returnvalue = self.__parameter__[ParameterName]
+        elif ParameterName in self.__index:
+            lines = self.Raw_lines(ParameterName)
+            first = lines[0].strip()
+            returnvalue = [first[first.index(' ') + 1:] if ' ' in first else '']
+            returnvalue.extend([line.strip() for line in lines[1:]])
+            self.__parameter__[ParameterName] = returnvalue
+        else:
+            print '\n------------\nNo parameter like "'+ParameterName+'" in the procpar file\n------------\n'
+            #exit()
+            returnvalue = None
+        return returnvalue
+    #####################################################
+    def value(self, ParameterName):
+        """
+        Returns the decoded values of a parameter: a list of floats for real
+        parameters, a list of strings (without quotes) for string parameters
+        or None if there is no such parameter
+
+        Parameters:
+
+        * ParameterName = The name of a parameter, like: ni, nt, sw2,...
+        """
+        if ParameterName not in self.__value:
+            if ParameterName not in self.__index:
+                return None
+            text = '\n'.join(self.Raw_lines(ParameterName))
+            if self.__index[ParameterName][2] == self.STRING:
+                values = [re.sub(r'\\(.)', r'\1', value) for value in
+                          re.findall(r'"((?:[^"\\]|\\.)*)"', text)]
+            else:
+                values = [float(value) for value in text.split()[1:]]
+            self.__value[ParameterName] = values
+        return self.__value[ParameterName]
+    #####################################################
+    def names(self):
+        """
+        Returns the names of all parameters in the procpar file
+        """
+        return self.__index.keys()
+################################################################################
+
+
+class VarianFid():
+    """
+    Read a varian fid file without converting it with var2pipe
+
+    The file is memory mapped, so the data points are not copied: the
+    returned arrays are views into the fid file itself (see Data() for
+    more traces in a block).
+
+    Example:
+
+        MyFid = VarianFid('data/','fid')
+        print MyFid.nblocks, MyFid.np
+        fids = MyFid.Data((2 * ni, MyFid.np / 2))
+    """
+    # Status bits of the file and block headers
+    S_DATA        = 0x1
+    S_SPEC        = 0x2
+    S_32          = 0x4
+    S_FLOAT       = 0x8
+    S_COMPLEX     = 0x10
+    S_HYPERCOMPLEX = 0x20
+    #
+    FILE_HEADER_SIZE  = 32
+    BLOCK_HEADER_SIZE = 28
+    #####################################################
+    def __init__(self, Path='', FileName='fid'):
+        """
+        Parameters:
+
+        * Path      Path of the fid file
+        * FileName  Filename of the fid file, default = 'fid'
+        """
+        if numpy is None:
+            print ('\n-----------\nThe native fid reader requires numpy! '
+                   'Please install it!\n-----------\n')
+            exit()
+        self.FileName = Path + FileName
+        try:
+            header = numpy.fromfile(self.FileName,
+                                    dtype = self.File_header_dtype(),
+                                    count = 1)
+        except IOError:
+            header = []
+        if len(header) != 1:
+            print ''.join(('\n-----------\nError opening ', Path, FileName,
+                           '! Please check it!\n-----------\n'))
+            exit()
+        header = header[0]
+        self.nblocks   = int(header['nblocks'])
+        self.ntraces   = int(header['ntraces'])
+        self.np        = int(header['np'])
+        self.ebytes    = int(header['ebytes'])
+        self.tbytes    = int(header['tbytes'])
+        self.bbytes    = int(header['bbytes'])
+        self.vers_id   = int(header['vers_id'])
+        self.status    = int(header['status'])
+        self.nbheaders = int(header['nbheaders'])
+        # The file can be shorter than the header says (running acquisition)
+        self.complete_blocks = min(self.nblocks,
+                                   (os.path.getsize(self.FileName) -
+                                    self.FILE_HEADER_SIZE) / self.bbytes)
+        self.__blocks = None
+        return None
+    #####################################################
+    def File_header_dtype(self):
+        """
+        The 32 byte big endian file header
+        """
+        return numpy.dtype([('nblocks',   '>i4'),
+                            ('ntraces',   '>i4'),
+                            ('np',        '>i4'),
+                            ('ebytes',    '>i4'),
+                            ('tbytes',    '>i4'),
+                            ('bbytes',    '>i4'),
+                            ('vers_id',   '>i2'),
+                            ('status',    '>i2'),
+                            ('nbheaders', '>i4')])
+    #####################################################
+    def Block_header_dtype(self):
+        """
+        The 28 byte big endian header in front of every block
+        """
+        return numpy.dtype([('scale',   '>i2'),
+                            ('status',  '>i2'),
+                            ('index',   '>i2'),
+                            ('mode',    '>i2'),
+                            ('ctcount', '>i4'),
+                            ('lpval',   '>f4'),
+                            ('rpval',   '>f4'),
+                            ('lvl',     '>f4'),
+                            ('tlt',     '>f4')])
+    #####################################################
+    def Point_dtype(self):
+        """
+        One complex point of the fid
+
+        Floating point data is mapped directly to a big endian complex
+        number, integer data to a (re, im) record.
+        """
+        if self.status & self.S_FLOAT:
+            return numpy.dtype('>c8')
+        if self.status & self.S_32:
+            return numpy.dtype([('re', '>i4'), ('im', '>i4')])
+        return numpy.dtype([('re', '>i2'), ('im', '>i2')])
+    #####################################################
+    def Blocks(self):
+        """
+        Returns the memory mapped blocks (block headers + data) of the file
+        """
+        if self.__blocks is None:
+            if self.bbytes != (self.ntraces * self.tbytes +
+                               self.nbheaders * self.BLOCK_HEADER_SIZE):
+                print ''.join(('\n-----------\nInconsistent block size in ',
+                               self.FileName, '!\n-----------\n'))
+                exit()
+            block_dtype = numpy.dtype([('head', self.Block_header_dtype(),
+                                                (self.nbheaders,)),
+                                       ('data', self.Point_dtype(),
+                                                (self.ntraces, self.np / 2))])
+            self.__blocks = numpy.memmap(self.FileName,
+                                         dtype  = block_dtype,
+                                         mode   = 'r',
+                                         offset = self.FILE_HEADER_SIZE,
+                                         shape  = (self.complete_blocks,))
+        return self.__blocks
+    #####################################################
+    def Stream(self, size = 256, count = None):
+        """
+        Yields the complex points of the fids, size fids at a time
+
+        The file is read block by block (block headers and data) instead of
+        mapping it, so only one batch of fids is in memory at any time.
+
+        Parameters:
+        ===========
+            * size = number of fids of a batch (whole blocks, at least one)
+            * count = only the first count fids, None = every complete block
+        """
+        if count is None:
+            count = self.complete_blocks * self.ntraces
+        self.Blocks()
+        block_dtype = numpy.dtype([('head', self.Block_header_dtype(), (self.nbheaders,)),
+                                   ('data', self.Point_dtype(), (self.ntraces, self.np / 2))])
+        blocks = max(size / self.ntraces, 1)
+        source = open(self.FileName, 'rb')
+        try:
+            source.seek(self.FILE_HEADER_SIZE)
+            while count > 0:
+                batch = numpy.fromfile(source, dtype = block_dtype,
+                                       count = min(blocks, (count + self.ntraces - 1) / self.ntraces))
+                if not len(batch):
+                    break
+                data = batch['data'].reshape((-1, self.np / 2))[:count]
+                count -= len(data)
+                yield data
+        finally:
+            source.close()
+    #####################################################
+    def Block_headers(self):
+        """
+        Returns the block headers, shape = (blocks, nbheaders)
+        """
+        return self.Blocks()['head']
+    #####################################################
+    def Data(self, Shape = None):
+        """
+        Returns the complex points as a view into the file
+
+        With more traces in a block the block headers are between the
+        traces of two blocks, then only a shape keeping the traces of a
+        block together (like (2 * ni, ntraces, np / 2)) is a view, any
+        other shape is a copy.
+
+        Parameters:
+
+        * Shape = The requested shape, the last value must be np / 2, like:
+                  (2 * ni, np / 2) or (2 * ni, arraydim, np / 2). The
+                  default is (blocks * ntraces, np / 2). If the shape has
+                  less fids than the file, the first fids are returned.
+        """
+        if not Shape:
+            Shape = (self.complete_blocks * self.ntraces, self.np / 2)
+        fids = reduce(lambda a, b: a * b, Shape[:-1])
+        # Shape = (blocks, ntraces, np / 2)
+        blocks = self.Blocks()['data'][:(fids + self.ntraces - 1) / self.ntraces]
+        if fids == len(blocks) * self.ntraces:
+            data = blocks.view()
+            try:
+                # Setting the shape raises an error instead of copying the data
+                data.shape = Shape
+                return data
+            except AttributeError:
+                pass
+        return blocks.reshape((-1, self.np / 2))[:fids].reshape(Shape)
+    #####################################################
+    def Complex(self, data):
+        """
+        Returns a native complex copy of (a slice of) the Data() view
+        """
+        if data.dtype.names:
+            result = numpy.empty(data.shape, dtype = numpy.complex64)
+            result.real = data['re']
+            result.imag = data['im']
+            return result
+        return data.astype(numpy.complex64)
+################################################################################
+
+
+class VectorCache():
+    """
+    Size bounded, least recently used cache of the apodization windows,
+    phase ramps and FFT plans of the native processing
+
+    The same window, ramp and FFT size is used for every trace of every
+    plane and every experiment with the same acquisition size, they are
+    computed once per process. The key is (kind, length, parameters).
+
+    Example:
+
+        Cache = VectorCache()
+        window = Cache.Get(('SP', 1024, 0.35, 0.95, 2, 1.0), Sine_bell_function)
+    """
+    MaxSize = 64 * 1024 ** 2
+    #####################################################
+    def __init__(self, MaxSize = None):
+        """
+        Parameters:
+
+        * MaxSize = Size limit in bytes, default = 64 MB
+        """
+        if MaxSize:
+            self.MaxSize = MaxSize
+        # key: (value, size in bytes), the last used is the last one
+        self.items = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        return None
+    #####################################################
+    def Get(self, key, function, *arguments):
+        """
+        Returns the cached value of key, function(*arguments) is called and
+        its value is cached if it is not there
+        """
+        if key in self.items:
+            self.hits += 1
+            value, size = self.items.pop(key)
+            self.items[key] = (value, size)
+            return value
+        self.misses += 1
+        value = function(*arguments)
+        size = getattr(value, 'nbytes', 0)
+        if size <= self.MaxSize:
+            self.items[key] = (value, size)
+            self.size += size
+            while self.size > self.MaxSize:
+                self.size -= self.items.popitem(last = False)[1][1]
+        return value
+    #####################################################
+    def Counters(self, since = (0, 0)):
+        """
+        Returns the (hits, misses) of Get() after since, an earlier value
+        """
+        return self.hits - since[0], self.misses - since[1]
+    #####################################################
+    def Clear(self):
+        self.items.clear()
+        self.size = 0
+        return None
+################################################################################
+
+
+class NmrPipeEngine():
+    """
+    In-process numpy version of the nmrPipe function chain of the scripts
+
+    Every function works on the last axis of the data, all the other axes
+    (traces, planes) are processed at once. The parameters are the same
+    dictionary that Convert_HSQC.CreateConverFile builds for the scripts.
+
+    Example:
+
+        Engine = NmrPipeEngine(parameters)
+        spectrum = Engine.Process_2D(fids)
+        Engine.Write_pipe('test.dat', spectrum)
+    """
+    # Positions in the 512 value nmrPipe header
+    FDMAGIC      = 0
+    FDFLTFORMAT  = 1
+    FDFLTORDER   = 2
+    FDDIMCOUNT   = 9
+    FDF3OBS      = 10
+    FDF3SW       = 11
+    FDF3ORIG     = 12
+    FDF3FTFLAG   = 13
+    FDF3SIZE     = 15
+    FDF2LABEL    = 16
+    FDF1LABEL    = 18
+    FDF3LABEL    = 20
+    FDDIMORDER   = 24
+    FDF3APOD     = 50
+    FDF3QUADFLAG = 51
+    FDF1QUADFLAG = 55
+    FDF2QUADFLAG = 56
+    FDPIPEFLAG   = 57
+    FDF2CAR      = 66
+    FDF1CAR      = 67
+    FDF3CAR      = 68
+    FDF2CENTER   = 79
+    FDF1CENTER   = 80
+    FDF3CENTER   = 81
+    FDF2APOD     = 95
+    FDF2FTSIZE   = 96
+    FDREALSIZE   = 97
+    FDF1FTSIZE   = 98
+    FDSIZE       = 99
+    FDF2SW       = 100
+    FDF2ORIG     = 101
+    FDQUADFLAG   = 106
+    FDF2OBS      = 119
+    FDF1OBS      = 218
+    FDSPECNUM    = 219
+    FDF2FTFLAG   = 220
+    FDTRANSPOSED = 221
+    FDF1FTFLAG   = 222
+    FDF1SW       = 229
+    FDF1ORIG     = 249
+    FD2DPHASE    = 256
+    FDF3FTSIZE   = 200
+    FDF2TDSIZE   = 386
+    FDF1TDSIZE   = 387
+    FDF3TDSIZE   = 388
+    FDF1APOD     = 428
+    FDFILECOUNT  = 442
+    # Windows, phase ramps and FFT plans shared by every engine
+    vectors = VectorCache()
+    #####################################################
+    def __init__(self, parameters):
+        """
+        Parameters:
+
+        * parameters = The dictionary used to fill in the processing scripts
+        """
+        if numpy is None:
+            print ('\n-----------\nThe native processing requires numpy! '
+                   'Please install it!\n-----------\n')
+            exit()
+        self.parameters = parameters
+        # Description of the dimensions, the first one is the current 'x'
+        self.axes = []
+        return None
+    #####################################################
+    def Active(self, key):
+        """
+        True if the optional script line (Ext, LP, Rev) is not commented out
+        """
+        return self.parameters[key] != '#'
+    #####################################################
+    def Axis(self, label, sw, obs, car, tdsize, quad):
+        """
+        Returns the description of one dimension
+        """
+        return {'label'  : label.strip().strip('"'),
+                'sw'     : float(sw),
+                'obs'    : float(obs),
+                'car'    : float(car),
+                'tdsize' : int(tdsize),
+                'ftsize' : 0,
+                'x1'     : 0,
+                'ft'     : False,
+                'quad'   : quad}
+    #####################################################
+    def Load(self, fids, dimensions):
+        """
+        Returns a complex copy of the fids and sets up the dimensions
+
+        Parameters:
+        ===========
+            * fids = complex or (re, im) record array, like VarianFid.Data()
+            * dimensions = 1, 2 or 3 (3D fids are (ni2, ni, 2, 2, np / 2)
+                           and become (2 * ni2, 2 * ni, np / 2))
+        """
+        p = self.parameters
+        if fids.dtype.names:
+            data = numpy.empty(fids.shape, dtype = numpy.complex64)
+            data.real = fids['re']
+            data.imag = fids['im']
+        else:
+            data = fids.astype(numpy.complex64)
+        if dimensions == 3:
+            # (t2, t1, phase, phase2) or (t2, t1, phase2, phase) =>
+            # (t2, phase2, t1, phase)
+            if p['_aqORD_'] == '0':
+                data = data.transpose(0, 3, 1, 2, 4)
+            else:
+                data = data.transpose(0, 2, 1, 3, 4)
+            data = data.reshape((2 * data.shape[0], 2 * data.shape[2], data.shape[4]))
+        self.axes = [self.Axis(p['_xlab__'], p['_sw____'], p['_xobs__'],
+                               p['_XCAR__'], data.shape[-1], 'Complex')]
+        if dimensions >= 2:
+            self.axes.append(self.Axis(p['_ylab__'], p['_sw2___'], p['_yobs__'],
+                                       p['_yCAR__'], data.shape[-2] / 2, 'States'))
+            if p['_yMODE_'] == 'Rance-Kay':
+                self.Rance_Kay(data, -2)
+        if dimensions == 3:
+            self.axes.append(self.Axis(p['_zlab__'], p['_sw3___'], p['_zobs__'],
+                                       p['_zCAR__'], data.shape[-3] / 2, 'States'))
+            if p['_zMODE_'] == 'Rance-Kay':
+                self.Rance_Kay(data, -3)
+        return data
+    #####################################################
+    def Rance_Kay(self, data, axis):
+        """
+        Echo / anti-echo pairs => cosine / sine modulated pairs along axis,
+        in place
+        """
+        index = [slice(None)] * data.ndim
+        index[axis] = slice(0, None, 2)
+        echo = data[tuple(index)].copy()
+        index[axis] = slice(1, None, 2)
+        antiecho = data[tuple(index)]
+        index[axis] = slice(0, None, 2)
+        data[tuple(index)] = echo + antiecho
+        index[axis] = slice(1, None, 2)
+        data[tuple(index)] = -1j * (echo - antiecho)
+        return None
+    #####################################################
+    def Chain_1D(self):
+        """
+        The functions of script_for_regular_1D as (function, arguments)
+        """
+        p = self.parameters
+        chain = [(self.POLY_time, {}),
+                 (self.SP, {'off': 0.35, 'end': 0.95, 'pow': 2, 'c': 0.5}),
+                 (self.ZF, {'zf': 2}),
+                 (self.FT, {}),
+                 (self.PS, {'p0': float(p['_p0x_']), 'p1': float(p['_p1x_'])})]
+        if self.Active('Ext'):
+            chain.append((self.EXT, {'options': p['ProtonExtraction']}))
+        chain.append((self.POLY_auto, {}))
+        return chain
+    #####################################################
+    def Chain_2D(self):
+        """
+        The functions of script_for_regular_2D as (function, arguments)
+        """
+        p = self.parameters
+        chain = [(self.POLY_time, {}),
+                 (self.SP, {'off': 0.35, 'end': 0.95, 'pow': 2, 'c': 0.5}),
+                 (self.ZF, {'zf': 2}),
+                 (self.FT, {}),
+                 (self.PS, {'p0': float(p['_p0x_']), 'p1': float(p['_p1x_'])})]
+        if self.Active('Ext'):
+            chain.append((self.EXT, {'options': p['ProtonExtraction']}))
+        chain.append((self.TP, {}))
+        if p.get('NUSschedule'):
+            chain.append((self.IST, {'schedule': [int(index) for index in
+                                                  p['NUSschedule'].split()],
+                                     'size': int(p['NUSsize'])}))
+        if self.Active('LP'):
+            chain.append((self.LP, self.LP_arguments()))
+        chain.extend([(self.SP, {'off': 0.35, 'end': 1.0, 'pow': 2,
+                                 'c': float(p['_c_'])}),
+                      (self.ZF, {'zf': 2}),
+                      (self.FT, {}),
+                      (self.PS, {'p0': float(p['_p0y_']),
+                                 'p1': float(p['_p1y_'])})])
+        if self.Active('Rev'):
+            chain.append((self.REV, {}))
+        chain.extend([(self.TP, {}),
+                      (self.POLY_auto, {})])
+        return chain
+    #####################################################
+    def Chain_3D(self):
+        """
+        The functions of script_for_regular_3D as three chains: the x
+        (direct) dimension, the y dimension (TP ... TP) and the z dimension
+        (TP ... TP, applied to the z vectors as rows)
+        """
+        p = self.parameters
+        chain_2D = self.Chain_2D()
+        functions = [function for function, arguments in chain_2D]
+        chain_x = chain_2D[:functions.index(self.TP)]
+        chains = []
+        for c, p0, p1 in (('_c_', '_p0y_', '_p1y_'), ('_cz_', '_p0z_', '_p1z_')):
+            chain = [(self.TP, {})]
+            if self.Active('LP'):
+                chain.append((self.LP, self.LP_arguments()))
+            chain.extend([(self.SP, {'off': 0.35, 'end': 1.0, 'pow': 2,
+                                     'c': float(p[c])}),
+                          (self.ZF, {'zf': 2}),
+                          (self.FT, {}),
+                          (self.PS, {'p0': float(p[p0]), 'p1': float(p[p1])})])
+            chains.append(chain)
+        if self.Active('Rev'):
+            chains[1].append((self.REV, {}))
+        return chain_x, chains[0] + [(self.TP, {})], chains[1] + [(self.TP, {})]
+    #####################################################
+    def Run(self, data, chain):
+        """
+        Apply the functions of a chain one after the other
+        """
+        for function, arguments in chain:
+            data = function(data, **arguments)
+        return data
+    #####################################################
+    def Process_1D(self, fids):
+        """
+        Process fids, shape = (..., np / 2), like script_for_regular_1D
+        """
+        return self.Run(self.Load(fids, 1), self.Chain_1D())
+    #####################################################
+    def Process_2D(self, fids):
+        """
+        Process fids, shape = (..., 2 * ni, np / 2), like
+        script_for_regular_2D. Leading axes (planes of a pseudo 3D) are
+        processed together.
+        """
+        return self.Run(self.Load(fids, 2), self.Chain_2D())
+    #####################################################
+    def Run_blocks(self, source, FileName, chain, memory, axis = 0, load = None):
+        """
+        Apply a chain to blocks of source along axis, the results are
+        written into a memory mapped .npy file, which is returned
+
+        Only one block is in the memory at a time, its size is set by
+        memory. Blocks along the last axis are (rows x block) tiles of the
+        source, so the vectors of the first axis are read without a
+        transposed copy of the whole data.
+
+        Parameters:
+        ===========
+            * source = (memory mapped) array
+            * FileName = name of the result .npy file
+            * chain = the functions, like Chain_3D()
+            * memory = approximate working memory in bytes
+            * axis = the source (and result) is cut along this axis
+            * load = function making the data of a block, default = copy
+        """
+        # Zero filling, linear prediction and the complex128 temporaries
+        values = source.size / source.shape[axis]
+        block = max(1, memory / (64 * values))
+        axes = [dict(description) for description in self.axes]
+        result = None
+        position = 0
+        for first in range(0, source.shape[axis], block):
+            # Every block starts from the same description of the dimensions
+            self.axes = [dict(description) for description in axes]
+            index = [slice(None)] * source.ndim
+            index[axis] = slice(first, first + block)
+            if load:
+                data = load(source[tuple(index)])
+            else:
+                data = numpy.array(source[tuple(index)])
+            data = self.Run(data, chain)
+            if result is None:
+                shape = list(data.shape)
+                shape[axis] = (data.shape[axis] * source.shape[axis] /
+                               min(block, source.shape[axis]))
+                result = numpy.lib.format.open_memmap(FileName, mode = 'w+',
+                                                      dtype = data.dtype,
+                                                      shape = tuple(shape))
+            index = [slice(None)] * result.ndim
+            index[axis] = slice(position, position + data.shape[axis])
+            result[tuple(index)] = data
+            position += data.shape[axis]
+        result.flush()
+        return result
+    #####################################################
+    def Process_3D(self, fids, Folder, memory = 256 * 1024 ** 2):
+        """
+        Process fids, shape = (ni2, ni, 2, 2, np / 2), like
+        script_for_regular_3D, out of core
+
+        The x dimension is processed in blocks of t2 increments, the y
+        dimension in blocks of planes, the results are memory mapped .npy
+        files in Folder. The ZTP reads (2 * ni2 x block) tiles of the
+        planes, so the peak memory is set by memory and not by the size of
+        the data. Returns the memory mapped spectrum, shape = (z, y, x).
+
+        Parameters:
+        ===========
+            * fids = like VarianFid.Data()
+            * Folder = folder of the work files (ends with '/')
+            * memory = approximate working memory in bytes
+        """
+        chain_x, chain_y, chain_z = self.Chain_3D()
+        planes = self.Run_blocks(fids, Folder + 'x.npy', chain_x, memory,
+                                 load = lambda block: self.Load(block, 3))
+        planes = self.Run_blocks(planes, Folder + 'xy.npy', chain_y, memory)
+        os.remove(Folder + 'x.npy')
+        # ZTP: the z vectors are the columns of the (z, y * x) planes
+        shape = planes.shape
+        x, y, z = self.axes
+        self.axes = [x, z]
+        spectrum = self.Run_blocks(planes.reshape((shape[0], -1)), Folder + 'xyz.npy',
+                                   chain_z, memory, axis = 1)
+        os.remove(Folder + 'xy.npy')
+        self.axes = [self.axes[0], y, self.axes[1]]
+        return spectrum.reshape((spectrum.shape[0],) + shape[1:])
+    #####################################################
+    def Process_stream(self, batches, count, FileName, PipeFileName = None):
+        """
+        Process a long series of 1D fids (arrayed 1D, like DOSY or a
+        titration) batch by batch and write the spectra as they come, the
+        memory does not depend on the number of fids
+
+        The spectra are the same as Process_1D() makes of all the fids
+        at once.
+
+        Parameters:
+        ===========
+            * batches = generator of (fids, np / 2) arrays, like
+                        VarianFid.Stream()
+            * count = number of all the fids
+            * FileName = the .ucsf result
+            * PipeFileName = the .dat result, None = not written
+        """
+        spectra = (self.Process_1D(fids) for fids in batches)
+        # The size of the spectra is known after the first batch
+        first = next(spectra)
+        shape = (count, first.shape[-1])
+        pipe = None
+        if PipeFileName:
+            pipe = open(PipeFileName, 'wb')
+            self.Pipe_header(shape).tofile(pipe)
+        def Written(spectra):
+            for spectrum in spectra:
+                if pipe:
+                    spectrum.astype(numpy.float32).tofile(pipe)
+                yield spectrum
+        try:
+            self.Write_ucsf_rows(FileName, shape, Written(itertools.chain([first], spectra)))
+        finally:
+            if pipe:
+                pipe.close()
+        return shape
+    #####################################################
+    def Chain_prephase(self, dimensions):
+        """
+        The 1D or 2D chain in two parts: (the phase independent functions,
+        the direct dimension PS and what follows it), see Prephase()
+
+        The 1D chain is cut at the PS. In 2D the x PS moves behind the y
+        dimension, the real and the imaginary x parts go through the y
+        functions as hypercomplex data (see TP) and the second part is only
+        the x PS and the POLY -auto.
+        """
+        chain = self.Chain_1D() if dimensions == 1 else self.Chain_2D()
+        functions = [function for function, arguments in chain]
+        cut = functions.index(self.PS)
+        if dimensions == 1:
+            return chain[:cut], chain[cut:]
+        return chain[:cut] + chain[cut + 1:-1], [chain[cut], chain[-1]]
+    #####################################################
+    def Prephase(self, fids, dimensions):
+        """
+        Returns the spectrum before the direct dimension phase correction:
+        the complex x dimension after the FT (1D) or after the whole y
+        dimension (2D), see Phase()
+        """
+        return self.Run(self.Load(fids, dimensions),
+                        self.Chain_prephase(dimensions)[0])
+    #####################################################
+    def Phase(self, prephase, dimensions):
+        """
+        The rest of the chain (PS -p0 <_p0x_> -p1 <_p1x_> -di, ..., POLY
+        -auto) on the result of Prephase(), together they are the same
+        functions as Process_1D() or Process_2D()
+
+        The phase of a 2D prephase is a linear combination of its real and
+        imaginary x parts, the same as phasing before the y dimension as
+        long as the y functions are linear. LP and IST are fitted on the two
+        parts separately, their result can differ from Process_2D() within
+        the noise.
+        """
+        return self.Run(prephase, self.Chain_prephase(dimensions)[1])
+    #####################################################
+    def Autophase(self, fids, dimensions, p1_range = 45.0, penalty = 100.0):
+        """
+        Returns the automatic direct dimension phase correction (p0, p1)
+
+        Only the first fid (first increment) is processed up to the phase
+        correction. The phase minimizes the entropy of the derivative of the
+        real spectrum plus a penalty on negative intensities (ACME, Chen et
+        al. J Magn Reson 2002;158:164-8). Every candidate of a grid is
+        scored at once, the grid is refined around the best one.
+
+        Parameters:
+        ===========
+            * fids = like Process_1D() or Process_2D()
+            * dimensions = 1 or 2
+            * p1_range = p1 is searched within +/- p1_range degrees, 0 = p0 only
+            * penalty = weight of the negative intensities
+        """
+        if dimensions == 2:
+            # The first cosine and sine fids of the first plane
+            first = fids[0:2]
+            if first.ndim == 3:
+                first = first[:, 0, :]
+            data = self.Load(first, 2)[0:1]
+            self.axes = self.axes[:1]
+        else:
+            data = self.Load(fids.reshape((-1,) + fids.shape[-1:])[0:1], 1)
+        # The 1D functions before the PS and the extraction
+        prephase, phase = self.Chain_prephase(1)
+        chain = prephase + [(function, arguments) for function, arguments in phase
+                            if function == self.EXT]
+        spectrum = self.Run(data, chain)[0].astype(numpy.complex128)
+        spectrum /= max(abs(spectrum).max(), 1e-30)
+        axis = self.axes[0]
+        points = (axis['x1'] + numpy.arange(spectrum.size)) / float(axis['ftsize'])
+        #
+        def Best(p0_values, p1_values):
+            p0, p1 = [values.ravel() for values in numpy.meshgrid(p0_values, p1_values)]
+            phase = numpy.radians(p0[:, numpy.newaxis] + p1[:, numpy.newaxis] * points)
+            real = (spectrum * numpy.exp(1j * phase)).real
+            derivative = abs(numpy.diff(real, axis = 1)) + 1e-30
+            derivative /= derivative.sum(axis = 1)[:, numpy.newaxis]
+            entropy = -(derivative * numpy.log(derivative)).sum(axis = 1)
+            negative = numpy.minimum(real, 0.0)
+            score = entropy + penalty * (negative ** 2).sum(axis = 1)
+            return p0[score.argmin()], p1[score.argmin()]
+        #
+        p1_step = p1_range / 3.0
+        best = Best(numpy.arange(0.0, 360.0, 5.0),
+                    numpy.linspace(-p1_range, p1_range, 7))
+        for step in (1.0, 0.2):
+            p1_step /= 5.0
+            best = Best(best[0] + numpy.arange(-5, 6) * step,
+                        best[1] + numpy.arange(-5, 6) * p1_step)
+        return best[0] % 360.0, best[1]
+    #####################################################
+    def Process_phased(self, fids, dimensions, Intermediate = None, signature = ''):
+        """
+        Process fids like Process_1D() or Process_2D()
+
+        If Intermediate is given (opt-in, the "keepprephase" flag), the
+        functions run in two parts, see Chain_prephase(), and the phase
+        independent part is kept as a memory mapped <Intermediate>.npy
+        file: the 1D spectrum or the hypercomplex 2D spectrum before the x
+        phase correction. A new run that changes only _p0x_/_p1x_ continues
+        from it with the PS and the POLY -auto. The 2D intermediate carries
+        both x parts through the y dimension, which doubles its cost, so
+        it is not made without Intermediate.
+
+        Parameters:
+        ===========
+            * fids = like Process_1D() or Process_2D()
+            * dimensions = 1 or 2
+            * Intermediate = file name without extension, None = not kept
+            * signature = describes the fid file (size, modification time)
+        """
+        if not Intermediate:
+            if dimensions == 1:
+                return self.Process_1D(fids)
+            return self.Process_2D(fids)
+        phases = ('_p0x_', '_p1x_')
+        key = hashlib.sha1(repr((signature, fids.shape, dimensions,
+                                 sorted([item for item in self.parameters.items()
+                                         if item[0] not in phases])))).hexdigest()
+        prephase = self.Load_prephase(Intermediate, key)
+        if prephase is None:
+            prephase = self.Prephase(fids, dimensions)
+            self.Save_prephase(Intermediate, key, prephase)
+        return self.Phase(prephase, dimensions)
+    #####################################################
+    def Save_prephase(self, Intermediate, key, prephase):
+        """
+        Write the result of Prephase() and the dimensions next to it
+        """
+        kept = numpy.lib.format.open_memmap(Intermediate + '.npy', mode = 'w+',
+                                            dtype = prephase.dtype,
+                                            shape = prephase.shape)
+        kept[...] = prephase
+        kept.flush()
+        del kept
+        # The description is written last, it marks a complete intermediate
+        json.dump({'key': key, 'axes': self.axes}, open(Intermediate + '.json', 'w'))
+        return None
+    #####################################################
+    def Load_prephase(self, Intermediate, key):
+        """
+        Returns the memory mapped intermediate if it was made with key,
+        otherwise None
+        """
+        try:
+            description = json.load(open(Intermediate + '.json'))
+            if description['key'] != key:
+                return None
+            prephase = numpy.load(Intermediate + '.npy', mmap_mode = 'r')
+        except (IOError, ValueError, KeyError):
+            return None
+        self.axes = []
+        for axis in description['axes']:
+            self.axes.append(dict([(str(name), str(value) if name == 'label' else value)
+                                   for name, value in axis.items()]))
+        return prephase
+    #####################################################
+    def POLY_time(self, data, order = 4):
+        """
+        POLY -time: subtract a polynomial fitted to the time domain data
+        (solvent suppression)
+        """
+        size = data.shape[-1]
+        vander = numpy.vander(numpy.linspace(-1.0, 1.0, size), order + 1)
+        coefficients = numpy.dot(data, numpy.linalg.pinv(vander).T)
+        data -= numpy.dot(coefficients, vander.T).astype(data.dtype)
+        return data
+    #####################################################
+    def SP(self, data, off = 0.0, end = 1.0, pow = 1, c = 1.0):
+        """
+        SP: sine bell apodization, the first point is scaled by c
+        """
+        size = data.shape[-1]
+        data *= self.vectors.Get(('SP', size, off, end, pow, c),
+                                 self.Sine_bell, size, off, end, pow, c)
+        self.axes[0]['tdsize'] = size
+        return data
+    #####################################################
+    def Sine_bell(self, size, off, end, pow, c):
+        """
+        Returns the window of SP
+        """
+        window = numpy.sin(numpy.pi * off + numpy.pi * (end - off) *
+                           numpy.arange(size) / max(size - 1, 1)) ** pow
+        window[0] *= c
+        return window.astype(numpy.float32)
+    #####################################################
+    def ZF(self, data, zf = 1, auto = True):
+        """
+        ZF -zf <zf> -auto: double the size zf times and round it up to a
+        power of 2
+        """
+        size = data.shape[-1] * 2 ** zf
+        if auto:
+            size = 2 ** int(numpy.ceil(numpy.log2(size)))
+        result = numpy.zeros(data.shape[:-1] + (size,), dtype = data.dtype)
+        result[..., :data.shape[-1]] = data
+        return result
+    #####################################################
+    def FT(self, data):
+        """
+        FT: complex Fourier transform with the nmrPipe sign convention
+        """
+        size = data.shape[-1]
+        if pyfftw:
+            plan = self.vectors.Get(('FFT', data.shape, data.dtype.str),
+                                    self.Fft_plan, data.shape, data.dtype)
+            data = numpy.fft.fftshift(plan(data), axes = -1)
+        else:
+            data = numpy.fft.fftshift(numpy.fft.ifft(data, axis = -1), axes = -1)
+        data *= size
+        self.axes[0]['ft'] = True
+        self.axes[0]['ftsize'] = size
+        self.axes[0]['x1'] = 0
+        return data.astype(numpy.complex64)
+    #####################################################
+    def PS(self, data, p0 = 0.0, p1 = 0.0, di = True):
+        """
+        PS -p0 <p0> -p1 <p1> -di: phase correction in degrees, deleting the
+        imaginaries if di
+
+        The ramp is the one of the whole transformed dimension, also after
+        an EXT (see Phase()).
+        """
+        axis = self.axes[0]
+        data = data * self.Ramp(data.shape[-1], p0, p1, axis['x1'],
+                                axis['ftsize'] or data.shape[-1])
+        if di:
+            data = numpy.ascontiguousarray(data.real)
+        return data
+    #####################################################
+    def Fft_plan(self, shape, dtype):
+        """
+        Returns the FFTW plan of FT (inverse transform along the last axis)
+
+        A worker of a pool uses one thread, the pool already uses the cores.
+        """
+        if multiprocessing.current_process().daemon:
+            threads = 1
+        else:
+            threads = multiprocessing.cpu_count()
+        plan = pyfftw.builders.ifft(numpy.empty(shape, dtype), axis = -1,
+                                    threads = threads)
+        # Counted by VectorCache like an array
+        plan.nbytes = plan.input_array.nbytes + plan.output_array.nbytes
+        return plan
+    #####################################################
+    def Ramp(self, size, p0, p1, x1 = 0, ftsize = None):
+        """
+        Returns the phase correction vector of PS (in degrees) of size
+        points starting at point x1 of the ftsize points spectrum
+        """
+        return self.vectors.Get(('PS', size, p0, p1, x1, ftsize or size),
+                                self.Phase_ramp, size, p0, p1, x1, ftsize or size)
+    #####################################################
+    def Phase_ramp(self, size, p0, p1, x1, ftsize):
+        points = (x1 + numpy.arange(size)) / float(ftsize)
+        return numpy.exp(1j * numpy.radians(p0 + p1 * points)).astype(numpy.complex64)
+    #####################################################
+    def PPM_to_point(self, ppm, size):
+        """
+        Returns the (fractional) point index of a ppm value in the current x
+        """
+        axis = self.axes[0]
+        return (axis['car'] - ppm) * size * axis['obs'] / axis['sw'] + size / 2
+    #####################################################
+    def EXT(self, data, options = '-left -sw'):
+        """
+        EXT: extract a region of the spectrum, options like the script:
+        '-left -sw' or '-x1 10.0ppm -xn 6.0ppm -sw -round 16'
+        """
+        size = data.shape[-1]
+        words = options.split()
+        if '-left' in words:
+            first, last = 0, size / 2
+        elif '-right' in words:
+            first, last = size / 2, size
+        else:
+            first = int(round(self.PPM_to_point(
+                        float(words[words.index('-x1') + 1].replace('ppm', '')), size)))
+            last = int(round(self.PPM_to_point(
+                        float(words[words.index('-xn') + 1].replace('ppm', '')), size))) + 1
+            first, last = max(min(first, last - 1), 0), min(max(first + 1, last), size)
+            if '-round' in words:
+                rounding = int(words[words.index('-round') + 1])
+                length = ((last - first + rounding - 1) / rounding) * rounding
+                last = min(first + length, size)
+                first = max(last - length, 0)
+        if '-sw' in words:
+            axis = self.axes[0]
+            length = last - first
+            axis['car'] = (axis['car'] + axis['sw'] / axis['obs'] *
+                           (size / 2 - first - length / 2) / float(size))
+            axis['sw'] = axis['sw'] * length / float(size)
+        # Position in the transformed data, needed for a later phase ramp
+        self.axes[0]['x1'] += first
+        return numpy.ascontiguousarray(data[..., first:last])
+    #####################################################
+    def TP(self, data):
+        """
+        TP: 2D transpose, interleaved States rows become complex vectors
+
+        If the x dimension is still complex (phase not applied yet) the real
+        and imaginary x parts give two y vectors, stacked on a new first
+        axis. The transpose back combines them into complex x data again.
+        """
+        if self.axes[1]['quad'] == 'States':
+            shape = data.shape[:-2] + (data.shape[-2] / 2, 2, data.shape[-1])
+            pairs = data.reshape(shape)
+            if numpy.iscomplexobj(pairs):
+                pairs = numpy.array([pairs.real, pairs.imag])
+                self.axes[0]['quad'] = 'Hypercomplex'
+            data = numpy.empty(pairs.shape[:-2] + (shape[-1],), dtype = numpy.complex64)
+            data.real = pairs[..., 0, :]
+            data.imag = pairs[..., 1, :]
+            self.axes[1]['quad'] = 'Complex'
+        elif self.axes[1]['quad'] == 'Hypercomplex' and not numpy.iscomplexobj(data):
+            combined = numpy.empty(data.shape[1:], dtype = numpy.complex64)
+            combined.real = data[0]
+            combined.imag = data[1]
+            data = combined
+            self.axes[1]['quad'] = 'Complex'
+        self.axes[0], self.axes[1] = self.axes[1], self.axes[0]
+        return numpy.ascontiguousarray(numpy.swapaxes(data, -1, -2))
+    #####################################################
+    def LP_arguments(self):
+        """
+        Returns the LP order and prediction length from 'LPoptions'
+        """
+        words = self.parameters.get('LPoptions', '').split()
+        arguments = {}
+        for option, name in (('-ord', 'order'), ('-pred', 'pred')):
+            if option in words:
+                arguments[name] = int(words[words.index(option) + 1])
+        return arguments
+    #####################################################
+    def LP(self, data, order = 8, pred = None, chunk = None):
+        """
+        LP -fb: forward-backward linear prediction, extending the data by
+        pred points (default: doubling the size)
+
+        The forward and the backward coefficients are fitted separately,
+        each as one batch of normal equations for all traces, and the two
+        predictions are averaged, see LP_chunk(). The traces are cut into
+        chunks of chunk traces (default: about 2 ** 18 points, at least one
+        chunk per core) that run on parallel threads.
+        """
+        size = data.shape[-1]
+        if not pred:
+            pred = size
+        order = min(order, size / 2)
+        traces = data.reshape(-1, size)
+        if not chunk:
+            cores = multiprocessing.cpu_count()
+            chunk = max(1, min(2 ** 18 / size, (traces.shape[0] + cores - 1) / cores))
+        result = numpy.zeros((traces.shape[0], size + pred), dtype = data.dtype)
+        result[:, :size] = traces
+        chunks = [(start, min(start + chunk, traces.shape[0]))
+                  for start in range(0, traces.shape[0], chunk)]
+        if len(chunks) > 1 and not multiprocessing.current_process().daemon:
+            pool = multiprocessing.pool.ThreadPool(min(len(chunks),
+                                                       multiprocessing.cpu_count()))
+            try:
+                pool.map(lambda limits: self.LP_chunk(result[limits[0]:limits[1]],
+                                                      size, order), chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for first, last in chunks:
+                self.LP_chunk(result[first:last], size, order)
+        self.axes[0]['tdsize'] = size + pred
+        return result.reshape(data.shape[:-1] + (size + pred,))
+    #####################################################
+    def LP_chunk(self, traces, size, order):
+        """
+        Predict traces[:, size:] in place from traces[:, :size]
+
+        Like nmrPipe LP -fb the forward and the backward predictions are
+        averaged. The backward coefficients are the forward coefficients of
+        the reversed, conjugated traces: their roots are 1 / conj(root) of
+        the forward roots, so the roots outside the unit circle are
+        reflected back, the ones inside (noise) are kept. Exact for damped
+        and undamped exponentials.
+        """
+        x = traces[:, :size].astype(numpy.complex128)
+        forward, backward = self.LP_coefficients(x, order)
+        roots = self.LP_roots(backward)
+        outside = abs(roots) > 1.0
+        roots[outside] = 1.0 / roots[outside].conj()
+        backward = self.LP_from_roots(roots)
+        traces[:, size:] = 0.5 * (self.LP_extend(x, forward, traces.shape[1]) +
+                                  self.LP_extend(x, backward, traces.shape[1]))
+        return None
+    #####################################################
+    def LP_coefficients(self, x, order):
+        """
+        Returns the least squares forward prediction coefficients of every
+        trace, x[k] = sum(c[i] * x[k - 1 - i]), and the ones of the
+        reversed, conjugated traces (backward)
+
+        Both normal equations are parts of the same Gram matrix of the
+        windows of order + 1 points.
+        """
+        rows = x.shape[1] - order
+        windows = x[:, numpy.arange(rows)[:, numpy.newaxis] + numpy.arange(order + 1)]
+        gram = numpy.einsum('tra,trb->tab', windows.conj(), windows)
+        def Solve(normal, right):
+            # Tiny diagonal load keeps empty (zero) traces solvable
+            load = 1e-10 * numpy.trace(normal, axis1 = 1, axis2 = 2).real + 1e-30
+            normal = normal + load[:, numpy.newaxis, numpy.newaxis] * numpy.eye(order)
+            return numpy.linalg.solve(normal, right[..., numpy.newaxis])[..., 0]
+        # The last point of a window from the ones before it, the first
+        # one from the ones after it
+        before = numpy.arange(order - 1, -1, -1)
+        after = numpy.arange(1, order + 1)
+        forward = Solve(gram[:, before[:, numpy.newaxis], before], gram[:, before, order])
+        backward = Solve(gram[:, after[:, numpy.newaxis], after].conj(), gram[:, 0, after])
+        return forward, backward
+    #####################################################
+    def LP_roots(self, coefficients, iterations = 100):
+        """
+        Returns the roots of the prediction polynomials of every trace,
+        z ** order - sum(c[i] * z ** (order - 1 - i))
+
+        Aberth's simultaneous iteration runs for all traces at once, much
+        faster than the eigenvalues of a companion matrix per trace. A
+        trace stops when its roots no longer move.
+        """
+        traces, order = coefficients.shape
+        polynomial = -coefficients.T
+        # Started on a circle, its radius is the mean size of the roots
+        radius = abs(coefficients[:, -1]) ** (1.0 / order) + 1e-3
+        angles = 2.0 * numpy.pi * numpy.arange(order) / order + 0.4
+        roots = numpy.exp(1j * angles)[:, numpy.newaxis] * radius
+        active = numpy.arange(traces)
+        for iteration in range(iterations):
+            z = roots[:, active]
+            # Horner for the value and the slope at every root
+            value = z.copy()
+            slope = numpy.ones_like(z)
+            for coefficient in polynomial[:-1, active]:
+                value += coefficient
+                slope *= z
+                slope += value
+                value *= z
+            value += polynomial[-1, active]
+            repulsion = numpy.zeros_like(z)
+            with numpy.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+                for first in range(order):
+                    for second in range(first + 1, order):
+                        inverse = numpy.reciprocal(z[first] - z[second])
+                        repulsion[first] += inverse
+                        repulsion[second] -= inverse
+                value /= slope
+                step = value / (1.0 - value * repulsion)
+            step[~numpy.isfinite(step)] = 0.0
+            z -= step
+            roots[:, active] = z
+            # The convergence is cubic, the error after a small step is tiny
+            moved = step.real ** 2 + step.imag ** 2
+            scale = z.real ** 2 + z.imag ** 2 + 1e-12
+            active = active[(moved > 1e-16 * scale).any(axis = 0)]
+            if not active.size:
+                break
+        return roots.T
+    #####################################################
+    def LP_from_roots(self, roots):
+        """
+        Returns the prediction coefficients of the polynomials with roots
+        """
+        polynomial = numpy.zeros((roots.shape[0], roots.shape[1] + 1),
+                                 dtype = numpy.complex128)
+        polynomial[:, 0] = 1.0
+        for j in range(roots.shape[1]):
+            polynomial[:, 1:j + 2] = (polynomial[:, 1:j + 2] -
+                                      roots[:, j:j + 1] * polynomial[:, :j + 1])
+        return -polynomial[:, 1:]
+    #####################################################
+    def LP_extend(self, x, coefficients, length):
+        """
+        Returns x extended to length points with the coefficients
+        """
+        order = coefficients.shape[1]
+        extended = numpy.zeros((x.shape[0], length), dtype = numpy.complex128)
+        extended[:, :x.shape[1]] = x
+        for k in range(x.shape[1], length):
+            extended[:, k] = numpy.einsum('ti,ti->t', coefficients,
+                                          extended[:, k - 1:k - order - 1:-1])
+        return extended[:, x.shape[1]:]
+    #####################################################
+    def IST(self, data, schedule, size, iterations = 100, threshold = 0.9,
+            chunk = 256):
+        """
+        IST: iterative soft thresholding reconstruction of non uniformly
+        sampled data
+
+        The measured points (in the order of the sampling schedule) are
+        put on the grid of size points, zero filled to twice the size. In
+        every iteration the spectrum of the residual is soft thresholded at
+        threshold times its maximum and added to the reconstructed spectrum,
+        scaled up by size / measured points (the peaks of the sparse data
+        are that much weaker). The missing points are filled in from the reconstructed
+        spectrum, the measured ones are kept. All traces of a chunk are
+        reconstructed together, the chunks run on parallel threads.
+        """
+        measured = data.shape[-1]
+        schedule = numpy.array(schedule[:measured])
+        traces = data.reshape(-1, measured)
+        result = numpy.zeros((traces.shape[0], size), dtype = data.dtype)
+        chunks = [(start, min(start + chunk, traces.shape[0]))
+                  for start in range(0, traces.shape[0], chunk)]
+        function = lambda limits: self.IST_chunk(traces[limits[0]:limits[1]],
+                                                 result[limits[0]:limits[1]],
+                                                 schedule, iterations, threshold)
+        if len(chunks) > 1 and not multiprocessing.current_process().daemon:
+            pool = multiprocessing.pool.ThreadPool(min(len(chunks),
+                                                       multiprocessing.cpu_count()))
+            try:
+                pool.map(function, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            map(function, chunks)
+        self.axes[0]['tdsize'] = size
+        return result.reshape(data.shape[:-1] + (size,))
+    #####################################################
+    def IST_chunk(self, traces, result, schedule, iterations, threshold):
+        """
+        Reconstruct result[:, :] from the measured traces, in place
+        """
+        size = result.shape[-1]
+        gain = size / float(len(schedule))
+        # Measured points and the (known) zeros of the zero filling
+        unknown = numpy.ones(2 * size, dtype = bool)
+        unknown[schedule] = False
+        unknown[size:] = False
+        grid = numpy.zeros((traces.shape[0], 2 * size), dtype = numpy.complex128)
+        grid[:, schedule] = traces
+        spectrum = numpy.zeros(grid.shape, dtype = numpy.complex128)
+        residual = grid.copy()
+        for iteration in range(iterations):
+            update = numpy.fft.fft(residual, axis = -1)
+            magnitude = abs(update)
+            level = threshold * magnitude.max(axis = -1)[:, numpy.newaxis]
+            update *= gain * numpy.maximum(magnitude - level, 0.0) / numpy.maximum(magnitude, 1e-30)
+            spectrum += update
+            residual = grid - numpy.fft.ifft(spectrum, axis = -1)
+            residual[:, unknown] = 0.0
+        reconstructed = numpy.fft.ifft(spectrum, axis = -1)[:, :size]
+        reconstructed[:, schedule] = traces
+        result[...] = reconstructed
+        return None
+    #####################################################
+    def REV(self, data, sw = True):
+        """
+        REV -sw: reverse the spectrum
+        """
+        if sw:
+            axis = self.axes[0]
+            axis['car'] -= axis['sw'] / axis['obs'] / data.shape[-1]
+        return numpy.ascontiguousarray(data[..., ::-1])
+    #####################################################
+    def POLY_auto(self, data, order = 2, window = 16):
+        """
+        POLY -auto: automatic baseline correction, a polynomial is fitted to
+        the points where the local noise level is low
+        """
+        size = data.shape[-1]
+        traces = data.reshape(-1, size).astype(numpy.float64)
+        # Standard deviation in a sliding window via cumulative sums
+        window = min(window, size)
+        padded = numpy.zeros((traces.shape[0], size + 1))
+        padded[:, 1:] = numpy.cumsum(traces, axis = 1)
+        squares = numpy.zeros((traces.shape[0], size + 1))
+        squares[:, 1:] = numpy.cumsum(traces ** 2, axis = 1)
+        mean = (padded[:, window:] - padded[:, :-window]) / window
+        deviation = numpy.sqrt(numpy.maximum(
+            (squares[:, window:] - squares[:, :-window]) / window - mean ** 2, 0.0))
+        noise = numpy.median(deviation, axis = 1)[:, numpy.newaxis]
+        quiet = numpy.zeros(traces.shape)
+        quiet[:, window / 2:window / 2 + deviation.shape[1]] = deviation <= 2.0 * noise
+        # Weighted least squares for every trace at once
+        vander = numpy.vander(numpy.linspace(-1.0, 1.0, size), order + 1)
+        normal = numpy.einsum('tn,nk,nl->tkl', quiet, vander, vander)
+        normal += numpy.eye(order + 1) * 1e-9
+        right = numpy.einsum('tn,nk->tk', quiet * traces, vander)
+        coefficients = numpy.linalg.solve(normal, right[..., numpy.newaxis])[..., 0]
+        traces -= numpy.dot(coefficients, vander.T)
+        return traces.astype(numpy.float32).reshape(data.shape)
+    #####################################################
+    @staticmethod
+    def Tile_sizes(shape, tile_points = 8192):
+        """
+        Returns the UCSF tile size of every axis
+
+        The longest side is halved until a tile has at most tile_points
+        values (32 kB), so a tile is one efficient read and the tiles are
+        close to square for scrolling in any direction.
+        """
+        tiles = list(shape)
+        while reduce(lambda a, b: a * b, tiles) > tile_points:
+            longest = tiles.index(max(tiles))
+            tiles[longest] = (tiles[longest] + 1) / 2
+        return tiles
+    #####################################################
+    def Sparky_nucleus(self, label):
+        """
+        Returns the Sparky name of a nucleus: H1 => 1H, N15 => 15N
+        """
+        match = re.match('^([A-Za-z]+)([0-9]+)$', label)
+        if match:
+            return match.group(2) + match.group(1)
+        return label
+    #####################################################
+    def Write_ucsf(self, FileName, data, tile_points = 8192):
+        """
+        Write real, processed data directly into a Sparky (UCSF) file
+
+        The data is written one row of tiles at a time, so only one row of
+        tiles is copied for the tiling and the byte order.
+
+        Parameters:
+        ===========
+            * FileName = Name of the output file, like: test.ucsf
+            * data = 1D, 2D or 3D array, the last axis is the direct dimension
+            * tile_points = maximum number of values in a tile
+        """
+        data = numpy.asarray(data, dtype = numpy.float32)
+        self.Write_ucsf_rows(FileName, data.shape, [data], tile_points)
+        return None
+    #####################################################
+    def Write_ucsf_rows(self, FileName, shape, batches, tile_points = 8192):
+        """
+        Write_ucsf() of data that comes in batches along the first axis,
+        like the results of Process_stream(), only one row of tiles is kept
+
+        Parameters:
+        ===========
+            * FileName = Name of the output file, like: test.ucsf
+            * shape = shape of the whole data
+            * batches = arrays (or a generator) of consecutive parts of the
+                        data, all of them together have shape[0] rows
+            * tile_points = maximum number of values in a tile
+        """
+        tiles = self.Tile_sizes(shape, tile_points)
+        dimensions = len(shape)
+        output = open(FileName, 'wb')
+        output.write(struct.pack('>10s4B9s26s80s3xl40s4x', 'UCSF NMR',
+                                 dimensions, 1, 0, 2, '', '', '', 0, ''))
+        # Axis headers from the slowest (w1) to the direct dimension
+        for dimension in range(dimensions):
+            position = dimensions - 1 - dimension
+            if position < len(self.axes):
+                axis = self.axes[position]
+            else:
+                # Arrayed (pseudo) dimension
+                axis = self.Axis('', 1.0, 1.0, 0.0, shape[dimension], 'Real')
+            output.write(struct.pack('>6sh3I6f84s',
+                                     self.Sparky_nucleus(axis['label'])[:6],
+                                     0, shape[dimension], 0, tiles[dimension],
+                                     axis['obs'], axis['sw'], axis['car'],
+                                     0.0, 0.0, 0.0, ''))
+        # Tile rows: [tile, t1, tile size 1, t2, tile size 2, ...] =>
+        #            [t1, t2, ..., tile, tile size 1, tile size 2, ...]
+        padded = [((size + tile - 1) / tile) * tile
+                  for size, tile in zip(shape[1:], tiles[1:])]
+        tiled_shape = [tiles[0]]
+        for size, tile in zip(padded, tiles[1:]):
+            tiled_shape.extend([size / tile, tile])
+        order = range(1, 2 * dimensions - 1, 2) + [0] + range(2, 2 * dimensions - 1, 2)
+        row = numpy.zeros([tiles[0]] + padded, dtype = '>f4')
+        area = tuple([slice(0, size) for size in shape[1:]])
+        filled = 0
+        for batch in batches:
+            first = 0
+            while first < len(batch):
+                rows = min(tiles[0] - filled, len(batch) - first)
+                row[(slice(filled, filled + rows),) + area] = batch[first:first + rows]
+                filled += rows
+                first += rows
+                if filled == tiles[0]:
+                    row.reshape(tiled_shape).transpose(order).tofile(output)
+                    row[...] = 0.0
+                    filled = 0
+        if filled:
+            row.reshape(tiled_shape).transpose(order).tofile(output)
+        output.close()
+        return None
+    #####################################################
+    @staticmethod
+    def Read_ucsf(FileName):
+        """
+        Read a Sparky (UCSF) file, like the ones of Write_ucsf()
+
+        Returns:
+        ========
+            * (data, axes): the float32 array, the last axis is the direct
+              dimension, and a {'label', 'size', 'tile', 'obs', 'sw', 'car'}
+              dictionary of every axis in the same order
+        """
+        source = open(FileName, 'rb')
+        header = source.read(180)
+        if header[:8] != 'UCSF NMR':
+            source.close()
+            raise ValueError(FileName + ' is not a UCSF file')
+        dimensions = ord(header[10])
+        axes = []
+        for dimension in range(dimensions):
+            values = struct.unpack('>6sh3I6f84s', source.read(128))
+            axes.append({'label' : values[0].strip('\x00'),
+                         'size'  : values[2],
+                         'tile'  : values[4],
+                         'obs'   : values[5],
+                         'sw'    : values[6],
+                         'car'   : values[7]})
+        shape = [axis['size'] for axis in axes]
+        tiles = [axis['tile'] for axis in axes]
+        counts = [(size + tile - 1) / tile for size, tile in zip(shape, tiles)]
+        data = numpy.fromfile(source, dtype = '>f4',
+                              count = reduce(lambda a, b: a * b,
+                                             [count * tile for count, tile in zip(counts, tiles)]))
+        source.close()
+        # [t1, t2, ..., tile size 1, tile size 2, ...] => [t1, tile size 1, t2, ...]
+        order = []
+        for dimension in range(dimensions):
+            order.extend([dimension, dimensions + dimension])
+        data = data.reshape(counts + tiles).transpose(order).reshape(
+                            [count * tile for count, tile in zip(counts, tiles)])
+        data = data[tuple([slice(0, size) for size in shape])].astype(numpy.float32)
+        return data, axes
+    #####################################################
+    def Write_pipe(self, FileName, data):
+        """
+        Write real, processed data into an nmrPipe format file
+
+        A 3D spectrum is written as one nmrPipe stream (like xyz2pipe -x),
+        plane by plane, so a memory mapped spectrum is not read at once.
+
+        Parameters:
+        ===========
+            * FileName = Name of the output file, like: test.dat
+            * data = 1D, 2D or 3D array, the last axis is the direct dimension
+        """
+        output = open(FileName, 'wb')
+        self.Pipe_header(data.shape).tofile(output)
+        for plane in (data if numpy.ndim(data) > 2 else [data]):
+            numpy.asarray(plane, dtype = numpy.float32).tofile(output)
+        output.close()
+        return None
+    #####################################################
+    def Pipe_header(self, shape):
+        """
+        Returns the 512 value nmrPipe header of real data of shape, 3D
+        data (z, y, x) needs three axes
+        """
+        size = shape[-1]
+        specnum = reduce(lambda a, b: a * b, shape) / size
+        cube = len(shape) == 3 and len(self.axes) > 2
+        if cube:
+            # The vectors of one plane, the planes follow each other
+            specnum = shape[1]
+        header = numpy.zeros(512, dtype = numpy.float32)
+        header[self.FDFLTFORMAT] = numpy.array([0xeeeeeeee],
+                                               dtype = numpy.uint32).view(numpy.float32)[0]
+        header[self.FDFLTORDER] = 2.345
+        header[self.FDDIMCOUNT] = 2 if specnum > 1 else 1
+        header[self.FDDIMORDER:self.FDDIMORDER + 4] = [2, 1, 3, 4]
+        header[self.FDSIZE] = size
+        header[self.FDREALSIZE] = size
+        header[self.FDSPECNUM] = specnum
+        header[self.FDQUADFLAG] = 1
+        header[self.FDF2QUADFLAG] = 1
+        header[self.FDF1QUADFLAG] = 1
+        header[self.FDFILECOUNT] = 1
+        fields = [(self.axes[0], size, self.FDF2LABEL, self.FDF2SW, self.FDF2OBS,
+                   self.FDF2CAR, self.FDF2ORIG, self.FDF2CENTER, self.FDF2FTFLAG,
+                   self.FDF2FTSIZE, self.FDF2TDSIZE, self.FDF2APOD)]
+        if len(self.axes) > 1:
+            header[self.FD2DPHASE] = 2
+            fields.append((self.axes[1], specnum, self.FDF1LABEL, self.FDF1SW,
+                           self.FDF1OBS, self.FDF1CAR, self.FDF1ORIG,
+                           self.FDF1CENTER, self.FDF1FTFLAG, self.FDF1FTSIZE,
+                           self.FDF1TDSIZE, self.FDF1APOD))
+        if cube:
+            header[self.FDDIMCOUNT] = 3
+            header[self.FDF3SIZE] = shape[0]
+            header[self.FDF3QUADFLAG] = 1
+            header[self.FDPIPEFLAG] = 1
+            fields.append((self.axes[2], shape[0], self.FDF3LABEL, self.FDF3SW,
+                           self.FDF3OBS, self.FDF3CAR, self.FDF3ORIG,
+                           self.FDF3CENTER, self.FDF3FTFLAG, self.FDF3FTSIZE,
+                           self.FDF3TDSIZE, self.FDF3APOD))
+        characters = header.view(numpy.uint8)
+        for (axis, points, label, sw, obs, car, orig, center, ftflag, ftsize,
+             tdsize, apod) in fields:
+            characters[label * 4:label * 4 + 8] = numpy.fromstring(
+                axis['label'][:8].ljust(8, '\0'), dtype = numpy.uint8)
+            header[sw] = axis['sw']
+            header[obs] = axis['obs']
+            header[car] = axis['car']
+            header[center] = points / 2 + 1
+            header[orig] = (axis['car'] * axis['obs'] -
+                            axis['sw'] * (points - header[center]) / points)
+            header[ftflag] = 1 if axis['ft'] else 0
+            header[ftsize] = axis['ftsize']
+            header[tdsize] = axis['tdsize']
+            header[apod] = axis['tdsize']
+        return header
+################################################################################
+
+
+class ResultCache():
+    """
+    Content addressed cache of the processed .ucsf/.dat files
+
+    The key is a hash of the fid bytes, the procpar values, the
+    processing parameters, the script and the source of the processing
+    code, so an identical run restores the results
+    instead of processing again. The least recently used entries are
+    removed when the cache grows over MaxSize bytes.
+
+    Example:
+
+        Cache = ResultCache()
+        key = Cache.Key('data/fid', {'np': ['2048']}, parameters)
+        if not Cache.Restore(key, 'data/'):
+            ...
+            Cache.Store(key, ['data/data.ucsf'])
+    """
+    MaxSize = 5 * 1024 ** 3
+    # Part of the key when the source of the program is not available,
+    # increase it when the results of the processing change
+    VERSION = '1'
+    #####################################################
+    def __init__(self, Folder = None, MaxSize = None):
+        """
+        Parameters:
+
+        * Folder  = Location of the cache, default = ~/.nmr_procy_cache/
+        * MaxSize = Size limit in bytes, default = 5 GB
+        """
+        if not Folder:
+            Folder = os.path.join(os.path.expanduser('~'), '.nmr_procy_cache')
+        self.Folder = os.path.join(Folder, '')
+        if MaxSize:
+            self.MaxSize = MaxSize
+        if not os.path.isdir(self.Folder):
+            try:
+                os.makedirs(self.Folder)
+            except OSError:
+                # Created by a parallel run in the meantime
+                pass
+        return None
+    #####################################################
+    def File_hash(self, FileName, chunk = 4 * 1024 ** 2):
+        """
+        Returns the sha1 hash of a file
+
+        The hashes are remembered by (path, size, modification time), so a
+        large fid is only read once. Every path has its own small memo file
+        in <Folder>/hashes/ (named by the hash of the path), written
+        atomically, parallel runs never overwrite each other's entries.
+        """
+        status = os.stat(FileName)
+        name = os.path.abspath(FileName)
+        signature = (status.st_size, status.st_mtime)
+        memo_file = self.Hash_folder() + hashlib.sha1(name).hexdigest()
+        try:
+            memo = marshal.load(open(memo_file, 'rb'))
+            if memo[0] == name and memo[1:3] == signature:
+                return memo[3]
+        except (IOError, EOFError, ValueError, TypeError, IndexError):
+            pass
+        digest = hashlib.sha1()
+        data = open(FileName, 'rb')
+        block = data.read(chunk)
+        while block:
+            digest.update(block)
+            block = data.read(chunk)
+        data.close()
+        self.Write_atomic(memo_file, marshal.dumps((name,) + signature +
+                                                   (digest.hexdigest(),)))
+        return digest.hexdigest()
+    #####################################################
+    def Hash_folder(self):
+        """
+        Returns the folder of the File_hash() memo files, created if needed
+        """
+        Folder = self.Folder + 'hashes/'
+        if not os.path.isdir(Folder):
+            try:
+                os.mkdir(Folder)
+            except OSError:
+                # Created by a parallel run in the meantime
+                pass
+        return Folder
+    #####################################################
+    def Prune_hashes(self):
+        """
+        Remove the File_hash() memo files of the files that no longer exist
+        or have changed since
+        """
+        Folder = self.Hash_folder()
+        for memo_file in os.listdir(Folder):
+            try:
+                memo = marshal.load(open(Folder + memo_file, 'rb'))
+                status = os.stat(memo[0])
+                if memo[1:3] == (status.st_size, status.st_mtime):
+                    continue
+            except (IOError, OSError, EOFError, ValueError, TypeError, IndexError):
+                pass
+            try:
+                os.remove(Folder + memo_file)
+            except OSError:
+                # Removed (or rewritten) by a parallel run
+                pass
+        # The single memo file of the earlier versions
+        if os.path.isfile(self.Folder + 'file_hashes'):
+            os.remove(self.Folder + 'file_hashes')
+        return None
+    #####################################################
+    def Code_hash(self):
+        """
+        Returns the hash of the source of this program (the engine, the
+        script templates and the workers), part of every key
+        """
+        source = os.path.abspath(__file__)
+        if source[-4:] in ('.pyc', '.pyo'):
+            source = source[:-1]
+        if not os.path.exists(source):
+            return self.VERSION
+        return self.File_hash(source)
+    #####################################################
+    def Write_atomic(self, FileName, content):
+        """
+        Write a file through a temporary file, parallel runs never see a
+        half written file
+        """
+        handle, temporary = tempfile.mkstemp(dir = self.Folder)
+        os.write(handle, content)
+        os.close(handle)
+        os.rename(temporary, FileName)
+        return None
+    #####################################################
+    def Key(self, FidFileName, procpar_values, parameters, *options):
+        """
+        Returns the cache key of a processing run
+
+        Parameters:
+        ===========
+            * FidFileName = the fid file, its content is hashed
+            * procpar_values = {name: value} of the used procpar parameters
+            * parameters = the parameters of CreateConverFile
+            * options = anything else that changes the results
+        """
+        digest = hashlib.sha1(self.File_hash(FidFileName))
+        for values in (procpar_values, parameters):
+            for key in sorted(values):
+                digest.update(repr((key, values[key])))
+        digest.update(repr(options))
+        return digest.hexdigest()
+    #####################################################
+    def Restore(self, key, Path):
+        """
+        Copy the cached files of key into Path, returns the restored files
+        or an empty list if key is not in the cache
+        """
+        entry = self.Folder + key + '/'
+        if not os.path.isdir(entry):
+            return []
+        restored = []
+        for name in sorted(os.listdir(entry)):
+            shutil.copy2(entry + name, Path + name)
+            restored.append(Path + name)
+        # Recently used entries are evicted last
+        os.utime(entry, None)
+        return restored
+    #####################################################
+    def Store(self, key, FileNames):
+        """
+        Copy the result files into the cache under key and evict the least
+        recently used entries if the cache is too large
+        """
+        if not FileNames or os.path.isdir(self.Folder + key):
+            return None
+        temporary = tempfile.mkdtemp(dir = self.Folder)
+        for name in FileNames:
+            shutil.copy2(name, os.path.join(temporary, os.path.basename(name)))
+        try:
+            os.rename(temporary, self.Folder + key)
+        except OSError:
+            # Stored by a parallel run in the meantime
+            shutil.rmtree(temporary, ignore_errors = True)
+        self.Evict()
+        return None
+    #####################################################
+    def Evict(self):
+        """
+        Remove the least recently used entries until the size is below
+        MaxSize, and the memo files of File_hash() of the missing files
+        """
+        self.Prune_hashes()
+        entries = []
+        total = 0
+        for key in os.listdir(self.Folder):
+            entry = self.Folder + key + '/'
+            if len(key) != 40 or not os.path.isdir(entry):
+                continue
+            size = sum([os.path.getsize(entry + name) for name in os.listdir(entry)])
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+        for used, size, entry in sorted(entries):
+            if total <= self.MaxSize:
+                break
+            shutil.rmtree(entry, ignore_errors = True)
+            total -= size
+        return None
+################################################################################
+
+
+class ProcessingReport():
+    """
+    Wall time, CPU time, peak memory (RSS) and I/O of the steps of a
+    processing, written as a JSON report
+
+    The steps done in this process are measured between Start() and
+    Stop(): the CPU time and the peak RSS include the finished worker
+    processes (native processing), the I/O is of this process. The peak
+    RSS (ru_maxrss) of these steps is the peak of the whole process life
+    up to the end of the step, not of the step alone. Every
+    subprocess of a Pipeline is measured on its own (os.wait4 and
+    /proc/<pid>/io). The I/O is the bytes read and written through the
+    system calls (rchar, wchar) and from / to the storage (read_bytes,
+    write_bytes), only on Linux.
+
     Example:
 
-        MyProcpar = ProcparData('data/','procpar')
-        print MyProcpar.parameter('ni')
+        Report = ProcessingReport()
+        start = Report.Start()
+        ...
+        Report.Stop('procpar', start)
+        Report.Write('convert_nmr.json')
     """
+    IO_FIELDS = ('rchar', 'wchar', 'read_bytes', 'write_bytes')
+    PEAK_RSS_NOTE = ('ru_maxrss: the steps of this process ("process": "self") '
+                     'have the peak of the process lifetime (and of its finished '
+                     'children) up to the end of the step, not a per step value; '
+                     'every subprocess step has its own peak')
+    #####################################################
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        return None
+    #####################################################
+    @staticmethod
+    def Io(pid = 'self'):
+        """
+        Returns the I/O counters of a process, {} if they are not available
+        """
+        counters = {}
+        try:
+            for line in open('/proc/' + str(pid) + '/io'):
+                name, value = line.split(':')
+                if name in ProcessingReport.IO_FIELDS:
+                    counters[name] = int(value)
+        except (IOError, ValueError):
+            return {}
+        return counters
+    #####################################################
+    def Start(self):
+        """
+        Returns the counters of this process and its finished children
+        """
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        sample = {'time'        : time.time(),
+                  'cpu'         : (own.ru_utime + own.ru_stime +
+                                   children.ru_utime + children.ru_stime),
+                  'peak_rss_kb' : max(own.ru_maxrss, children.ru_maxrss)}
+        sample.update(self.Io())
+        return sample
+    #####################################################
+    def Stop(self, name, start, values = None):
+        """
+        Record a step of this process started at start = Start(), values
+        are other counters of the step, like {'vector_cache_hits': 10}
+        """
+        end = self.Start()
+        stage = {'name'        : name,
+                 'process'     : 'self',
+                 'wall'        : end['time'] - start['time'],
+                 'cpu'         : end['cpu'] - start['cpu'],
+                 'peak_rss_kb' : end['peak_rss_kb']}
+        stage.update(values or {})
+        for field in self.IO_FIELDS:
+            if field in start and field in end:
+                stage[field] = end[field] - start[field]
+        self.stages.append(stage)
+        return None
+    #####################################################
+    def Add(self, stage):
+        """
+        Record a measured step, like a subprocess of a Pipeline
+        """
+        self.stages.append(stage)
+        return None
+    #####################################################
+    def Write(self, FileName, error = None):
+        """
+        Write the report as JSON
+        """
+        report = {'started' : time.strftime('%Y-%m-%d %H:%M:%S',
+                                            time.localtime(self.started)),
+                  'wall'    : time.time() - self.started,
+                  'error'   : error,
+                  'stages'  : self.stages,
+                  'notes'   : {'peak_rss_kb' : self.PEAK_RSS_NOTE}}
+        json.dump(report, open(FileName, 'w'), indent = 1, sort_keys = True)
+        return None
     #####################################################
-    def __init__(self, Path='', FileName='procpar'):
+    @staticmethod
+    def Summary(FileNames, FileName):
         """
+        Write the aggregate of many reports (a batch) as JSON: the totals
+        of every run and of every step name, like 'var2pipe' or
+        'nmrPipe -fn LP'
+
         Parameters:
+        ===========
+            * FileNames = the reports, missing ones are skipped
+            * FileName = the summary file
+        """
+        runs = []
+        stages = {}
+        for name in FileNames:
+            try:
+                report = json.load(open(name))
+            except (IOError, ValueError):
+                continue
+            runs.append({'report' : name,
+                         'wall'   : report['wall'],
+                         'cpu'    : sum([stage['cpu'] for stage in report['stages']]),
+                         'error'  : report['error']})
+            for stage in report['stages']:
+                total = stages.setdefault(stage['name'], {'count': 0, 'wall': 0.0,
+                                                          'cpu': 0.0, 'peak_rss_kb': 0})
+                total['count'] += 1
+                total['wall'] += stage['wall']
+                total['cpu'] += stage['cpu']
+                total['peak_rss_kb'] = max(total['peak_rss_kb'], stage['peak_rss_kb'])
+                for field in ProcessingReport.IO_FIELDS:
+                    if field in stage:
+                        total[field] = total.get(field, 0) + stage[field]
+        summary = {'runs'   : runs,
+                   'wall'   : sum([run['wall'] for run in runs]),
+                   'cpu'    : sum([run['cpu'] for run in runs]),
+                   'stages' : stages}
+        json.dump(summary, open(FileName, 'w'), indent = 1, sort_keys = True)
+        return None
+################################################################################
 
-        * Path      Path of the procpar file
-        * FileName  Filename of the procpar file, default = 'procpar'
+
+class PipelineError(Exception):
+    """
+    A stage of a Pipeline failed, could not start or ran out of time
+    """
+    pass
+################################################################################
+
+
+class Pipeline():
+    """
+    Run shell like commands (var2pipe | nmrPipe ... | nmrPipe ...) as
+    chained subprocesses, without a shell
+
+    A pipeline is a list of commands run one after the other, a command is
+    a list of stages connected by pipes, a stage is a list of arguments.
+    The exit code of every stage is checked, the first failure (or the
+    timeout) stops the pipeline with a PipelineError.
+
+    Example:
+
+        Pipeline.Run_all([Pipeline.From_script(open('convert_nmr.com').read())])
+        Pipeline.Run_all([Pipeline.From_script('sethdr a.dat -ndim 2\n'
+                                               'pipe2ucsf a.dat a.ucsf'),
+                          Pipeline.From_script('pipe2ucsf b.dat b.ucsf')],
+                         Processes = 2, timeout = 600)
+    """
+    # Interval of checking the running processes in seconds
+    POLL = 0.02
+    #####################################################
+    def __init__(self, commands, Report = None):
         """
-        # Open and read the procpar file
-        try:
-            File_handler = open(Path+FileName,'r')
-        except IOError:
-            print ''.join(('\n-----------\nError opening ', Path, FileName,
-                           '! Please check it!\n-----------\n'))
-            exit()
-        Lines = File_handler.readlines()
-        File_handler.close()
-        # Data stored in __parameter__
-        self.__parameter__ = {}
-        # Go through the lines
-        i = 0
-        while (i < len(Lines)):
-            # The 'key' is the first line first value
-            key = Lines[i].split()[0]
-            while key == '0':
-                key = Lines[i].split()[0]
-                i += 1
-#            print '\n',key
-            if (key == 'saveglobal_') or (key == 'dgs') or (key == 'dg2'):
-                # The 'values' are the next lines till a "0" comes
-                i += 1
-                first_row = 1
-                while (i < len(Lines)) and (Lines[i].strip() != '0'):
-                    if first_row == 1:
-                        # The first value in the first row is the numer of
-                        # values, do not need to store
-                        value = Lines[i].strip().split()[1:]
-                        first_row = 0
-                    else:
-                        value.append(Lines[i].strip())
-                    i += 1
-                # The final line for each parameter is the "0"
-                if (i < len(Lines)):
-                    i += 1
+        Parameters:
+
+        * commands = [[stage arguments, ...], ...], the output of the last
+                     stage goes to a file if its last two arguments are
+                     '>' and a file name
+        * Report   = ProcessingReport to record every stage, None = not
+                     recorded
+        """
+        self.commands = commands
+        self.report = Report
+        self.current = 0
+        self.processes = []
+        self.output = None
+        self.deadline = None
+        return None
+    #####################################################
+    @staticmethod
+    def From_script(script, Report = None):
+        """
+        Returns the Pipeline of a csh processing script, like the result of
+        Convert_HSQC.script_for_regular_2D(), see __init__ for Report and
+        Split_script() for the understood part of csh
+        """
+        return Pipeline(Pipeline.Split_script(script), Report)
+    #####################################################
+    @staticmethod
+    def Split_script(script):
+        """
+        Returns the commands of a csh processing script as [[stage
+        arguments, ...], ...], see __init__
+
+        Only the csh of the generated scripts is understood, it is not a
+        shell: one command per line, continued by a backslash at the end of
+        the line, the stages separated by '|', single or double quoted
+        arguments (a quoted '|', '#' or '>' is a part of the argument) and
+        an optional '> file' at the end of the last stage. Lines starting
+        with '#' are left out, also within a continued command (like an
+        inactive '#| nmrPipe -fn LP'), a '#' starting a word comments out
+        the rest of the line. There are no variables, no globs and no
+        other redirections, ';', '&', '<', '`', '$', '(', ')', '>>' and an
+        unmatched quote raise a PipelineError instead of being passed on
+        as arguments.
+        """
+        commands = []
+        stages = []
+        piece = ''
+        output = None
+        quote = None
+        line_start = True
+        text = script + '\n'
+        position = 0
+        while position < len(text):
+            character = text[position]
+            position += 1
+            if quote:
+                if character == '\n':
+                    raise PipelineError('Unmatched {0} in the script:\n{1}'.format(
+                                        quote, piece.strip()))
+                if character == quote:
+                    quote = None
+                elif character == '\\' and quote == '"' and text[position] in '"\\':
+                    # Escaped within double quotes, kept for shlex
+                    character += text[position]
+                    position += 1
+                piece += character
+                continue
+            if line_start and character in ' \t':
+                piece += character
+                continue
+            if character == '#' and (line_start or not piece or piece[-1] in ' \t'):
+                # A commented out line is skipped with its end, the command
+                # goes on, a comment after a word ends the command
+                position = text.index('\n', position) + (1 if line_start else 0)
+                continue
+            line_start = False
+            if character == '\\':
+                if text[position] == '\n':
+                    # Continued on the next line
+                    piece += ' '
+                    line_start = True
+                else:
+                    piece += character + text[position]
+                position += 1
+            elif character in ';&<`$()' or (character == '>' and text[position] in '>&!'):
+                raise PipelineError('"{0}" is not supported in a processing script:\n{1}'.format(
+                                    character + (text[position] if character == '>' else ''),
+                                    piece.strip()))
+            elif character in '|>\n':
+                if output is not None:
+                    if character != '\n' or len(shlex.split(piece)) != 1:
+                        raise PipelineError('"> file" must end a command:\n' +
+                                            ' '.join(stages[-1] + ['>', piece.strip()]))
+                    output = shlex.split(piece)
+                else:
+                    stages.append(shlex.split(piece))
+                piece = ''
+                if character == '>':
+                    output = []
+                if character == '\n':
+                    line_start = True
+                    if output:
+                        stages[-1].extend(['>'] + output)
+                    if [stage for stage in stages if stage]:
+                        if [stage for stage in stages if not stage]:
+                            raise PipelineError('Empty stage in the script:\n' +
+                                                ' | '.join([' '.join(stage) for stage in stages]))
+                        commands.append(stages)
+                    stages = []
+                    output = None
             else:
-                value = []
-                value.append(Lines[i+1].strip()[Lines[i+1].index(' ')+1:])
+                if character in '"\'':
+                    quote = character
+                piece += character
+        return commands
+    #####################################################
+    def Text(self, command):
+        """
+        Returns a command as one line, for the messages
+        """
+        return ' | '.join([' '.join(stage) for stage in command])
+    #####################################################
+    def Stage_name(self, stage):
+        """
+        Returns the name of a stage for the report, like 'nmrPipe -fn FT'
+        """
+        name = os.path.basename(stage[0])
+        if '-fn' in stage[:-1]:
+            name += ' -fn ' + stage[stage.index('-fn') + 1]
+        return name
+    #####################################################
+    def Start(self, timeout = None):
+        """
+        Start the first command, the pipeline is stopped after timeout
+        seconds (None = no limit)
+        """
+        if timeout:
+            self.deadline = time.time() + timeout
+        self.current = 0
+        self.Start_command()
+        return None
+    #####################################################
+    def Start_command(self):
+        """
+        Start the stages of the current command connected by pipes
+        """
+        command = self.commands[self.current]
+        self.processes = []
+        self.started = time.time()
+        stdin = None
+        for number, stage in enumerate(command):
+            stdout = subprocess.PIPE
+            if number == len(command) - 1:
+                stdout = None
+                if len(stage) > 2 and stage[-2] == '>':
+                    self.output = open(stage[-1], 'wb')
+                    stdout = self.output
+                    stage = stage[:-2]
+            try:
+                process = subprocess.Popen(stage, stdin = stdin, stdout = stdout)
+            except OSError, error:
+                self.Kill()
+                raise PipelineError('Cannot start {0}: {1}\n{2}'.format(
+                                    stage[0], error.strerror, self.Text(command)))
+            if stdin is not None:
+                # Only the next stage reads it, so a failing stage stops the
+                # previous ones (SIGPIPE)
+                stdin.close()
+            stdin = process.stdout
+            self.processes.append(process)
+        return None
+    #####################################################
+    def Poll(self):
+        """
+        Returns True if every command is finished, False if it is running
+
+        The next command is started when the current one is finished. A
+        PipelineError is raised if a stage failed or the time is over.
+        """
+        while True:
+            if [number for number in range(len(self.processes))
+                if not self.Finished(number)]:
+                if self.deadline and time.time() > self.deadline:
+                    self.Kill()
+                    raise PipelineError('Timeout, stopped:\n' +
+                                        self.Text(self.commands[self.current]))
+                return False
+            self.Check()
+            self.current += 1
+            if self.current == len(self.commands):
+                return True
+            self.Start_command()
+    #####################################################
+    def Finished(self, number):
+        """
+        True if a stage of the current command is finished
+
+        The stage is reaped with os.wait4, its resource usage and I/O go
+        into the report. The I/O counters are read while the process is a
+        zombie, after reaping they are gone.
+        """
+        process = self.processes[number]
+        if process.returncode is not None:
+            return True
+        try:
+            state = open('/proc/{0}/stat'.format(process.pid)).read().rsplit(')', 1)[1].split()[0]
+        except (IOError, IndexError):
+            # No /proc, wait4 tells if it is finished
+            state = 'Z'
+        if state != 'Z':
+            return False
+        io = ProcessingReport.Io(process.pid)
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if not pid:
+            return False
+        if os.WIFSIGNALED(status):
+            process.returncode = -os.WTERMSIG(status)
+        else:
+            process.returncode = os.WEXITSTATUS(status)
+        if self.report:
+            stage = self.commands[self.current][number]
+            record = {'name'        : self.Stage_name(stage),
+                      'process'     : ' '.join(stage),
+                      'exit_code'   : process.returncode,
+                      'wall'        : time.time() - self.started,
+                      'cpu'         : usage.ru_utime + usage.ru_stime,
+                      'peak_rss_kb' : usage.ru_maxrss}
+            record.update(io)
+            self.report.Add(record)
+        return True
+    #####################################################
+    def Check(self):
+        """
+        Raise a PipelineError if a stage of the finished command failed
 
-                i += 3
-            # Store the data
-#            print key, value
-            self.__parameter__[key] = value
-            key = ''
+        A stage stopped by SIGPIPE is only reported if no other one failed,
+        it is the result of a failure after it.
+        """
+        if self.output:
+            self.output.close()
+            self.output = None
+        command = self.commands[self.current]
+        failed = [(process.returncode == -signal.SIGPIPE, number, process.returncode)
+                  for number, process in enumerate(self.processes)
+                  if process.returncode != 0]
+        if failed:
+            broken, number, code = min(failed)
+            raise PipelineError('{0} failed with exit code {1}:\n{2}'.format(
+                                command[number][0], code, self.Text(command)))
         return None
     #####################################################
-    def parameter(self, ParameterName):
+    def Kill(self):
         """
-        Returns the value of a parameter from the procpar file
+        Stop the running stages of the current command
+        """
+        for process in self.processes:
+            if process.poll() is None:
+                try:
+                    process.kill()
+                except OSError:
+                    pass
+                process.wait()
+        if self.output:
+            self.output.close()
+            self.output = None
+        return None
+    #####################################################
+    @staticmethod
+    def Run_all(pipelines, Processes = 1, timeout = None):
+        """
+        Run pipelines, at most Processes of them at the same time
+
+        The first failure stops every running pipeline and raises its
+        PipelineError, the waiting ones are not started.
 
         Parameters:
+        ===========
+            * pipelines = list of Pipeline
+            * Processes = number of pipelines running at the same time
+            * timeout = seconds for one pipeline, None = no limit
+        """
+        waiting = list(pipelines)
+        running = []
+        try:
+            while waiting or running:
+                while waiting and len(running) < Processes:
+                    pipeline = waiting.pop(0)
+                    running.append(pipeline)
+                    pipeline.Start(timeout)
+                for pipeline in running[:]:
+                    if pipeline.Poll():
+                        running.remove(pipeline)
+                if running:
+                    time.sleep(Pipeline.POLL)
+        finally:
+            for pipeline in running:
+                pipeline.Kill()
+        return None
+################################################################################
 
-        * ParameterName = The name of a parameter, like: ni, nt, sw2,...
+
+class SpectrumStore():
+    """
+    Chunked, compressed spectrum file (.nmrz) with a preview pyramid
+
+    The spectrum is cut into the tiles of the UCSF files, every tile is
+    compressed on its own (zlib of the shuffled float bytes). Level 0 is
+    the full spectrum, every next level is half the size along every
+    axis (the value with the largest magnitude of a block, so the peaks
+    stay visible) down to a single tile. Only the tiles of the requested
+    region and level are read, a preview of a large spectrum is a few kB.
+
+    File: 'NMRZ0001', tiles, JSON footer (axes, shape, tile size and
+    tile offsets of the levels), footer length (8 bytes), 'NMRZ0001'
+
+    Example:
+
+        SpectrumStore.Write('hsqc.nmrz', data, axes)
+        Store = SpectrumStore('hsqc.nmrz')
+        region = Store.Read((slice(100, 200), slice(0, 512)))
+        preview = Store.Read(level = Store.levels - 1)
+    """
+    MAGIC = 'NMRZ0001'
+    # Mantissa bits of the preview levels (0.1 % precision)
+    PREVIEW_BITS = 10
+    #####################################################
+    def __init__(self, FileName):
         """
-        if ParameterName in self.__parameter__:
-            returnvalue = self.__parameter__[ParameterName]
+        Parameters:
+
+        * FileName = the .nmrz file, only its footer is read
+        """
+        self.FileName = FileName
+        self.source = open(FileName, 'rb')
+        self.source.seek(-16, 2)
+        length, magic = struct.unpack('>Q8s', self.source.read(16))
+        if magic != self.MAGIC:
+            self.source.close()
+            raise ValueError(FileName + ' is not a .nmrz file')
+        self.source.seek(-16 - length, 2)
+        footer = json.loads(self.source.read(length))
+        self.axes = footer['axes']
+        self.pyramid = footer['levels']
+        self.levels = len(self.pyramid)
+        self.shape = tuple(self.pyramid[0]['shape'])
+        # Bytes read from the file so far
+        self.bytes_read = 16 + length
+        return None
+    #####################################################
+    @staticmethod
+    def Write(FileName, data, axes, tile_points = 8192, compression = 6, bits = None):
+        """
+        Write data (1D, 2D or 3D, the last axis is the direct dimension)
+        with the axes of Read_ucsf(), FileName.part is renamed at the end
+
+        Parameters:
+        ===========
+            * FileName = Name of the output file, like: test.nmrz
+            * data = the real spectrum
+            * axes = [{'label', 'obs', 'sw', 'car', ...}] of the axes of data
+            * tile_points = maximum number of values in a tile
+            * compression = zlib level, 1 (fast) ... 9 (small)
+            * bits = mantissa bits kept of the full spectrum (1 ... 23, the
+                     rest is rounded off and compresses away), None =
+                     lossless, the previews always keep PREVIEW_BITS
+        """
+        data = numpy.asarray(data, dtype = numpy.float32)
+        output = open(FileName + '.part', 'wb')
+        output.write(SpectrumStore.MAGIC)
+        position = len(SpectrumStore.MAGIC)
+        levels = []
+        while True:
+            tiles = NmrPipeEngine.Tile_sizes(data.shape, tile_points)
+            offsets = []
+            for index in numpy.ndindex(*[(size + tile - 1) / tile
+                                         for size, tile in zip(data.shape, tiles)]):
+                block = data[tuple([slice(i * tile, (i + 1) * tile)
+                                    for i, tile in zip(index, tiles)])]
+                if bits:
+                    block = SpectrumStore.Round(block, bits)
+                content = zlib.compress(SpectrumStore.Shuffle(block), compression)
+                output.write(content)
+                offsets.append([position, len(content)])
+                position += len(content)
+            levels.append({'shape': list(data.shape), 'tile': tiles, 'offsets': offsets})
+            if data.size <= tile_points:
+                break
+            data = SpectrumStore.Downsample(data)
+            bits = min(bits or SpectrumStore.PREVIEW_BITS, SpectrumStore.PREVIEW_BITS)
+        footer = json.dumps({'axes': axes, 'levels': levels})
+        output.write(footer)
+        output.write(struct.pack('>Q8s', len(footer), SpectrumStore.MAGIC))
+        output.close()
+        os.rename(FileName + '.part', FileName)
+        return None
+    #####################################################
+    @staticmethod
+    def Shuffle(block):
+        """
+        Returns the bytes of the float32 values grouped by byte position,
+        the exponent bytes of neighbouring values compress much better
+        """
+        return numpy.ascontiguousarray(block, dtype = '<f4').view(numpy.uint8).reshape(
+                                       -1, 4).T.tostring()
+    #####################################################
+    @staticmethod
+    def Round(block, bits):
+        """
+        Returns the values rounded to bits of the 23 mantissa bits, the
+        other bits are zeros
+        """
+        if bits >= 23:
+            return block
+        values = numpy.array(block, dtype = numpy.float32).view(numpy.uint32)
+        values += numpy.uint32(1 << (22 - bits))
+        values &= numpy.uint32((0xffffffff << (23 - bits)) & 0xffffffff)
+        return values.view(numpy.float32)
+    #####################################################
+    @staticmethod
+    def Unshuffle(content, shape):
+        return numpy.frombuffer(content, dtype = numpy.uint8).reshape(4, -1).T.copy().view(
+                                '<f4').reshape(shape)
+    #####################################################
+    @staticmethod
+    def Downsample(data):
+        """
+        Returns the half size data, the largest magnitude value of every
+        2 x 2 (x 2) block
+        """
+        padded = [size + size % 2 for size in data.shape]
+        if padded != list(data.shape):
+            data = numpy.pad(data, [(0, size % 2) for size in data.shape], 'edge')
+        shape = []
+        for size in padded:
+            shape.extend([size / 2, 2])
+        # [n1, 2, n2, 2, ...] => [n1, n2, ..., 2 * 2 * ...]
+        blocks = data.reshape(shape).transpose(range(0, 2 * data.ndim, 2) +
+                                               range(1, 2 * data.ndim, 2))
+        size = blocks.shape[:data.ndim]
+        blocks = blocks.reshape(-1, 2 ** data.ndim)
+        return blocks[numpy.arange(blocks.shape[0]),
+                      abs(blocks).argmax(axis = 1)].reshape(size)
+    #####################################################
+    def Tile(self, level, index):
+        """
+        Returns one tile of a level, index = tile position along every axis
+        """
+        pyramid = self.pyramid[level]
+        counts = [(size + tile - 1) / tile
+                  for size, tile in zip(pyramid['shape'], pyramid['tile'])]
+        offset, length = pyramid['offsets'][numpy.ravel_multi_index(index, counts)]
+        self.source.seek(offset)
+        content = zlib.decompress(self.source.read(length))
+        self.bytes_read += length
+        return self.Unshuffle(content, [min(tile, size - i * tile) for i, tile, size
+                                        in zip(index, pyramid['tile'], pyramid['shape'])])
+    #####################################################
+    def Read(self, region = None, level = 0):
+        """
+        Returns a region of a level, only its tiles are read
+
+        Parameters:
+        ===========
+            * region = slice (step 1) of every axis in the points of the
+                       level, None = the whole level
+            * level = 0 (full size) ... levels - 1 (smallest preview)
+        """
+        pyramid = self.pyramid[level]
+        shape = pyramid['shape']
+        if region is None:
+            region = [slice(None)] * len(shape)
+        limits = [part.indices(size)[:2] for part, size in zip(region, shape)]
+        result = numpy.zeros([max(last - first, 0) for first, last in limits],
+                             dtype = numpy.float32)
+        if not result.size:
+            return result
+        ranges = [range(first / tile, (last - 1) / tile + 1)
+                  for (first, last), tile in zip(limits, pyramid['tile'])]
+        for index in itertools.product(*ranges):
+            tile = self.Tile(level, index)
+            target = []
+            source = []
+            for i, size, (first, last), length in zip(index, pyramid['tile'], limits, tile.shape):
+                start = max(first, i * size)
+                stop = min(last, i * size + length)
+                target.append(slice(start - first, stop - first))
+                source.append(slice(start - i * size, stop - i * size))
+            result[tuple(target)] = tile[tuple(source)]
+        return result
+    #####################################################
+    def Scale(self, axis, level = 0):
+        """
+        Returns the chemical shifts (ppm) of the points of an axis of a level
+        """
+        description = self.axes[axis]
+        size = self.pyramid[level]['shape'][axis]
+        # A point of a level is 2 ** level points of the full spectrum
+        points = (numpy.arange(size) + 0.5) * self.shape[axis] / float(size) - 0.5
+        return (description['car'] + description['sw'] / description['obs'] *
+                (self.shape[axis] / 2 - points) / float(self.shape[axis]))
+    #####################################################
+    def Preview(self, width = 78, height = 30, contours = ' .:-=+*#%@'):
+        """
+        Returns a text contour map of the spectrum (the largest magnitude
+        projection of a 3D), from the smallest level that is large enough
+        """
+        level = self.levels - 1
+        while level > 0 and (self.pyramid[level]['shape'][-1] < width or
+                             (len(self.shape) > 1 and
+                              self.pyramid[level]['shape'][-2] < height)):
+            level -= 1
+        data = self.Read(level = level)
+        if data.ndim == 1:
+            data = data[numpy.newaxis]
+        if data.ndim > 2:
+            flat = data.reshape(data.shape[0], -1)
+            data = flat[abs(flat).argmax(axis = 0),
+                        numpy.arange(flat.shape[1])].reshape(data.shape[1:])
+        rows = numpy.linspace(0, data.shape[0], min(height, data.shape[0]) + 1).astype(int)
+        columns = numpy.linspace(0, data.shape[1], min(width, data.shape[1]) + 1).astype(int)
+        cells = numpy.array([[abs(data[rows[i]:rows[i + 1], columns[j]:columns[j + 1]]).max()
+                              for j in range(len(columns) - 1)]
+                             for i in range(len(rows) - 1)])
+        noise = 1.4826 * numpy.median(abs(data - numpy.median(data)))
+        floor = max(5.0 * noise, 1e-30)
+        top = max(cells.max(), floor * 1.0001)
+        steps = numpy.log(numpy.maximum(cells, floor) / floor) / numpy.log(top / floor)
+        characters = numpy.array(list(contours))[
+                     numpy.minimum((steps * (len(contours) - 1)).round().astype(int),
+                                   len(contours) - 1)]
+        scale = self.Scale(len(self.shape) - 1, level)
+        lines = ['{0}: {1}, level {2} of {3}, {4} kB read'.format(
+                 self.FileName, ' x '.join([str(size) for size in self.shape]),
+                 level, self.levels - 1, self.bytes_read / 1024)]
+        if len(self.shape) > 1:
+            shifts = self.Scale(len(self.shape) - 2, level)
+            lines.append('{0} {1:.2f} ... {2:.2f} ppm (rows), {3} {4:.2f} ... {5:.2f} ppm'.format(
+                         self.axes[-2]['label'], shifts[0], shifts[-1],
+                         self.axes[-1]['label'], scale[0], scale[-1]))
         else:
-            print '\n------------\nNo parameter like "'+ParameterName+'" in the procpar file\n------------\n'
-            #exit()
-            returnvalue = None
-        return returnvalue
+            lines.append('{0} {1:.2f} ... {2:.2f} ppm'.format(self.axes[-1]['label'],
+                                                            scale[0], scale[-1]))
+        lines.extend([''.join(row) for row in characters])
+        return '\n'.join(lines)
+    #####################################################
+    def Close(self):
+        self.source.close()
+        return None
+    #####################################################
+    @staticmethod
+    def From_arguments(argumentlist):
+        """
+        Run a 'preview' command line, see 'help'
+        """
+        words = argumentlist[argumentlist.index('preview') + 1:]
+        keywords = {'width': 78, 'height': 30}
+        for i, word in enumerate(words[1:-1]):
+            if word in keywords:
+                keywords[word] = int(words[i + 2])
+        try:
+            Store = SpectrumStore(words[0])
+        except (IndexError, IOError, ValueError), exception:
+            print ''.join(('\n-----------\nNo .nmrz file to preview (', str(exception),
+                           ')!\n-----------\n'))
+            exit()
+        print Store.Preview(keywords['width'], keywords['height'])
+        Store.Close()
+        return None
+################################################################################
+
+
+class RelaxationSeries():
+    """
+    Peak picking and exponential fitting of the planes of an arrayed
+    (relaxation) experiment, every peak at once
+
+    The peaks are the local maxima of the reference plane above Threshold
+    times its noise. Their heights are read from every plane in one step
+    and I(t) = A * exp(-R * t) is fitted to all of them together (weighted
+    Gauss-Newton with the noise of every plane), the errors of A and R
+    come from the covariance matrix.
+
+    Example:
+
+        Series = RelaxationSeries(['T1_1.ucsf', 'T1_2.ucsf', 'T1_3.ucsf'],
+                                  [0.01, 0.25, 0.5])
+        Series.Write('T1_rates.txt')
+    """
+    #####################################################
+    def __init__(self, FileNames, Delays, Reference = 0, Threshold = 8.0,
+                 Iterations = 20):
+        """
+        Parameters:
+
+        * FileNames  = .ucsf files of the planes, in the order of the delays
+        * Delays     = values of the arrayed parameter of the planes
+        * Reference  = index of the plane for the peak picking, default = 0
+        * Threshold  = peak picking level in noise units, default = 8
+        * Iterations = number of Gauss-Newton steps, default = 20
+        """
+        planes = []
+        for FileName in FileNames:
+            data, self.axes = NmrPipeEngine.Read_ucsf(FileName)
+            planes.append(data)
+        self.planes = numpy.array(planes)
+        self.delays = numpy.array([float(delay) for delay in Delays])
+        self.noise = self.Noise(self.planes)
+        self.reference = Reference
+        self.peaks = self.Pick(self.planes[Reference],
+                               Threshold * self.noise[Reference])
+        # [plane, peak]
+        self.heights = self.planes[(slice(None),) + tuple(self.peaks.T)]
+        self.fit = self.Fit(self.delays, self.heights, self.noise, Iterations)
+        return None
+    #####################################################
+    def Noise(self, planes):
+        """
+        Returns the noise (robust standard deviation) of every plane
+        """
+        flat = planes.reshape(planes.shape[0], -1)
+        deviation = abs(flat - numpy.median(flat, axis = 1)[:, numpy.newaxis])
+        return 1.4826 * numpy.median(deviation, axis = 1)
+    #####################################################
+    def Pick(self, plane, level):
+        """
+        Returns the [[index, ...], ...] positions of the local maxima above
+        level, every point is compared to all of its neighbours at once
+        """
+        padded = numpy.pad(plane, 1, 'constant', constant_values = -numpy.inf)
+        maximum = plane > level
+        for shift in numpy.ndindex(*((3,) * plane.ndim)):
+            if shift == (1,) * plane.ndim:
+                continue
+            neighbour = padded[tuple([slice(start, start + size)
+                                      for start, size in zip(shift, plane.shape)])]
+            maximum &= plane >= neighbour
+        return numpy.argwhere(maximum)
+    #####################################################
+    def Fit(self, delays, heights, noise, iterations):
+        """
+        Fit A * exp(-R * t) to every column of heights
+
+        The start values come from a weighted linear fit of the logarithm,
+        the 2 x 2 normal equations of the peaks are solved together.
+
+        Returns:
+        ========
+            * {'A', 'R', 'A_error', 'R_error', 'chi2'} arrays of the peaks,
+              chi2 is the reduced chi square
+        """
+        t = delays[:, numpy.newaxis]
+        weight = (1.0 / noise ** 2)[:, numpy.newaxis] * numpy.ones(heights.shape)
+        # ln(I) = ln(A) - R * t, weighted by I^2 / noise^2
+        logweight = numpy.where(heights > 0, heights ** 2, 0.0) * weight
+        logheight = numpy.log(numpy.where(heights > 0, heights, 1.0))
+        sw, st, stt = [(logweight * t ** power).sum(axis = 0) for power in (0, 1, 2)]
+        sy, sty = (logweight * logheight).sum(axis = 0), (logweight * t * logheight).sum(axis = 0)
+        determinant = sw * stt - st ** 2
+        with numpy.errstate(divide = 'ignore', invalid = 'ignore'):
+            R = -(sw * sty - st * sy) / determinant
+            A = numpy.exp((stt * sy - st * sty) / determinant)
+            for iteration in range(iterations + 1):
+                decay = numpy.exp(-R * t)
+                residual = heights - A * decay
+                # Derivatives by A and by R
+                dA = decay
+                dR = -A * t * decay
+                a = (weight * dA * dA).sum(axis = 0)
+                b = (weight * dA * dR).sum(axis = 0)
+                c = (weight * dR * dR).sum(axis = 0)
+                determinant = a * c - b ** 2
+                if iteration == iterations:
+                    break
+                g1 = (weight * dA * residual).sum(axis = 0)
+                g2 = (weight * dR * residual).sum(axis = 0)
+                A = A + (c * g1 - b * g2) / determinant
+                R = R + (a * g2 - b * g1) / determinant
+            chi2 = (weight * residual ** 2).sum(axis = 0) / max(len(delays) - 2, 1)
+            return {'A'       : A,
+                    'R'       : R,
+                    'A_error' : numpy.sqrt(c / determinant),
+                    'R_error' : numpy.sqrt(a / determinant),
+                    'chi2'    : chi2}
+    #####################################################
+    def PPM(self, peaks):
+        """
+        Returns the chemical shifts of the positions, [[w1, w2 ...], ...]
+        """
+        shifts = []
+        for dimension, axis in enumerate(self.axes):
+            shifts.append(axis['car'] + axis['sw'] / axis['obs'] *
+                          (axis['size'] / 2 - peaks[:, dimension]) / float(axis['size']))
+        return numpy.array(shifts).T
+    #####################################################
+    def Write(self, FileName):
+        """
+        Write the table of the rates, the strongest peak first
+        """
+        shifts = self.PPM(self.peaks)
+        output = open(FileName, 'w')
+        output.write('# {0} planes, delays: {1}\n'.format(len(self.delays),
+                     ' '.join(['{0:g}'.format(delay) for delay in self.delays])))
+        output.write('#' + ''.join(['{0:>10}'.format('w{0} ({1})'.format(dimension + 1, axis['label']))
+                                    for dimension, axis in enumerate(self.axes)]) +
+                     '{0:>14}{1:>12}{2:>12}{3:>10}\n'.format('height', 'R', 'R error', 'chi2'))
+        heights = self.heights[self.reference]
+        for peak in numpy.argsort(-heights):
+            output.write(' ' + ''.join(['{0:10.3f}'.format(shift) for shift in shifts[peak]]) +
+                         '{0:14.5g}{1:12.5g}{2:12.5g}{3:10.3f}\n'.format(
+                         heights[peak], self.fit['R'][peak],
+                         self.fit['R_error'][peak], self.fit['chi2'][peak]))
+        output.close()
+        return None
 ################################################################################
 
 
@@ -106,7 +2826,17 @@ class Convert_HSQC():
     Note:
         * Last value must be the proton phase correction
     """
-    def __init__(self, argumentlist, FidFileName = 'fid', Path = './'):
+    def __init__(self, argumentlist, FidFileName = 'fid', Path = './', Temperature = None):
+        """
+        Parameters:
+
+        * argumentlist = command line like list of flags, see 'help'
+        * FidFileName  = name of the fid file, default = 'fid'
+        * Path         = experiment directory, all files are read and
+                         written there, default = './'
+        * Temperature  = measurement temperature in C, overrides the procpar
+                         value and the interactive 'temp' question
+        """
         #
         if 'help' in argumentlist:
             print ('\n-------------------------------------------------\n'
@@ -116,16 +2846,94 @@ class Convert_HSQC():
                    'noplot    = use "noplot" flag not to see nmrDraw and Sparky plots\n'
                    'nocleanup = keeping all files\n'
                    'extract   = proton dimension extraction, next parameter must be [6.8,10.0]\n'
-                   'p0 phase  = proton phase correction value must be the last parameter\n')
+                   'lporder   = linear prediction order, next parameter is the order (8)\n'
+                   'lppred    = number of predicted points, next parameter is the number\n'
+                   'native    = process in-process with numpy instead of var2pipe/nmrPipe\n'
+                   '            (non uniformly sampled 2D data with a sampling.sch file is\n'
+                   '            always processed natively, with IST reconstruction)\n'
+                   'stream    = 1D (arrayed) data is read and processed natively in\n'
+                   '            batches, the memory does not depend on the number of fids\n'
+                   'watch     = process during the acquisition (native), the .ucsf files\n'
+                   '            are refreshed with the new increments, an optional next\n'
+                   '            parameter is the check interval in seconds (60)\n'
+                   'nocache   = always process, do not use the result cache\n'
+                   'keepprephase = (native, opt-in) keep the spectrum before the proton\n'
+                   '            phase correction (.prephase.npy, hypercomplex for 2D), a new\n'
+                   '            proton phase only applies the phase and the baseline\n'
+                   '            correction to it\n'
+                   'timeout   = stop a processing step (pipeline) running longer, next\n'
+                   '            parameter is the limit in seconds (required, a number)\n'
+                   'store     = also write the spectra as .nmrz files: compressed tiles\n'
+                   '            and preview levels, only the viewed region is read\n'
+                   'fit       = pick the peaks of the first plane of an arrayed experiment\n'
+                   '            and fit their exponential decay, <experiment>_rates.txt\n'
+                   'autophase = automatic proton phase correction (p0 and p1), the\n'
+                   '            p0 phase parameter is added to the automatic value\n'
+                   'p0 phase  = proton phase correction value must be the last parameter\n'
+                   '\n'
+                   'Usage: hsqc.com batch <directories or globs> [jobs N] [temp T] [phase P]\n'
+                   '                      [list file] [summary file] [flags]\n'
+                   'jobs      = number of parallel processes, default = number of cores\n'
+                   'temp      = measurement temperature for every directory (no question)\n'
+                   'phase     = proton p0 phase correction for every directory\n'
+                   'list      = file with lines of "directory [temperature [phase]]"\n'
+                   'summary   = JSON file of the aggregated convert_nmr.json reports (time,\n'
+                   '            CPU, memory and I/O of every step) of the directories\n'
+                   '\n'
+                   'Usage: hsqc.com index <archive folder> [database]\n'
+                   '       hsqc.com query <database> [name=value] [name=min:max] ...\n'
+                   'index     = update the SQLite index of every procpar below the folder\n'
+                   'query     = print the matching experiment directories, like:\n'
+                   '            query archive.sqlite seqfil=gNhsqc temp=24.5:25.5 ni=129:\n'
+                   '\n'
+                   'Usage: hsqc.com daemon [status | stop] [socket file]\n'
+                   '       hsqc.com submit <directory> [priority N] [temp T] [phase P]\n'
+                   '                       [wait] [socket file] [flags]\n'
+                   'daemon    = start the processing daemon (keeps the procpar data,\n'
+                   '            windows and FFT plans warm), or print its jobs, or stop it\n'
+                   'submit    = queue a directory, higher priority jobs run first, "wait"\n'
+                   '            returns when the job is finished\n'
+                   'socket    = socket of the daemon, default = ~/.nmr_procy.sock\n'
+                   '\n'
+                   'Usage: hsqc.com preview <file.nmrz> [width W] [height H]\n'
+                   'preview   = text contour map of a .nmrz spectrum from its preview levels\n')
             exit()
         #
         self.Path            = Path
         self.FidFileName     = FidFileName
         self.ConvertFileName = 'convert_nmr.com'
+        # Time, CPU, memory and I/O of the steps
+        self.ReportFileName  = 'convert_nmr.json'
+        self.report          = ProcessingReport()
         #
         self.__temporary_folder = 'data'
-        #
-        self.PropcarInformation = ProcparData(Path = Path)
+        # Every run writes its report, a failed one with the error
+        self.error = None
+        try:
+            self.Process(argumentlist, Temperature)
+        except BaseException, exception:
+            if self.error:
+                pass
+            elif isinstance(exception, SystemExit):
+                self.error = 'stopped, see the output of the processing'
+            else:
+                self.error = '{0}: {1}'.format(exception.__class__.__name__, exception)
+            self.report.Write(self.Path + self.ReportFileName, self.error)
+            raise
+        self.report.Write(self.Path + self.ReportFileName)
+        self.ByeBye()
+        return None
+    ###################
+    def Process(self, argumentlist, Temperature = None):
+        """
+        The steps of the processing, the parameters are the same as of
+        __init__
+        """
+        start = self.report.Start()
+        self.PropcarInformation = ProcparData.Open(Path = self.Path)
+        self.report.Stop('procpar', start)
+        # Every procpar value used for the processing (part of the cache key)
+        self.used_parameters = {}
         #
         #
         if len(argumentlist) > 1:
@@ -133,13 +2941,19 @@ class Convert_HSQC():
         else:
             protonphase = '0.0'
         self.temp = self.Info('temp')[0]
-        if 'temp' in argumentlist:
+        if Temperature is not None:
+            self.temp = float(Temperature)
+        elif 'temp' in argumentlist:
             self.SetTemperature()
         ########
         if self.Info('ni') and self.Info('ni2'):
             self._2D = self.Info('ni')[0] != '1' or self.Info('ni2')[0] != '1'
         else:
             self._2D = False
+        # Triple resonance 3D: both indirect dimensions are incremented
+        self._3D = self._2D and self.Info('ni')[0] != '1' and self.Info('ni2')[0] != '1'
+        # Measured t1 increments of non uniformly sampled data
+        self.schedule = self.Sampling_schedule()
         ######
         if 'extract' in argumentlist:
             ex = eval(argumentlist[argumentlist.index('extract') + 1])
@@ -154,17 +2968,108 @@ class Convert_HSQC():
                 # If it is a 1D then only extract if needed!
                 ex = None
         #
+        lp = {}
+        for keyword, option in (('lporder', 'LP_order'), ('lppred', 'LP_prediction')):
+            if keyword in argumentlist:
+                lp[option] = int(argumentlist[argumentlist.index(keyword) + 1])
+        # Seconds between two checks of the fid during the acquisition
+        self.watch = None
+        if 'watch' in argumentlist:
+            self.watch = 60.0
+            index = argumentlist.index('watch') + 1
+            # The interval is optional, the last argument is the phase
+            if index < len(argumentlist) - 1:
+                try:
+                    self.watch = float(argumentlist[index])
+                except ValueError:
+                    pass
+        # Seconds a processing step may run, the limit is required
+        timeout = None
+        if 'timeout' in argumentlist:
+            index = argumentlist.index('timeout') + 1
+            try:
+                # The last argument is the phase, never the limit
+                if index >= len(argumentlist) - 1:
+                    raise ValueError
+                timeout = float(argumentlist[index])
+                if timeout <= 0.0:
+                    raise ValueError
+            except ValueError:
+                print ''.join(('\n-----------\nThe "timeout" flag needs the limit in ',
+                               'seconds as the next parameter, like: timeout 600 <phase>',
+                               '\n-----------\n'))
+                exit()
         #
+        start = self.report.Start()
         self.CreateConverFile(userphase = protonphase, SecondDimension='N', Fastprocess='fast' in argumentlist, Extract=ex,
-                              Trosy_experiment = 'trosy' in self.Info('seqfil')[0])
+                              Trosy_experiment = 'trosy' in self.Info('seqfil')[0],
+                              Autophase = 'autophase' in argumentlist, **lp)
+        self.report.Stop('script', start)
         #
-        self.RunConvertFile(not 'noplot' in argumentlist, not 'noplot' in argumentlist, 'nocleanup' in argumentlist)
+        native = 'native' in argumentlist
+        # Large 1D series are processed batch by batch
+        self.stream = 'stream' in argumentlist and not self._2D
+        # The phase independent intermediate for a quick new proton phase
+        self.keepprephase = 'keepprephase' in argumentlist
+        if self.stream:
+            native = True
+        elif 'stream' in argumentlist:
+            print 'NOTE: "stream" is only used for 1D data'
+        if self.schedule and not native:
+            # var2pipe expects uniformly sampled increments
+            print 'NOTE: Non uniformly sampled data, processed natively with IST reconstruction'
+            native = True
+        if self.watch:
+            start = self.report.Start()
+            self.Watch(self.watch)
+            self.report.Stop('watch', start)
+            # The complete data is processed like the refreshed planes
+            native = True
         #
-        self.ByeBye()
+        start = self.report.Start()
+        if 'nocache' in argumentlist:
+            cache = None
+        else:
+            cache = ResultCache()
+            # A changed script or processing code never restores old results
+            key = cache.Key(self.Path + self.FidFileName, self.used_parameters,
+                            self.parameters, native,
+                            'nocleanup' in argumentlist,
+                            open(self.Path + self.ConvertFileName).read(),
+                            cache.Code_hash())
+        restored = cache and cache.Restore(key, self.Path)
+        self.report.Stop('cache lookup', start)
+        if restored:
+            print 'Identical processing found in the cache, results restored'
+            if not 'noplot' in argumentlist and os.path.exists(self.Output_files('.dat')[0]):
+                os.system('nmrDraw '+ self.Output_files('.dat')[0])
+        else:
+            self.RunConvertFile(not 'noplot' in argumentlist, not 'noplot' in argumentlist, 'nocleanup' in argumentlist,
+                                native = native, timeout = timeout)
+            if cache:
+                results = self.Output_files('.ucsf')
+                if 'nocleanup' in argumentlist:
+                    results += self.Output_files('.dat')
+                if not [name for name in results if not os.path.exists(name)]:
+                    start = self.report.Start()
+                    cache.Store(key, results)
+                    self.report.Stop('cache store', start)
+        #
+        if 'store' in argumentlist:
+            start = self.report.Start()
+            self.Write_store()
+            self.report.Stop('store', start)
+        #
+        if 'fit' in argumentlist:
+            start = self.report.Start()
+            self.Fit_relaxation()
+            self.report.Stop('fit', start)
         return None
     ###################
     def Info(self, paramatername):
-        return self.PropcarInformation.parameter(paramatername)
+        value = self.PropcarInformation.parameter(paramatername)
+        self.used_parameters[paramatername] = value
+        return value
     ###################
     def Get_H2O_chemical_shift(self, temperature):
         """
@@ -174,8 +3079,9 @@ class Convert_HSQC():
     ###################
     def Get_Current_Dir(self):
         """
+        Returns the name of the experiment directory (self.Path)
         """
-        return os.getcwd().split('/')[-1]
+        return os.path.basename(os.path.abspath(self.Path))
     ###################
     def SetTemperature(self):
         self.temp = ''
@@ -226,19 +3132,128 @@ class Convert_HSQC():
                             pass
         return [Xp0,Xp1,Yp0,Yp1]
     ###################
-    def Get_carrier_in_PPM(self, Proton_carrier_PPM, Frequency_H, Frequency_X, Nucleus_type_X):
+    def Get_carrier_in_PPM(self, Proton_carrier_PPM, Frequency_H, Frequency_X, Nucleus_type_X):
+        """
+        Returns the carrier in ppm
+
+        1H, 13C and 15N chemical shift referencing in biomolecular NMR.
+        Wishart DS, Bigam CG, Yao J, Abildgaard F, Dyson HJ, Oldfield E, Markley JL, Sykes BD.
+        J Biomol NMR. 1995 Sep;6(2):135-40. PMID: 8589602
+
+        http://www.bmrb.wisc.edu/ref_info/cshift.html
+        """
+        RATIOS = {'H':1.0, 'N':0.101329118, 'C':0.251449530}
+        #
+        return Frequency_X * (1E+6 + Proton_carrier_PPM) / (RATIOS[Nucleus_type_X] * Frequency_H) - 1E+6
+    ###################
+    def Get_Array_Parameter(self):
+        """
+        Returns the arrayed parameter besides 'phase' or 'single_hsqc'
+        """
+        arrayed = 'single_hsqc'
+        for element in self.Info('array')[0][1:-1].split(','):
+            if element and not 'phase' in element:
+                arrayed = element
+        return arrayed
+    ###################
+    def Sampling_schedule(self):
+        """
+        Returns the measured t1 increments of non uniformly sampled data in
+        the order of the fid (sampling.sch of VnmrJ), None if the data is
+        uniformly sampled
+        """
+        FileName = self.Path + 'sampling.sch'
+        if not self._2D or not os.path.exists(FileName):
+            return None
+        # Not every procpar has the parameter, no warning about it
+        if ('sampling' in self.PropcarInformation.names() and
+            'sparse' not in self.Info('sampling')[0]):
+            # Left behind by an earlier non uniformly sampled setup
+            return None
+        lines = [line for line in open(FileName) if line.strip()]
+        if not lines:
+            return None
+        try:
+            schedule = [[int(word) for word in line.split()] for line in lines]
+        except ValueError:
+            schedule = []
+        if self._3D or not schedule or [indices for indices in schedule if len(indices) != 1]:
+            print ''.join(('\n-----------\nOnly 2D sampling schedules (one increment ',
+                           'per line) are supported, please check ', FileName,
+                           '!\n-----------\n'))
+            exit()
+        return [indices[0] for indices in schedule]
+    ###################
+    def Acquired_increments(self):
         """
-        Returns the carrier in ppm
+        Returns the number of complete and of all increments of the fid
 
-        1H, 13C and 15N chemical shift referencing in biomolecular NMR.
-        Wishart DS, Bigam CG, Yao J, Abildgaard F, Dyson HJ, Oldfield E, Markley JL, Sykes BD.
-        J Biomol NMR. 1995 Sep;6(2):135-40. PMID: 8589602
+        An increment is one t1 point (cosine and sine fids of every arrayed
+        plane) of a 2D, or one fid of a 1D. During the acquisition only the
+        blocks completely written into the fid file are counted.
+        """
+        fid = VarianFid(self.Path, self.FidFileName)
+        if self._3D:
+            fids = 4 * int(self.Info('ni')[0])
+            total = int(self.Info('ni2')[0])
+        elif self._2D:
+            arrayed = self.Get_Array_Parameter()
+            fids = 2
+            if arrayed != 'single_hsqc':
+                fids *= len(self.Info(arrayed)[0].split())
+            total = int(self.Info('ni')[0])
+            if self.schedule:
+                total = len(self.schedule)
+        else:
+            fids = 1
+            total = int(self.Info('arraydim')[0])
+        return fid.complete_blocks * fid.ntraces / fids, total
+    ###################
+    def FidData(self, increments = None):
+        """
+        Returns the fid data as a memory mapped view, no conversion needed
 
-        http://www.bmrb.wisc.edu/ref_info/cshift.html
+        The shape follows the var2pipe dimensions of the scripts:
+            * 1D         = (fids, np / 2)
+            * 2D         = (2 * ni, np / 2)
+            * pseudo 3D  = (2 * ni, arrayed values, np / 2)
+            * 3D         = (ni2, ni, 2, 2, np / 2), the two phase cycles
+                           in the order of the 'array' parameter
+
+        Parameters:
+        ===========
+            * increments = only the first increments (running acquisition),
+                           see Acquired_increments(), None = all of them
         """
-        RATIOS = {'H':1.0, 'N':0.101329118, 'C':0.251449530}
-        #
-        return Frequency_X * (1E+6 + Proton_carrier_PPM) / (RATIOS[Nucleus_type_X] * Frequency_H) - 1E+6
+        fid = VarianFid(self.Path, self.FidFileName)
+        points = int(self.Info('np')[0]) / 2
+        if not self._2D:
+            shape = (fid.complete_blocks * fid.ntraces, points)
+            if increments is not None:
+                shape = (increments, points)
+        else:
+            if increments is None:
+                increments = int(self.Info('ni2' if self._3D else 'ni')[0])
+                if self.schedule:
+                    increments = len(self.schedule)
+                complete = True
+            else:
+                complete = False
+            arrayed = self.Get_Array_Parameter()
+            if self._3D:
+                shape = (increments, int(self.Info('ni')[0]), 2, 2, points)
+            elif arrayed == 'single_hsqc':
+                shape = (2 * increments, points)
+            else:
+                shape = (2 * increments, len(self.Info(arrayed)[0].split()), points)
+            expected = reduce(lambda a, b: a * b, shape[:-1])
+            if complete and fid.complete_blocks * fid.ntraces != expected:
+                print ''.join(('\n-----------\nThe fid file contains ',
+                               str(fid.complete_blocks * fid.ntraces),
+                               ' fids instead of ', str(expected),
+                               '! Please check it!\n-----------\n'))
+                exit()
+        return fid.Data(shape)
     ###################
     def script_for_regular_1D(self, parameters):
         """
@@ -291,7 +3306,7 @@ class Convert_HSQC():
                   '| nmrPipe -fn PS -p0 {_p0x_:>6s} -p1 {_p1x_:>6s} -di -verb        \\\n'
                   '{Ext}| nmrPipe -fn EXT {ProtonExtraction:27s}           \\\n'
                   '| nmrPipe -fn TP                                        \\\n'
-                  '{LP}| nmrPipe -fn LP -fb                                    \\\n'
+                  '{LP}| nmrPipe -fn LP -fb {LPoptions:35s}\\\n'
                   '| nmrPipe -fn SP -off 0.35 -end 1.0 -pow 2 -c {_c_:5s}     \\\n'
                   '| nmrPipe -fn ZF -auto -zf 2                            \\\n'
                   '| nmrPipe -fn FT                                        \\\n'
@@ -327,7 +3342,7 @@ class Convert_HSQC():
                   '{Ext}| nmrPipe -fn EXT {ProtonExtraction:27s}           \\\n'
                   '| nmrPipe -fn TP                                        \\\n'
                   '| nmrPipe -fn ZTP                                       \\\n'
-                  '{LP}| nmrPipe -fn LP -fb                                    \\\n'
+                  '{LP}| nmrPipe -fn LP -fb {LPoptions:35s}\\\n'
                   '| nmrPipe -fn SP -off 0.35 -end 1.0 -pow 2 -c {_c_:5s}     \\\n'
                   '| nmrPipe -fn ZF -auto -zf 2                            \\\n'
                   '| nmrPipe -fn FT                                        \\\n'
@@ -338,12 +3353,58 @@ class Convert_HSQC():
                   '| pipe2xyz -x -out {_processedfile_} -verb -ov\n').format(**parameters)
         return script
     ###################
+    def script_for_regular_3D(self, parameters):
+        """
+        """
+        script = ('#!/bin/csh\n'
+                  '\n'
+                  'var2pipe -in {_fidfile_} -aqORD {_aqORD_} \\\n'
+                  '     -xN    {_xN____:>12s}     -yN    {_yN____:>12s}    -zN    {_zN____:>12s}    \\\n'
+                  '     -xT    {_xT____:>12s}     -yT    {_yT____:>12s}    -zT    {_zT____:>12s}    \\\n'
+                  '     -xMODE {_xMODE_:>12s}     -yMODE {_yMODE_:>12s}    -zMODE {_zMODE_:>12s}    \\\n'
+                  '     -xSW   {_sw____:>12s}     -ySW   {_sw2___:>12s}    -zSW   {_sw3___:>12s}    \\\n'
+                  '     -xOBS  {_xobs__:>12s}     -yOBS  {_yobs__:>12s}    -zOBS  {_zobs__:>12s}    \\\n'
+                  '     -xCAR  {_XCAR__:>12s}     -yCAR  {_yCAR__:>12s}    -zCAR  {_zCAR__:>12s}    \\\n'
+                  '     -xLAB  {_xlab__:>12s}     -yLAB  {_ylab__:>12s}    -zLAB  {_zlab__:>12s}    \\\n'
+                  '     -ndim  {_ndim__:>12s}     -aq2D  {_aq2D__:>12s}                           \\\n'
+                  '     -out {_outputfile_} -verb -ov                        \n'
+                  '\n'
+                  'xyz2pipe  -in {_outputfile_} -x -verb \\\n'
+                  '| nmrPipe -fn POLY -time                                \\\n'
+                  '| nmrPipe -fn SP -off 0.35 -end 0.95 -pow 2 -c 0.5      \\\n'
+                  '| nmrPipe -fn ZF -auto -zf 2                            \\\n'
+                  '| nmrPipe -fn FT                                        \\\n'
+                  '| nmrPipe -fn PS -p0 {_p0x_:>6s} -p1 {_p1x_:>6s} -di -verb        \\\n'
+                  '{Ext}| nmrPipe -fn EXT {ProtonExtraction:27s}           \\\n'
+                  '| nmrPipe -fn TP                                        \\\n'
+                  '{LP}| nmrPipe -fn LP -fb {LPoptions:35s}\\\n'
+                  '| nmrPipe -fn SP -off 0.35 -end 1.0 -pow 2 -c {_c_:5s}     \\\n'
+                  '| nmrPipe -fn ZF -auto -zf 2                            \\\n'
+                  '| nmrPipe -fn FT                                        \\\n'
+                  '| nmrPipe -fn PS -p0 {_p0y_:>6s} -p1 {_p1y_:>6s} -di -verb        \\\n'
+                  '| pipe2xyz -y -out {_planefile_} -verb -ov\n'
+                  '\n'
+                  'xyz2pipe  -in {_planefile_} -z -verb \\\n'
+                  '{LP}| nmrPipe -fn LP -fb {LPoptions:35s}\\\n'
+                  '| nmrPipe -fn SP -off 0.35 -end 1.0 -pow 2 -c {_cz_:5s}     \\\n'
+                  '| nmrPipe -fn ZF -auto -zf 2                            \\\n'
+                  '| nmrPipe -fn FT                                        \\\n'
+                  '| nmrPipe -fn PS -p0 {_p0z_:>6s} -p1 {_p1z_:>6s} -di -verb        \\\n'
+                  '{Rev}| nmrPipe -fn REV -sw                                   \\\n'
+                  '| pipe2xyz -z -out {_spectrumfile_} -verb -ov\n'
+                  '\n'
+                  'xyz2pipe  -in {_spectrumfile_} -x > {_processedfile_}\n').format(**parameters)
+        return script
+    ###################
     def CreateConverFile(self,
                          userphase,
                          SecondDimension = None,
                          Fastprocess = None,
                          Extract = None,
-                         Trosy_experiment = None):
+                         Trosy_experiment = None,
+                         LP_order = None,
+                         LP_prediction = None,
+                         Autophase = False):
         """
         It creates the convert file based
         Parameters:
@@ -353,6 +3414,9 @@ class Convert_HSQC():
             * Fastprocess = No linear prediction
             * Extract = extract proton dimension, like: [6.0,10.0] in ppm
             * Trosy_experiment = Trosy or non trosy
+            * LP_order = order of the linear prediction, default = 8
+            * LP_prediction = number of predicted points, default = size
+            * Autophase = automatic proton p0/p1, userphase is added to p0
         Returns:
         ========
             * File created = self.ConvertFileName
@@ -406,6 +3470,13 @@ class Convert_HSQC():
         parameters['_yobs__'] = '{0:10.6f}'.format(yobs)
         parameters['_yCAR__'] = '{0:9.6f}'.format(self.Get_carrier_in_PPM(xcar, float(self.Info('sfrq')[0]), yobs, SecondDimension))
         parameters['_ylab__'] = self.Info(SecDim[2])[0]
+        if self.schedule:
+            # var2pipe reads the measured increments, the reconstruction
+            # puts them on the full grid of NUSsize increments
+            parameters['_yN____'] = str(len(self.schedule) * 2)
+            parameters['_yT____'] = str(len(self.schedule))
+            parameters['NUSsize'] = str(max(int(self.Info('ni')[0]), max(self.schedule) + 1))
+            parameters['NUSschedule'] = ' '.join([str(index) for index in self.schedule])
         #
         parameters['_ndim__'] = '2'
         parameters['_aq2D__'] = 'States'
@@ -417,6 +3488,11 @@ class Convert_HSQC():
             parameters['LP'] = '#'
         else:
             parameters['LP'] = ''
+        parameters['LPoptions'] = ''
+        if LP_order:
+            parameters['LPoptions'] += '-ord {0:d} '.format(LP_order)
+        if LP_prediction:
+            parameters['LPoptions'] += '-pred {0:d} '.format(LP_prediction)
         #
         parameters['_p0x_'] = '{0:5.1f}'.format(phase[0])
         parameters['_p1x_'] = '{0:5.1f}'.format(phase[1])
@@ -442,6 +3518,38 @@ class Convert_HSQC():
             parameters['_p0y_']  = '{0:5.1f}'.format(0.0)
             parameters['_p1y_']  = '{0:5.1f}'.format(0.0)
         #
+        if self._3D:
+            # Triple resonance: y = ni (like 13C) with States, z = ni2 (like
+            # 15N) with echo / anti-echo, the nucleus comes from dn / dn2
+            yobs = float(self.Info('dfrq')[0])
+            parameters['_yMODE_'] = 'Complex'
+            parameters['_sw2___'] = '{0:10.4f}'.format(float(self.Info('sw1')[0]))
+            parameters['_yobs__'] = '{0:10.6f}'.format(yobs)
+            parameters['_yCAR__'] = '{0:9.6f}'.format(self.Get_carrier_in_PPM(xcar, float(self.Info('sfrq')[0]), yobs, self.Info('dn')[0].strip('"')[0]))
+            parameters['_ylab__'] = self.Info('dn')[0]
+            zobs = float(self.Info('dfrq2')[0])
+            parameters['_zN____'] = str(int(self.Info('ni2')[0]) * 2)
+            parameters['_zT____'] = self.Info('ni2')[0]
+            parameters['_zMODE_'] = 'Rance-Kay'
+            parameters['_sw3___'] = '{0:10.4f}'.format(float(self.Info('sw2')[0]))
+            parameters['_zobs__'] = '{0:10.6f}'.format(zobs)
+            parameters['_zCAR__'] = '{0:9.6f}'.format(self.Get_carrier_in_PPM(xcar, float(self.Info('sfrq')[0]), zobs, self.Info('dn2')[0].strip('"')[0]))
+            parameters['_zlab__'] = self.Info('dn2')[0]
+            # Which phase cycle is the outer loop of the fid
+            array = self.Info('array')[0][1:-1].split(',')
+            if 'phase' in array and 'phase2' in array and array.index('phase2') < array.index('phase'):
+                parameters['_aqORD_'] = '1'
+            else:
+                parameters['_aqORD_'] = '0'
+            if self.Info('f2180') and 'y' in self.Info('f2180')[0]:
+                parameters['_cz_']   = '{0:3.1f}'.format(1.0)
+                parameters['_p0z_']  = '{0:5.1f}'.format(-90.0)
+                parameters['_p1z_']  = '{0:5.1f}'.format(180.0)
+            else:
+                parameters['_cz_']   = '{0:3.1f}'.format(0.5)
+                parameters['_p0z_']  = '{0:5.1f}'.format(0.0)
+                parameters['_p1z_']  = '{0:5.1f}'.format(0.0)
+        #
         if Trosy_experiment:
             parameters['Rev'] = ''
         else:
@@ -449,6 +3557,23 @@ class Convert_HSQC():
         #
         parameters['_processedfile_'] = self.Path + self.Get_Current_Dir() + '.dat'
         #
+        if Autophase:
+            # The first increment is enough (the first fid of a 3D, like for
+            # a 1D), also while the acquisition is running
+            if self.watch:
+                self.Wait_increments(1, self.watch)
+            p0, p1 = NmrPipeEngine(parameters).Autophase(self.FidData(1),
+                                                         2 if self._2D and not self._3D else 1)
+            try:
+                user = float(userphase)
+            except ValueError:
+                user = 0.0
+            parameters['_p0x_'] = '{0:5.1f}'.format((p0 + user) % 360.0)
+            parameters['_p1x_'] = '{0:5.1f}'.format(p1)
+            print '----------------------------------------------------------------'
+            print 'Automatic phase correction: p0 = {0:5.1f} + ({1}) = {2}, p1 = {3}'.format(
+                   p0, user, parameters['_p0x_'], parameters['_p1x_'])
+            print '----------------------------------------------------------------'
         #
         self.multiple_file = False # True if there are multiple files in the fid file
         #################
@@ -458,12 +3583,18 @@ class Convert_HSQC():
             ################
             script = self.script_for_regular_1D(parameters)
             ################
+        elif self._3D:
+            # 3D experiment
+            parameters['_ndim__'] = '3'
+            parameters['_outputfile_'] = self.Path + self.__temporary_folder + '/' + self.Get_Current_Dir() + '_%03d.fid'
+            parameters['_planefile_'] = self.Path + self.__temporary_folder + '/' + self.Get_Current_Dir() + '_%03d.ft2'
+            parameters['_spectrumfile_'] = self.Path + self.__temporary_folder + '/' + self.Get_Current_Dir() + '_%03d.ft3'
+            ################
+            script = self.script_for_regular_3D(parameters)
+            ################
         else:
             # 2D experiment
-            self.onefile = 'single_hsqc'
-            for element in self.Info('array')[0][1:-1].split(','):
-                if not 'phase' in element:
-                    self.onefile = element
+            self.onefile = self.Get_Array_Parameter()
             if self.onefile == 'single_hsqc':
                 ################
                 script = self.script_for_regular_2D(parameters)
@@ -481,12 +3612,12 @@ class Convert_HSQC():
                 parameters['_elab__'] = '"Trel"'
                 parameters['_outputfile_'] = self.Path + self.__temporary_folder + '/' + self.Get_Current_Dir() + '_%03d.fid'
                 parameters['_processedfile_'] = self.Path + self.Get_Current_Dir() + '_%01d.dat'
-                os.system('mkdir '+self.__temporary_folder)
                 ################
                 script = self.script_for_semi_3D(parameters)
                 ################
+        self.parameters = parameters
         # Write out the convert file
-        convertfile = open(self.ConvertFileName,'w')
+        convertfile = open(self.Path + self.ConvertFileName,'w')
         convertfile.write(script)
         convertfile.close()
         #
@@ -497,7 +3628,9 @@ class Convert_HSQC():
     def RunConvertFile(self,
                        open_nmrDraw = True,
                        open_sparky = False,
-                       nocleanup = False):
+                       nocleanup = False,
+                       native = False,
+                       timeout = None):
         """
         Run the convert script, show it in NmrDraw or Sparky and erase all
         files if needed
@@ -506,21 +3639,60 @@ class Convert_HSQC():
             * open_nmrDraw =
             * open_sparky =
             * nocleanup =
+            * native = process with NmrPipeEngine instead of the script
+            * timeout = seconds for one processing step, None = no limit
         """
-        #
-        os.system('chmod 755 ' + self.ConvertFileName)
-        os.system('./' + self.ConvertFileName)
+        # A failed run must not leave the results of an earlier run behind
+        for name in self.Output_files('.ucsf') + self.Output_files('.dat'):
+            if os.path.exists(name):
+                os.remove(name)
         #
         result_file = self.Path + self.Get_Current_Dir()
-        if self.multiple_file:
-            # If there are multiple file, the header conteins 3 dim => set to 2
-            for i in range(len(self.Info(self.onefile)[0].split())):
-                os.system('sethdr '+ result_file + '_' + str(i + 1) + '.dat -ndim 2')
-                os.system('pipe2ucsf '+ result_file + '_' + str(i + 1) + '.dat '
-                                      + result_file + '_' + str(i + 1) + '.ucsf')
-        else:
-            os.system('pipe2ucsf '+ result_file + '.dat '
-                                  + result_file + '.ucsf')
+        try:
+            if native:
+                # The .dat files are only needed for nmrDraw or to keep them
+                # The native processing writes the .ucsf files itself
+                start = self.report.Start()
+                hits, misses = self.RunNative(open_nmrDraw or nocleanup)
+                self.report.Stop('native', start, {'vector_cache_hits': hits,
+                                                   'vector_cache_misses': misses})
+            else:
+                # The var2pipe output of 3D and arrayed data goes to the
+                # temporary folder, only created when the script runs
+                if ((self._3D or self.multiple_file) and
+                    not os.path.isdir(self.Path + self.__temporary_folder)):
+                    os.mkdir(self.Path + self.__temporary_folder)
+                # The script stays executable for the user, its commands
+                # run as subprocess pipelines
+                os.chmod(self.Path + self.ConvertFileName, 0o755)
+                script = open(self.Path + self.ConvertFileName).read()
+                Pipeline.Run_all([Pipeline.From_script(script, self.report)],
+                                 timeout = timeout)
+                if self.multiple_file:
+                    # If there are multiple file, the header conteins 3 dim => set to 2
+                    # Every plane is an independent job, they run concurrently
+                    jobs = []
+                    for i in range(len(self.Info(self.onefile)[0].split())):
+                        plane = result_file + '_' + str(i + 1)
+                        jobs.append(Pipeline([[['sethdr', plane + '.dat', '-ndim', '2']],
+                                              [['pipe2ucsf', plane + '.dat', plane + '.ucsf']]],
+                                             self.report))
+                    if multiprocessing.current_process().daemon:
+                        processes = 1
+                    else:
+                        processes = multiprocessing.cpu_count()
+                    Pipeline.Run_all(jobs, processes, timeout)
+                else:
+                    Pipeline.Run_all([Pipeline([[['pipe2ucsf', result_file + '.dat',
+                                                  result_file + '.ucsf']]],
+                                               self.report)],
+                                     timeout = timeout)
+        except PipelineError, error:
+            print ''.join(('\n-----------\nThe processing stopped! ', str(error),
+                           '\n-----------\n'))
+            # Written into the report by __init__
+            self.error = str(error)
+            exit()
 
         if open_nmrDraw:
             os.system('nmrDraw '+ result_file+ '.dat')
@@ -530,12 +3702,176 @@ class Convert_HSQC():
             #os.system('sparky ' + result_file + '*.ucsf')
 
         if not nocleanup:
-            if self.__temporary_folder in os.listdir('.'):
-                os.system('rm -rf ' + self.__temporary_folder)
-            os.system('rm -f ' + result_file + '*.fid')
-            os.system('rm -f ' + result_file + '*.dat')
+            start = self.report.Start()
+            if self.__temporary_folder in os.listdir(self.Path):
+                shutil.rmtree(self.Path + self.__temporary_folder, True)
+            for name in glob.glob(result_file + '*.fid') + glob.glob(result_file + '*.dat'):
+                os.remove(name)
+            self.report.Stop('cleanup', start)
         #
         return None
+    ###################
+    def RunNative(self, write_pipe = False, increments = None):
+        """
+        Process the memory mapped fid with NmrPipeEngine, the same function
+        chain as the script without var2pipe and the nmrPipe processes. The
+        .ucsf files are written directly, the .dat files only if write_pipe.
+        Only the first increments are processed if given, see FidData().
+        Returns the (hits, misses) of the VectorCache of the workers.
+        """
+        if not self._2D and self.stream:
+            # Batch by batch, the fids are never in the memory at once (not
+            # even as a copy of the view, see VarianFid.Data())
+            count = increments or self.Acquired_increments()[0]
+            jobs = [(self.Path, self.FidFileName, count, self.parameters,
+                     write_pipe)]
+            return self.Map(Stream_worker, jobs)[0]
+        fids = self.FidData(increments)
+        keep = self.keepprephase
+        if not self._2D:
+            jobs = [(self.Path, self.FidFileName, fids.shape, None,
+                     self.parameters, 1, write_pipe, keep)]
+        elif self._3D:
+            jobs = [(self.Path, self.FidFileName, fids.shape, None,
+                     self.parameters, 3, write_pipe, keep)]
+        elif self.multiple_file:
+            # Every plane is processed and converted on its own core
+            jobs = []
+            for i in range(fids.shape[1]):
+                jobs.append((self.Path, self.FidFileName, fids.shape, i,
+                             self.parameters, 2, write_pipe, keep))
+        else:
+            jobs = [(self.Path, self.FidFileName, fids.shape, None,
+                     self.parameters, 2, write_pipe, keep)]
+        return tuple([sum(counters) for counters in zip(*self.Map(Native_worker, jobs))])
+    ###################
+    def Watch(self, interval = 60.0):
+        """
+        Process the data while it is acquired
+
+        The t1 increments are the outermost loop of the fid, so every
+        arrayed plane grows by one increment at a time. Every interval
+        seconds the complete increments are counted from the size of the
+        fid, and if there are new ones all the planes are processed natively
+        from the increments measured so far and their .ucsf files are
+        replaced. Returns when the acquisition is finished, Ctrl-C stops
+        the watching.
+
+        Parameters:
+        ===========
+            * interval = seconds between two checks of the fid file
+        """
+        processed = 0
+        # The indirect dimension needs at least two increments (LP, ZF)
+        minimum = 2 if self._2D else 1
+        try:
+            while True:
+                acquired, total = self.Acquired_increments()
+                if acquired >= total:
+                    break
+                if acquired > processed and acquired >= minimum:
+                    start = time.time()
+                    self.RunNative(increments = acquired)
+                    processed = acquired
+                    print 'Acquired {0} of {1} increments, refreshed in {2:.1f} s'.format(
+                          acquired, total, time.time() - start)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print ''.join(('\n-----------\nWatching stopped after ',
+                           str(processed), ' processed increments!',
+                           '\n-----------\n'))
+            exit()
+        return None
+    ###################
+    def Wait_increments(self, increments, interval = 60.0):
+        """
+        Wait until the first increments of a running acquisition are in
+        the fid file, Ctrl-C stops the waiting
+
+        Parameters:
+        ===========
+            * increments = number of increments, see Acquired_increments()
+            * interval = seconds between two checks of the fid file
+        """
+        try:
+            while self.Acquired_increments()[0] < increments:
+                print 'Waiting for {0} acquired increment(s)...'.format(increments)
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print '\n-----------\nWaiting stopped, nothing is processed!\n-----------\n'
+            exit()
+        return None
+    ###################
+    def Output_files(self, extension):
+        """
+        Returns the result files with the extension, like '.ucsf'
+        """
+        result_file = self.Path + self.Get_Current_Dir()
+        if self.multiple_file:
+            return [result_file + '_' + str(i + 1) + extension
+                    for i in range(len(self.Info(self.onefile)[0].split()))]
+        return [result_file + extension]
+    ###################
+    def Write_store(self):
+        """
+        Write a chunked, compressed copy with previews (.nmrz, see
+        SpectrumStore) of every .ucsf result
+        """
+        if numpy is None:
+            print ('\n-----------\nThe .nmrz files require numpy! '
+                   'Please install it!\n-----------\n')
+            exit()
+        for FileName in self.Output_files('.ucsf'):
+            if os.path.exists(FileName):
+                data, axes = NmrPipeEngine.Read_ucsf(FileName)
+                SpectrumStore.Write(FileName[:-5] + '.nmrz', data, axes)
+                print '{0} written ({1:.1f} MB instead of {2:.1f} MB)'.format(
+                       FileName[:-5] + '.nmrz',
+                       os.path.getsize(FileName[:-5] + '.nmrz') / 1024.0 ** 2,
+                       os.path.getsize(FileName) / 1024.0 ** 2)
+        return None
+    ###################
+    def Fit_relaxation(self):
+        """
+        Pick the peaks of the first plane of an arrayed experiment and fit
+        the decay of all of them along the arrayed parameter, the table is
+        written into <experiment>_rates.txt, see RelaxationSeries
+        """
+        if not self.multiple_file:
+            print 'NOTE: "fit" needs an arrayed experiment, no rates are fitted!'
+            return None
+        results = self.Output_files('.ucsf')
+        if numpy is None:
+            print ('\n-----------\nThe fitting requires numpy! '
+                   'Please install it!\n-----------\n')
+            exit()
+        if [name for name in results if not os.path.exists(name)]:
+            print '\n-----------\nThe .ucsf files of the planes are missing, no rates are fitted!\n-----------\n'
+            return None
+        series = RelaxationSeries(results, self.Info(self.onefile)[0].split())
+        FileName = self.Path + self.Get_Current_Dir() + '_rates.txt'
+        series.Write(FileName)
+        print '{0} peaks fitted along {1}, the rates are in {2}'.format(
+               len(series.peaks), self.onefile, FileName)
+        return None
+    ###################
+    def Map(self, function, jobs):
+        """
+        Run function for every job on a process pool, returns the results
+
+        Inside a worker of a pool (like Batch_Convert) the jobs run serially,
+        daemonic processes can not start their own pool.
+        """
+        if len(jobs) < 2 or multiprocessing.current_process().daemon:
+            return map(function, jobs)
+        pool = multiprocessing.Pool(min(len(jobs), multiprocessing.cpu_count()))
+        try:
+            results = pool.map(function, jobs)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+    ###################
     def ByeBye(self):
         """
         Write out the temperature to be sure the the carrier is at the right
@@ -552,7 +3888,748 @@ class Convert_HSQC():
 
 
 
-arguments = sys.argv
 
-HC = Convert_HSQC(arguments)
+def Native_worker(job):
+    """
+    Process a 1D, a 2D, a 3D or one plane of an arrayed (pseudo 3D)
+    experiment natively and write its .ucsf file (and the .dat file if
+    write_pipe)
+
+    If keep, the phase independent intermediate of a 1D or 2D is kept as
+    <result>.prephase.npy, so a new proton phase does not process the x
+    and the y dimension again, see NmrPipeEngine.Process_phased().
+
+    Parameters:
+    ===========
+        * job = (Path, FidFileName, shape of the fid data, plane index or
+                 None, parameters of CreateConverFile, dimensions,
+                 write_pipe, keep)
+    Returns:
+    ========
+        * (hits, misses) of the VectorCache during the job
+    """
+    Path, FidFileName, shape, plane, parameters, dimensions, write_pipe, keep = job
+    counters = NmrPipeEngine.vectors.Counters()
+    fids = VarianFid(Path, FidFileName).Data(shape)
+    status = os.stat(Path + FidFileName)
+    result = parameters['_processedfile_']
+    if plane is not None:
+        fids = fids[:, plane, :]
+        result = result % (plane + 1)
+    engine = NmrPipeEngine(parameters)
+    if dimensions == 3:
+        # Out of core, the work files are removed at the end
+        Folder = tempfile.mkdtemp(prefix = '.nmr_procy_', dir = Path or './') + '/'
+        try:
+            spectrum = engine.Process_3D(fids, Folder)
+            # Both are written from the memory mapped spectrum, row by row
+            engine.Write_ucsf_rows(result[:-4] + '.ucsf.part', spectrum.shape, [spectrum])
+            if write_pipe:
+                engine.Write_pipe(result, spectrum)
+        finally:
+            shutil.rmtree(Folder, True)
+    else:
+        spectrum = engine.Process_phased(fids, dimensions,
+                                         keep and result[:-4] + '.prephase' or None,
+                                         (status.st_size, status.st_mtime))
+        engine.Write_ucsf(result[:-4] + '.ucsf.part', spectrum)
+        if write_pipe:
+            engine.Write_pipe(result, spectrum)
+    # Replaced at once, Sparky never reads a half written (refreshed) file
+    os.rename(result[:-4] + '.ucsf.part', result[:-4] + '.ucsf')
+    return NmrPipeEngine.vectors.Counters(counters)
+################################################################################
+
+
+def Stream_worker(job):
+    """
+    Process a 1D series natively batch by batch, read block by block from
+    the fid, and write its .ucsf file (and the .dat file if write_pipe)
+
+    Parameters:
+    ===========
+        * job = (Path, FidFileName, number of fids, parameters of
+                 CreateConverFile, write_pipe)
+    Returns:
+    ========
+        * (hits, misses) of the VectorCache during the job
+    """
+    Path, FidFileName, count, parameters, write_pipe = job
+    counters = NmrPipeEngine.vectors.Counters()
+    result = parameters['_processedfile_']
+    engine = NmrPipeEngine(parameters)
+    engine.Process_stream(VarianFid(Path, FidFileName).Stream(count = count), count,
+                          result[:-4] + '.ucsf.part', write_pipe and result or None)
+    os.rename(result[:-4] + '.ucsf.part', result[:-4] + '.ucsf')
+    return NmrPipeEngine.vectors.Counters(counters)
+################################################################################
+
+
+def Batch_worker(job):
+    """
+    Process one directory of a Batch_Convert run in a worker process
+
+    The output of the processing (and of the nmrPipe programs) goes to
+    convert_nmr.log in the experiment directory.
+
+    Parameters:
+    ===========
+        * job = (directory, temperature, phase, flags)
+    Returns:
+    ========
+        * (directory, None) or (directory, error message)
+    """
+    directory, temperature, phase, flags = job
+    log = open(directory + 'convert_nmr.log', 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = (os.dup(1), os.dup(2))
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    error = None
+    try:
+        try:
+            Convert_HSQC(['batch'] + flags + [str(phase)],
+                         Path = directory, Temperature = temperature)
+        except SystemExit:
+            error = 'stopped, see ' + directory + 'convert_nmr.log'
+        except Exception, exception:
+            error = '{0}: {1}'.format(exception.__class__.__name__, exception)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+        log.close()
+    return directory, error
+################################################################################
+
+
+class Batch_Convert():
+    """
+    Process many experiment directories in parallel, without any question
+
+    Example:
+
+        Batch_Convert(['titration/*', 'hsqc_25C/'],
+                      Temperature = {'hsqc_25C/': 25.0},
+                      Phase = 0.0, Flags = ['native'])
+    """
+    #####################################################
+    def __init__(self, Directories, Temperature = None, Phase = '0.0',
+                 Flags = None, Processes = None, Summary = None):
+        """
+        Parameters:
+
+        * Directories = list of experiment directories or glob patterns
+        * Temperature = None (procpar value), one value for all directories
+                        or a {directory: temperature} dictionary
+        * Phase       = proton p0 phase correction, one value for all
+                        directories or a {directory: phase} dictionary
+        * Flags       = Convert_HSQC flags like 'native', 'fast', 'nocleanup'
+        * Processes   = number of parallel processes, default = cpu count
+        * Summary     = file name of the aggregated JSON report of the
+                        convert_nmr.json reports, None = not written
+        """
+        self.directories = []
+        for pattern in Directories:
+            for directory in sorted(glob.glob(pattern)) or [pattern]:
+                directory = os.path.join(directory, '')
+                if (os.path.exists(directory + 'procpar') and
+                    directory not in self.directories):
+                    self.directories.append(directory)
+        # Interactive and display flags make no sense in a batch
+        flags = [flag for flag in (Flags or [])
+                 if flag not in ('temp', 'help', 'noplot')] + ['noplot']
+        jobs = []
+        for directory in self.directories:
+            jobs.append((directory,
+                         self.Value(Temperature, directory, None),
+                         self.Value(Phase, directory, '0.0'),
+                         flags))
+        print 'Processing {0} directories'.format(len(jobs))
+        self.errors = {}
+        pool = multiprocessing.Pool(Processes)
+        try:
+            for directory, error in pool.imap_unordered(Batch_worker, jobs):
+                if error:
+                    self.errors[directory] = error
+                    print 'FAILED ' + directory + ' ' + error
+                else:
+                    print 'done   ' + directory
+        finally:
+            pool.close()
+            pool.join()
+        print '{0} done, {1} failed'.format(len(jobs) - len(self.errors),
+                                            len(self.errors))
+        if Summary:
+            ProcessingReport.Summary([directory + 'convert_nmr.json'
+                                      for directory in self.directories], Summary)
+        return None
+    #####################################################
+    def Value(self, values, directory, default):
+        """
+        Returns the value for a directory from a single value or dictionary
+        """
+        if isinstance(values, dict):
+            for key in (directory, directory.rstrip('/'),
+                        os.path.normpath(directory)):
+                if key in values:
+                    return values[key]
+            return default
+        if values is None:
+            return default
+        return values
+    #####################################################
+    @staticmethod
+    def From_arguments(argumentlist):
+        """
+        Start a batch from a command line like list, see 'help'
+        """
+        keywords = {'jobs': None, 'temp': None, 'phase': '0.0', 'list': None,
+                    'summary': None}
+        flags = []
+        directories = []
+        words = argumentlist[argumentlist.index('batch') + 1:]
+        i = 0
+        while i < len(words):
+            if words[i] in keywords and i + 1 < len(words):
+                keywords[words[i]] = words[i + 1]
+                i += 1
+            elif words[i] == 'extract' and i + 1 < len(words):
+                flags.extend(words[i:i + 2])
+                i += 1
+            elif os.path.isdir(words[i]) or re.search('[*?[]', words[i]):
+                directories.append(words[i])
+            else:
+                flags.append(words[i])
+            i += 1
+        temperature = keywords['temp']
+        phase = keywords['phase']
+        if keywords['list']:
+            temperature = {}
+            phase = {}
+            for line in open(keywords['list']):
+                values = line.split()
+                if not values or values[0].startswith('#'):
+                    continue
+                directory = os.path.join(values[0], '')
+                directories.append(directory)
+                temperature[directory] = (float(values[1]) if len(values) > 1
+                                          else keywords['temp'])
+                phase[directory] = (values[2] if len(values) > 2
+                                    else keywords['phase'])
+        if keywords['jobs']:
+            keywords['jobs'] = int(keywords['jobs'])
+        return Batch_Convert(directories, Temperature = temperature,
+                             Phase = phase, Flags = flags,
+                             Processes = keywords['jobs'],
+                             Summary = keywords['summary'])
+################################################################################
+
+
+def Index_worker(directory):
+    """
+    Read the indexed parameters of one procpar for ProcparIndex.Update
+
+    A procpar that can not be read or parsed (like a real parameter with a
+    value "abc") does not stop the update of the others.
+
+    Returns:
+    ========
+        * (directory, size, modification time, {name: value}) or
+          (directory, error message) if the procpar is skipped
+    """
+    try:
+        status = os.stat(directory + 'procpar')
+        # The archive is not touched, the database is the only output
+        procpar = ProcparData(directory, SaveIndex = False)
+        values = {}
+        for name in ProcparIndex.PARAMETERS:
+            value = procpar.value(name)
+            if value:
+                values[name] = value[0]
+    except SystemExit:
+        return directory, 'the procpar can not be read'
+    except (ValueError, IOError, OSError, IndexError, KeyError) as error:
+        return directory, '{0}: {1}'.format(type(error).__name__, error)
+    return directory, status.st_size, status.st_mtime, values
+################################################################################
+
+
+class ProcparIndex():
+    """
+    SQLite index of the main procpar parameters of a data archive
+
+    Update() walks a folder tree and parses the new or changed procpar
+    files (by size and modification time) in parallel, Query() returns the
+    matching experiment directories, ready for Convert_HSQC or
+    Batch_Convert. Nothing is written into the archive (no .procpar.index
+    files), the database is the only written file.
+
+    Example:
+
+        Archive = ProcparIndex('archive.sqlite')
+        Archive.Update('/data/')
+        print Archive.Query(seqfil = 'gNhsqc', temp = (24.5, 25.5),
+                            ni = (129, None))
+    """
+    # The indexed parameters, each one is a column
+    PARAMETERS = ['seqfil', 'pslabel', 'temp', 'np', 'ni', 'ni2', 'sw', 'sw1',
+                  'sw2', 'sfrq', 'dfrq', 'dfrq2', 'tn', 'dn', 'dn2', 'nt',
+                  'array', 'arraydim', 'f1180', 'samplename', 'time_run']
+    #####################################################
+    def __init__(self, DatabaseName):
+        """
+        Parameters:
+
+        * DatabaseName = the SQLite file, created if it does not exist
+        """
+        self.DatabaseName = DatabaseName
+        # (directory, error message) of the procpar files the last Update() skipped
+        self.skipped = []
+        self.connection = sqlite3.connect(DatabaseName)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS experiments (directory TEXT PRIMARY KEY, '
+            'size INTEGER, mtime REAL, ' +
+            ', '.join(['"' + name + '"' for name in self.PARAMETERS]) + ')')
+        for name in ('seqfil', 'temp', 'ni'):
+            self.connection.execute('CREATE INDEX IF NOT EXISTS by_{0} ON '
+                                    'experiments ("{0}")'.format(name))
+        self.connection.commit()
+        return None
+    #####################################################
+    def Update(self, Folder, Processes = None):
+        """
+        Add the new and changed, remove the deleted experiments below Folder
+
+        The directories of unreadable procpar files are printed and kept in
+        self.skipped as (directory, error message), they are not indexed and
+        are tried again by the next Update().
+
+        Returns:
+        ========
+            * (number of updated, number of removed) experiments
+        """
+        Folder = os.path.join(os.path.abspath(Folder), '')
+        known = dict([(row[0], (row[1], row[2])) for row in self.connection.execute(
+                       'SELECT directory, size, mtime FROM experiments '
+                       'WHERE substr(directory, 1, ?) = ?', (len(Folder), Folder))])
+        found = set()
+        changed = []
+        for directory, folders, files in os.walk(Folder):
+            if 'procpar' not in files:
+                continue
+            directory = os.path.join(directory, '')
+            found.add(directory)
+            try:
+                status = os.stat(directory + 'procpar')
+            except OSError:
+                continue
+            if known.get(directory) != (status.st_size, status.st_mtime):
+                changed.append(directory)
+        removed = [directory for directory in known if directory not in found]
+        self.connection.executemany('DELETE FROM experiments WHERE directory = ?',
+                                    [(directory,) for directory in removed])
+        columns = ['directory', 'size', 'mtime'] + self.PARAMETERS
+        insert = ('INSERT OR REPLACE INTO experiments (' +
+                  ', '.join(['"' + name + '"' for name in columns]) +
+                  ') VALUES (' + ', '.join(['?'] * len(columns)) + ')')
+        if len(changed) > 1 and not multiprocessing.current_process().daemon:
+            pool = multiprocessing.Pool(Processes)
+            results = pool.imap_unordered(Index_worker, changed, chunksize = 64)
+        else:
+            pool = None
+            results = (Index_worker(directory) for directory in changed)
+        self.skipped = []
+        try:
+            updated = 0
+            for result in results:
+                if len(result) == 2:
+                    print 'skipped ' + ' '.join(result)
+                    self.skipped.append(result)
+                    continue
+                directory, size, mtime, values = result
+                self.connection.execute(insert, [directory, size, mtime] +
+                                        [values.get(name) for name in self.PARAMETERS])
+                updated += 1
+                if updated % 1000 == 0:
+                    self.connection.commit()
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        self.connection.commit()
+        return updated, len(removed)
+    #####################################################
+    def Query(self, **conditions):
+        """
+        Returns the directories of the matching experiments
+
+        Parameters:
+        ===========
+            * conditions = name = value for equality, name = (minimum,
+                           maximum) for an inclusive range, None for an open
+                           end, like: seqfil = 'gNhsqc', ni = (129, None)
+        """
+        where = []
+        values = []
+        for name, value in sorted(conditions.items()):
+            if name not in self.PARAMETERS:
+                raise KeyError('{0} is not an indexed parameter'.format(name))
+            if isinstance(value, (tuple, list)):
+                if value[0] is not None:
+                    where.append('"{0}" >= ?'.format(name))
+                    values.append(value[0])
+                if value[1] is not None:
+                    where.append('"{0}" <= ?'.format(name))
+                    values.append(value[1])
+            else:
+                where.append('"{0}" = ?'.format(name))
+                values.append(value)
+        query = 'SELECT directory FROM experiments'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        return [row[0] for row in self.connection.execute(query + ' ORDER BY directory',
+                                                          values)]
+    #####################################################
+    @staticmethod
+    def From_arguments(argumentlist):
+        """
+        Run an 'index' or 'query' command line, see 'help'
+        """
+        if 'index' in argumentlist:
+            words = argumentlist[argumentlist.index('index') + 1:]
+            Folder = words[0]
+            if len(words) > 1:
+                DatabaseName = words[1]
+            else:
+                DatabaseName = os.path.join(Folder, 'procpar_index.sqlite')
+            Archive = ProcparIndex(DatabaseName)
+            updated, removed = Archive.Update(Folder)
+            print '{0} experiments updated, {1} removed, {2} skipped in {3}'.format(
+                   updated, removed, len(Archive.skipped), DatabaseName)
+            return None
+        words = argumentlist[argumentlist.index('query') + 1:]
+        conditions = {}
+        for word in words[1:]:
+            name, value = word.split('=', 1)
+            if ':' in value:
+                conditions[name] = [float(limit) if limit else None
+                                    for limit in value.split(':', 1)]
+            else:
+                try:
+                    conditions[name] = float(value)
+                except ValueError:
+                    conditions[name] = value
+        for directory in ProcparIndex(words[0]).Query(**conditions):
+            print directory
+        return None
+################################################################################
+
+
+class ProcessingDaemon():
+    """
+    Long running process working through a priority queue of processing
+    jobs, submitted over a local (Unix) socket
+
+    The interpreter, numpy, the parsed procpar files and the windows,
+    phase ramps and FFT plans (VectorCache) stay warm between the jobs, a
+    spectrum does not pay for the start up again. The jobs run one after
+    the other, every job uses all the cores for its planes. The output of
+    a job goes to convert_nmr.log in its directory, like in a batch.
+
+    One JSON request per line, one JSON answer per line:
+
+        {"command": "submit", "directory": "/data/hsqc/", "temperature": 25.0,
+         "phase": "-12.0", "flags": ["native"], "priority": 10, "wait": false}
+        {"command": "status"}
+        {"command": "stop"}
+
+    The job with the highest priority (then the oldest) is the next one.
+
+    Example:
+
+        ProcessingDaemon().Serve()
+        ProcessingDaemon.Send({'command': 'submit', 'directory': '/data/hsqc/'})
+    """
+    # Finished jobs remembered for the status
+    HISTORY = 100
+    #####################################################
+    def __init__(self, Socket = None):
+        """
+        Parameters:
+
+        * Socket = file name of the socket, default = ~/.nmr_procy.sock
+        """
+        self.Socket = Socket or ProcessingDaemon.Default_socket()
+        self.queue = []
+        self.jobs = {}
+        self.finished = []
+        self.number = 0
+        self.running = True
+        self.changed = threading.Condition()
+        # The jobs redirect the standard output into their logs
+        self.console = os.fdopen(os.dup(1), 'w', 0)
+        return None
+    #####################################################
+    @staticmethod
+    def Default_socket():
+        return os.path.join(os.path.expanduser('~'), '.nmr_procy.sock')
+    #####################################################
+    def Log(self, message):
+        self.console.write(time.strftime('%Y-%m-%d %H:%M:%S ') + message + '\n')
+        return None
+    #####################################################
+    def Serve(self):
+        """
+        Accept the requests until a 'stop' request or Ctrl-C
+        """
+        if os.path.exists(self.Socket):
+            try:
+                ProcessingDaemon.Send({'command': 'status'}, self.Socket)
+            except socket.error:
+                # Left behind by a daemon that did not stop properly
+                os.remove(self.Socket)
+            else:
+                print ''.join(('\n-----------\nA daemon is already running on ',
+                               self.Socket, '!\n-----------\n'))
+                exit()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.Socket)
+        os.chmod(self.Socket, 0600)
+        listener.listen(16)
+        # Checking for a stop request regularly
+        listener.settimeout(1.0)
+        worker = threading.Thread(target = self.Work)
+        worker.start()
+        self.Log('Listening on ' + self.Socket)
+        try:
+            while self.running:
+                try:
+                    connection = listener.accept()[0]
+                except socket.timeout:
+                    continue
+                connection.settimeout(None)
+                handler = threading.Thread(target = self.Handle, args = (connection,))
+                handler.daemon = True
+                handler.start()
+        except KeyboardInterrupt:
+            self.Log('Interrupted')
+        finally:
+            listener.close()
+            os.remove(self.Socket)
+            self.changed.acquire()
+            self.running = False
+            for priority, number, job in self.queue:
+                job['state'] = 'cancelled'
+            self.queue = []
+            self.changed.notify_all()
+            self.changed.release()
+            # The running job is finished
+            worker.join()
+        self.Log('Stopped')
+        return None
+    #####################################################
+    def Handle(self, connection):
+        """
+        Answer the request of one connection
+        """
+        stream = connection.makefile('rw', 0)
+        try:
+            try:
+                request = json.loads(stream.readline())
+                command = request.get('command')
+                if command == 'submit':
+                    answer = self.Submit(request)
+                elif command == 'status':
+                    answer = self.Status()
+                elif command == 'stop':
+                    self.running = False
+                    answer = {'state': 'stopping'}
+                else:
+                    answer = {'error': 'unknown command: {0}'.format(command)}
+            except (ValueError, AttributeError, TypeError), exception:
+                answer = {'error': 'invalid request: {0}'.format(exception)}
+            stream.write(json.dumps(answer) + '\n')
+        except socket.error:
+            # The client is gone
+            pass
+        finally:
+            stream.close()
+            connection.close()
+        return None
+    #####################################################
+    def Submit(self, request):
+        """
+        Queue a job, returns its state (the result if the request waits)
+        """
+        directory = os.path.join(os.path.abspath(request['directory']), '')
+        if not os.path.exists(directory + 'procpar'):
+            return {'error': 'no procpar in ' + directory}
+        # Interactive and display flags make no sense in a daemon
+        flags = [str(flag) for flag in request.get('flags') or []
+                 if flag not in ('temp', 'help', 'noplot')] + ['noplot']
+        self.changed.acquire()
+        try:
+            if not self.running:
+                return {'error': 'the daemon is stopping'}
+            self.number += 1
+            job = {'id': self.number, 'directory': directory,
+                   'temperature': request.get('temperature'),
+                   'phase': str(request.get('phase', '0.0')),
+                   'flags': flags, 'priority': int(request.get('priority', 0)),
+                   'state': 'queued', 'error': None, 'submitted': time.time()}
+            self.jobs[job['id']] = job
+            heapq.heappush(self.queue, (-job['priority'], job['id'], job))
+            self.changed.notify_all()
+            self.Log('queued   {0} {1} (priority {2})'.format(job['id'], directory,
+                                                           job['priority']))
+            if request.get('wait'):
+                while job['state'] in ('queued', 'running'):
+                    self.changed.wait()
+            return dict(job)
+        finally:
+            self.changed.release()
+    #####################################################
+    def Status(self):
+        """
+        Returns the queued, the running and the last finished jobs
+        """
+        self.changed.acquire()
+        try:
+            return {'jobs': [dict(self.jobs[number]) for number in sorted(self.jobs)]}
+        finally:
+            self.changed.release()
+    #####################################################
+    def Work(self):
+        """
+        Process the queued jobs, in the worker thread
+        """
+        while True:
+            self.changed.acquire()
+            try:
+                while self.running and not self.queue:
+                    self.changed.wait()
+                if not self.running:
+                    return None
+                job = heapq.heappop(self.queue)[2]
+                job['state'] = 'running'
+                job['started'] = time.time()
+            finally:
+                self.changed.release()
+            self.Log('started  {0} {1}'.format(job['id'], job['directory']))
+            # Batch_worker catches the exit() of the processing
+            error = Batch_worker((job['directory'], job['temperature'],
+                                  job['phase'], job['flags']))[1]
+            self.changed.acquire()
+            try:
+                job['finished'] = time.time()
+                job['error'] = error
+                job['state'] = error and 'failed' or 'done'
+                self.finished.append(job['id'])
+                while len(self.finished) > self.HISTORY:
+                    del self.jobs[self.finished.pop(0)]
+                self.changed.notify_all()
+            finally:
+                self.changed.release()
+            self.Log('{0:8} {1} {2} {3:.1f} s'.format(job['state'], job['id'],
+                     error or job['directory'], job['finished'] - job['started']))
+    #####################################################
+    @staticmethod
+    def Send(request, Socket = None):
+        """
+        Send a request to the daemon, returns its answer
+        """
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(Socket or ProcessingDaemon.Default_socket())
+            stream = connection.makefile('rw', 0)
+            stream.write(json.dumps(request) + '\n')
+            answer = stream.readline()
+            stream.close()
+        finally:
+            connection.close()
+        if not answer:
+            raise socket.error('no answer from the daemon')
+        return json.loads(answer)
+    #####################################################
+    @staticmethod
+    def From_arguments(argumentlist):
+        """
+        Run a 'daemon' or 'submit' command line, see 'help'
+        """
+        if 'daemon' in argumentlist:
+            words = argumentlist[argumentlist.index('daemon') + 1:]
+        else:
+            words = argumentlist[argumentlist.index('submit') + 1:]
+        Socket = None
+        if 'socket' in words[:-1]:
+            Socket = words[words.index('socket') + 1]
+            del words[words.index('socket'):words.index('socket') + 2]
+        if 'daemon' in argumentlist and not words:
+            ProcessingDaemon(Socket).Serve()
+            return None
+        if 'daemon' in argumentlist:
+            request = {'command': words[0]}
+        else:
+            keywords = {'priority': 0, 'temp': None, 'phase': '0.0'}
+            request = {'command': 'submit', 'flags': [], 'wait': False}
+            i = 0
+            while i < len(words):
+                if words[i] in keywords and i + 1 < len(words):
+                    keywords[words[i]] = words[i + 1]
+                    i += 1
+                elif words[i] == 'wait':
+                    request['wait'] = True
+                elif 'directory' not in request and os.path.isdir(words[i]):
+                    request['directory'] = os.path.abspath(words[i])
+                else:
+                    request['flags'].append(words[i])
+                i += 1
+            if 'directory' not in request:
+                print '\n-----------\nNo experiment directory to submit!\n-----------\n'
+                exit()
+            request['priority'] = int(keywords['priority'])
+            request['phase'] = keywords['phase']
+            if keywords['temp'] is not None:
+                request['temperature'] = float(keywords['temp'])
+        try:
+            answer = ProcessingDaemon.Send(request, Socket)
+        except socket.error, exception:
+            print ''.join(('\n-----------\nThe daemon is not running (',
+                           str(exception), ')! Start it with "hsqc.com daemon"\n'
+                           '-----------\n'))
+            exit()
+        if answer.get('error') and 'jobs' not in answer and 'state' not in answer:
+            print '\n-----------\n' + answer['error'] + '\n-----------\n'
+            exit()
+        if 'jobs' in answer:
+            for job in answer['jobs']:
+                print '{0:5} {1:10} {2:4} {3}{4}'.format(job['id'], job['state'],
+                       job['priority'], job['directory'],
+                       job['error'] and ' ' + job['error'] or '')
+        elif 'id' in answer:
+            print '{0:5} {1:10} {2}{3}'.format(answer['id'], answer['state'],
+                   answer['directory'], answer['error'] and ' ' + answer['error'] or '')
+        else:
+            print answer['state']
+        return None
+################################################################################
+
+
+if __name__ == '__main__':
+    arguments = sys.argv
+    if 'batch' in arguments:
+        Batch_Convert.From_arguments(arguments)
+    elif 'index' in arguments[1:2] or 'query' in arguments[1:2]:
+        ProcparIndex.From_arguments(arguments)
+    elif 'daemon' in arguments[1:2] or 'submit' in arguments[1:2]:
+        ProcessingDaemon.From_arguments(arguments)
+    elif 'preview' in arguments[1:2]:
+        SpectrumStore.From_arguments(arguments)
+    else:
+        HC = Convert_HSQC(arguments)
 